@@ -0,0 +1,538 @@
+"""
+Micro-benchmarks do backend. Rodar de dentro de backend/:
+
+    python bench.py ratelimit
+    python bench.py middleware
+    python bench.py json
+    python bench.py purchase   # usa o Mongo do .env (MONGO_URL/DB_NAME); cria e apaga um usuário temporário
+    python bench.py end-session [--legacy] [--mock-rtt MS]
+                               # latência p50/p99 do /study/end; Mongo do .env, ou em memória
+                               # (mongomock-motor) com MS de ida e volta por chamada
+    python bench.py levels     # nível a partir do XP: laço por nível vs bisect vs numpy
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _deque_limiter(window: float, clock):
+    # implementação anterior do middleware: um float por request, chaves nunca removidas
+    hitq = defaultdict(deque)
+
+    def hit(key, limit):
+        now = clock()
+        dq = hitq[key]
+        while dq and (now - dq[0]) > window:
+            dq.popleft()
+        if len(dq) >= limit:
+            return False
+        dq.append(now)
+        return True
+
+    return hit, hitq
+
+
+def bench_ratelimit(args):
+    from ratelimit import SlidingWindowLimiter
+
+    window = 60.0
+    print(f"{args.ips} IPs novos por janela, {args.hits} hits/IP, {args.windows} janelas de {window:.0f}s")
+    print(f"{'impl':<8} {'janela':>6} {'chaves':>9} {'memória (MB)':>13}")
+
+    for name in ("deque", "sliding"):
+        clock = _FakeClock()
+        if name == "deque":
+            hit, store = _deque_limiter(window, clock)
+        else:
+            limiter = SlidingWindowLimiter(window, clock=clock)
+            hit, store = limiter.hit, limiter
+
+        tracemalloc.start()
+        for w in range(args.windows):
+            base = w * args.ips
+            step = window / (args.ips * args.hits)
+            for i in range(args.ips * args.hits):
+                ip = base + (i % args.ips)
+                clock.now = w * window + i * step
+                hit((f"10.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}#{ip >> 24}", "GET"), 300)
+            cur, _ = tracemalloc.get_traced_memory()
+            print(f"{name:<8} {w + 1:>6} {len(store):>9} {cur / 1e6:>13.1f}")
+        tracemalloc.stop()
+
+
+def _legacy_guard_app(limiter, limits, csrf_exempt, rate_exempt, max_body):
+    # os quatro @app.middleware("http") de antes, na mesma ordem de registro
+    import secrets
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+    from guards import CONTENT_SECURITY_POLICY
+
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def csrf_guard(request: Request, call_next):
+        if request.method not in ("POST", "PUT", "PATCH", "DELETE"):
+            return await call_next(request)
+        if request.headers.get("Authorization", "").startswith("Bearer "):
+            return await call_next(request)
+        if request.url.path in csrf_exempt:
+            return await call_next(request)
+        header = request.headers.get("X-CSRF-Token")
+        cookie = request.cookies.get("csrf_token")
+        if not header or not cookie or not secrets.compare_digest(header, cookie):
+            return JSONResponse({"detail": "CSRF check failed"}, status_code=403)
+        return await call_next(request)
+
+    @app.middleware("http")
+    async def rate_limit(request: Request, call_next):
+        if request.url.path in rate_exempt:
+            return await call_next(request)
+        ip = request.client.host if request.client else "unknown"
+        method = request.method.upper()
+        if not await limiter.hit((ip, method), limits.get(method, 120)):
+            return JSONResponse({"detail": "Too many requests"}, status_code=429)
+        return await call_next(request)
+
+    @app.middleware("http")
+    async def body_size_guard(request: Request, call_next):
+        if request.method in ("POST", "PUT", "PATCH"):
+            cl = request.headers.get("content-length")
+            if cl and cl.isdigit() and int(cl) > max_body:
+                return JSONResponse({"detail": "Payload too large"}, status_code=413)
+        return await call_next(request)
+
+    @app.middleware("http")
+    async def security_headers(request: Request, call_next):
+        resp = await call_next(request)
+        resp.headers["X-Content-Type-Options"] = "nosniff"
+        resp.headers["X-Frame-Options"] = "DENY"
+        resp.headers["Referrer-Policy"] = "same-origin"
+        resp.headers["Permissions-Policy"] = "camera=(), microphone=(), geolocation=()"
+        resp.headers["Content-Security-Policy"] = CONTENT_SECURITY_POLICY
+        return resp
+
+    return app
+
+
+def bench_middleware(args):
+    import httpx
+    from fastapi import FastAPI
+    from guards import SecurityPipeline
+    from ratelimit import LocalBackend
+
+    limits = {"GET": 10**9, "POST": 10**9}
+    cfg = dict(csrf_exempt=set(), rate_exempt=set(), max_body=1_048_576)
+
+    def root_route(app):
+        @app.get("/api/")
+        async def root():
+            return {"message": "CicloStudy API", "status": "ok"}
+        return app
+
+    before = root_route(_legacy_guard_app(LocalBackend(60), limits, **cfg))
+    after = root_route(FastAPI())
+    after.add_middleware(
+        SecurityPipeline, limiter=LocalBackend(60), limits_by_method=limits, default_limit=120,
+        rate_exempt_paths=cfg["rate_exempt"], csrf_exempt_paths=cfg["csrf_exempt"],
+        max_body_bytes=cfg["max_body"],
+    )
+
+    async def run(app) -> float:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as c:
+            for _ in range(200):  # aquecimento
+                await c.get("/api/")
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def one():
+                async with sem:
+                    r = await c.get("/api/")
+                    assert r.status_code == 200 and r.headers["x-frame-options"] == "DENY"
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(args.requests)))
+            return args.requests / (time.perf_counter() - t0)
+
+    print(f"GET /api/  {args.requests} requests, concorrência {args.concurrency} (ASGI in-process)")
+    results = {}
+    for name, app in (("antes (4x BaseHTTPMiddleware)", before), ("depois (SecurityPipeline)", after)):
+        results[name] = max(asyncio.run(run(app)) for _ in range(args.rounds))
+        print(f"{name:<32} {results[name]:>9.0f} req/s")
+    a, b = results.values()
+    print(f"ganho: {b / a:.2f}x")
+
+
+def _json_payloads():
+    # formatos reais: catálogo do /shop/list, lista do /friends e o breakdown do /stats
+    import uuid
+    from datetime import datetime, timedelta, timezone
+    from shop_seed import build_items
+
+    now = datetime.now(timezone.utc)
+    friends = [
+        {
+            "id": str(uuid.uuid4()), "name": f"Amigo {i}", "nickname": f"amigo{i}", "tag": f"{i:04d}",
+            "picture": None, "level": 1 + i % 40, "coins": 37 * i, "xp": 113 * i,
+            "items_owned": [f"seal_{j}" for j in range(i % 12)],
+            "equipped_items": {"seal": "seal_1", "border": None, "theme": "theme_3"},
+            "last_activity": now - timedelta(minutes=i), "created_at": now - timedelta(days=i),
+        }
+        for i in range(200)
+    ]
+    stats = {
+        "total_time": 91_234, "week_time": 1_234, "cycle_progress": 63.5,
+        "subjects": [
+            {"id": str(uuid.uuid4()), "name": f"Matéria {i}", "color": "#3b82f6",
+             "time_goal": 300, "time_studied": 17 * i, "progress": min(100.0, 17 * i / 3)}
+            for i in range(25)
+        ],
+        "level": 12, "xp": 4_321, "coins": 987, "sessions_completed": 412,
+    }
+    return {"shop": {"items": build_items()}, "friends": friends, "stats": stats}
+
+
+def bench_json(args):
+    from fastapi.encoders import jsonable_encoder
+    from starlette.responses import JSONResponse
+    from responses import FastJSONResponse, orjson
+
+    print(f"encoder: {'orjson ' + orjson.__version__ if orjson else 'json (stdlib, fallback)'}; {args.iterations} iterações")
+    print(f"{'payload':<10} {'bytes':>8} {'antes (µs)':>11} {'depois (µs)':>12} {'ganho':>7}")
+
+    def timed(fn) -> float:
+        fn()
+        t0 = time.perf_counter()
+        for _ in range(args.iterations):
+            fn()
+        return (time.perf_counter() - t0) / args.iterations * 1e6
+
+    for name, payload in _json_payloads().items():
+        before = timed(lambda: JSONResponse(jsonable_encoder(payload)).body)
+        after = timed(lambda: FastJSONResponse(payload).body)
+        size = len(FastJSONResponse(payload).body)
+        print(f"{name:<10} {size:>8} {before:>11.1f} {after:>12.1f} {before / after:>6.1f}x")
+
+
+async def _legacy_buy(db, user_id: str, item: dict) -> bool:
+    # fluxo anterior do /shop/purchase: lê, confere em Python, depois $inc/$push
+    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    await asyncio.sleep(0)  # outro request entra aqui (como entre as idas ao Mongo)
+    price = item.get("price", 0)
+    if (user.get("coins") or 0) < price or item["id"] in (user.get("items_owned") or []):
+        return False
+    await db.users.update_one({"id": user_id}, {"$inc": {"coins": -price}, "$push": {"items_owned": item["id"]}})
+    return True
+
+
+def bench_purchase(args):
+    import uuid
+    import server
+    from fastapi import HTTPException
+
+    async def run(name, buy) -> bool:
+        db = server.db
+        catalog = await server.shop_catalog.ensure()
+        items = catalog.items[: args.items]
+        budget = sum(int(it.get("price", 0)) for it in items) // 2   # dá para metade
+        uid = f"bench-{uuid.uuid4()}"
+        await db.users.insert_one({"id": uid, "name": "bench", "coins": budget, "level": 999, "items_owned": []})
+        try:
+            async def attempt(it) -> bool:
+                try:
+                    return await buy(db, uid, it)
+                except HTTPException:
+                    return False
+
+            tasks = [attempt(it) for it in items for _ in range(args.repeat)]
+            t0 = time.perf_counter()
+            ok = sum(await asyncio.gather(*tasks))
+            dt = time.perf_counter() - t0
+            user = await db.users.find_one({"id": uid}, {"_id": 0, "coins": 1, "items_owned": 1})
+        finally:
+            await db.users.delete_one({"id": uid})
+
+        owned = user.get("items_owned") or []
+        spent = sum(int(it.get("price", 0)) for it in items if it["id"] in owned)
+        problems = []
+        if user["coins"] < 0:
+            problems.append(f"saldo negativo ({user['coins']})")
+        if len(owned) != len(set(owned)):
+            problems.append(f"{len(owned) - len(set(owned))} itens duplicados")
+        if ok != len(owned) or user["coins"] != budget - spent:
+            problems.append(f"{ok} compras aceitas para {len(set(owned))} itens, saldo {user['coins']} (esperado {budget - spent})")
+        print(f"{name:<8} {len(tasks):>6} tentativas em {dt * 1000:>7.1f} ms  ->  "
+              + ("OK" if not problems else "; ".join(problems)))
+        return not problems
+
+    async def atomic(db, uid, item) -> bool:
+        await server.buy_item(uid, item)
+        return True
+
+    async def main():
+        print(f"{args.items} itens x {args.repeat} compras concorrentes cada, saldo para ~metade")
+        results = [await run("antes", _legacy_buy)] if args.legacy else []
+        results.append(await run("atômica", atomic))
+        if not results[-1]:
+            raise SystemExit(1)
+
+    asyncio.run(main())
+
+
+def _mock_mongo(rtt_ms: float):
+    """
+    Troca o Motor por mongomock-motor antes de importar o server. Cada chamada de coleção paga
+    `rtt_ms` (asyncio.sleep, então chamadas em gather se sobrepõem como na rede); cursores
+    pagam uma vez, no primeiro lote. Não mede o servidor, só o número de idas em série.
+    """
+    import os
+    import inspect
+
+    try:
+        import mongomock_motor as mmm
+    except ImportError:
+        raise SystemExit("--mock-rtt precisa de mongomock-motor (pip install mongomock-motor)")
+    import motor.motor_asyncio
+
+    delay = rtt_ms / 1000
+
+    def slow(fn):
+        async def wrapper(self, *args, **kwargs):
+            await asyncio.sleep(delay)
+            return await fn(self, *args, **kwargs)
+        return wrapper
+
+    def slow_once(fn):
+        async def wrapper(self, *args, **kwargs):
+            if not self.__dict__.get("_rtt_paid"):
+                self.__dict__["_rtt_paid"] = True
+                await asyncio.sleep(delay)
+            return await fn(self, *args, **kwargs)
+        return wrapper
+
+    coll = mmm.AsyncMongoMockCollection   # subclasse "máscara": os métodos estão na base (dir, não vars)
+    for name in dir(coll):
+        fn = getattr(coll, name)
+        if not name.startswith("_") and inspect.iscoroutinefunction(fn):
+            setattr(coll, name, slow(fn))
+    for cursor in (mmm.AsyncCursor, mmm.AsyncCommandCursor, mmm.AsyncLatentCommandCursor):
+        cursor.to_list = slow_once(cursor.to_list)
+        cursor.next = cursor.__anext__ = slow_once(cursor.next)
+
+    motor.motor_asyncio.AsyncIOMotorClient = lambda *a, **k: mmm.AsyncMongoMockClient(tz_aware=k.get("tz_aware", False))
+    os.environ.setdefault("MONGO_URL", "mongodb://mock")
+    os.environ.setdefault("DB_NAME", "bench")
+
+
+async def _legacy_end(server, user_id: str, input) -> dict:
+    # fluxo anterior do /study/end: cada ida ao Mongo esperava a anterior; agenda e quests inline
+    from datetime import datetime, timedelta, timezone
+
+    db = server.db
+    session = await db.study_sessions.find_one({"id": input.session_id, "user_id": user_id})
+    duration = max(0, int(input.duration))
+    block_minutes = await server._get_user_settings_minutes(user_id)
+    week_before = await server._week_minutes_accumulated(user_id)
+    streak_days = await server._update_and_get_streak(user_id, duration if not input.skipped else 0)
+    mults = (
+        server._completion_multiplier(duration, block_minutes, input.skipped),
+        server._fatigue_multiplier(duration),
+        server._streak_multiplier(streak_days),
+    )
+    coins = server._apply_mults(server._coins_raw(duration), *mults, server._softcap_multiplier(week_before))
+    xp = server._apply_mults(server._session_xp_raw(duration, block_minutes), *mults)
+    await db.study_sessions.update_one({"id": input.session_id}, {"$set": {
+        "end_time": datetime.now(timezone.utc), "duration": duration, "completed": not input.skipped,
+        "skipped": input.skipped, "coins_earned": int(coins), "xp_earned": int(xp)}})
+    await db.users.update_one({"id": user_id}, {"$unset": {"active_session": ""}})
+    subject_id = session.get("subject_id")
+    st = server._to_aware(session.get("start_time"))
+    await server._try_autocomplete_events(user_id, subject_id, st, st + timedelta(minutes=duration))
+    await db.subjects.update_one({"id": subject_id, "user_id": user_id},
+                                 {"$inc": {"time_spent": duration, "sessions_count": 1}})
+    if coins or xp:
+        await server.ledger.record(user_id, coins=int(coins), xp=int(xp), reason="study_session",
+                                   ref=input.session_id, key=f"session:{input.session_id}")
+    await server.update_weekly_quests_after_study(user_id=user_id, subject_id=subject_id,
+                                                  duration=duration, completed=not input.skipped)
+    return {"coins_earned": int(coins), "xp_earned": int(xp)}
+
+
+def bench_end_session(args):
+    import statistics
+    import uuid
+    from datetime import datetime, timedelta, timezone
+
+    if args.mock_rtt is not None:
+        _mock_mongo(args.mock_rtt)
+    import server
+
+    async def seed(uid: str):
+        db = server.db
+        now = datetime.now(timezone.utc)
+        subjects = [{"id": f"{uid}-s{i}", "user_id": uid, "name": f"m{i}", "time_goal": 300,
+                     "time_spent": 0, "sessions_count": 0} for i in range(6)]
+        await db.users.insert_one({"id": uid, "name": "bench", "coins": 0, "xp": 0, "level": 1})
+        await db.user_settings.insert_one({"user_id": uid, "study_duration": 50})
+        await db.subjects.insert_many(subjects)
+        # histórico da semana + eventos de agenda em volta de agora (autocompletar tem trabalho)
+        await db.study_sessions.insert_many([{
+            "id": str(uuid.uuid4()), "user_id": uid, "subject_id": subjects[i % 6]["id"],
+            "start_time": now - timedelta(hours=i * 3 + 2), "end_time": now - timedelta(hours=i * 3 + 1),
+            "duration": 60, "completed": True, "skipped": False,
+        } for i in range(args.history)])
+        await db.calendar_events.insert_many([{
+            "id": str(uuid.uuid4()), "user_id": uid, "subject_id": subjects[i % 6]["id"],
+            "start": now - timedelta(minutes=30 * i), "end": now - timedelta(minutes=30 * i - 60),
+            "completed": False,
+        } for i in range(args.events)])
+        await server.get_current_week_quests(uid)
+        return subjects
+
+    async def cleanup(uid: str):
+        db = server.db
+        for col in ("users", "user_settings", "subjects", "study_sessions", "calendar_events",
+                    "weekly_quests", "ledger"):
+            await db[col].delete_many({"user_id": uid} if col != "users" else {"id": uid})
+        await db.jobs.delete_many({"payload.user_id": uid})
+
+    async def run(name, end) -> list[float]:
+        uid = f"bench-{uuid.uuid4()}"
+        subjects = await seed(uid)
+        lat = []
+        try:
+            for i in range(args.sessions):
+                sid = str(uuid.uuid4())
+                start = datetime.now(timezone.utc) - timedelta(minutes=50)
+                await server.db.study_sessions.insert_one({
+                    "id": sid, "user_id": uid, "subject_id": subjects[i % 6]["id"],
+                    "start_time": start, "end_time": None, "duration": 0, "completed": False,
+                })
+                payload = server.StudySessionEnd(session_id=sid, duration=50, skipped=False)
+                t0 = time.perf_counter()
+                await end(uid, payload)
+                lat.append((time.perf_counter() - t0) * 1000)
+        finally:
+            await cleanup(uid)
+        lat.sort()
+        p50 = statistics.median(lat)
+        p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))]
+        print(f"{name:<10} {len(lat):>6} {p50:>9.2f} {p99:>9.2f}")
+        return [p50, p99]
+
+    async def inline_jobs(uid, inp):
+        # mesmo trabalho do fluxo antigo: agenda e quests rodam antes de responder
+        server.jobs.inline = True
+        try:
+            return await server.complete_study_session(uid, inp)
+        finally:
+            server.jobs.inline = False
+
+    async def main():
+        where = f"Mongo em memória, {args.mock_rtt:g} ms por ida" if args.mock_rtt is not None else "Mongo do .env"
+        print(f"{args.sessions} sessões encerradas em série; {args.history} sessões e {args.events} eventos de histórico; {where}")
+        print(f"{'fluxo':<10} {'n':>6} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        if args.legacy:
+            before = await run("sequencial", lambda uid, inp: _legacy_end(server, uid, inp))
+        after = await run("gather", inline_jobs)
+        if args.legacy:
+            print(f"redução (mesmo trabalho): p50 {1 - after[0] / before[0]:.0%}, p99 {1 - after[1] / before[1]:.0%}")
+        # resposta real do /study/end: agenda e quests só enfileiradas (jobs.py), rodam depois
+        await run("fila", server.complete_study_session)
+
+    asyncio.run(main())
+
+
+def bench_levels(args):
+    import random
+    import leveling
+
+    def legacy_level_up(xp: int, level: int) -> tuple[int, int]:
+        # laço anterior: recalcula 1.25 ** (level-1) a cada nível
+        need = int(100 * (1.25 ** (level - 1)) + 0.999)
+        while xp >= need:
+            xp -= need
+            level += 1
+            need = int(100 * (1.25 ** (level - 1)) + 0.999)
+        return xp, level
+
+    rng = random.Random(1)
+    totals = [rng.randint(0, leveling.CUMULATIVE[args.max_level - 1]) for _ in range(args.users)]
+    print(f"{args.users} usuários, XP total até o nível {args.max_level}")
+    print(f"{'impl':<8} {'tempo (ms)':>11} {'por usuário (µs)':>17}")
+
+    def report(name, fn):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t0
+        print(f"{name:<8} {dt * 1000:>11.1f} {dt / args.users * 1e6:>17.3f}")
+        return out
+
+    a = report("laço", lambda: [legacy_level_up(t, 1) for t in totals])
+    b = report("bisect", lambda: [leveling.split_total(t) for t in totals])
+    if leveling.np is not None:
+        xs, ls = report("numpy", lambda: leveling.levels_for_totals(totals))
+        c = list(zip(xs.tolist(), ls.tolist()))
+    else:
+        c = b
+    if not (a == b == c):
+        raise SystemExit("resultados divergentes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("ratelimit", help="memória do limiter com IPs rotativos")
+    p.add_argument("--ips", type=int, default=100_000)
+    p.add_argument("--hits", type=int, default=2)
+    p.add_argument("--windows", type=int, default=5)
+    p.set_defaults(func=bench_ratelimit)
+
+    p = sub.add_parser("middleware", help="req/s em GET /api/ com os guards antigos vs o pipeline ASGI")
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--rounds", type=int, default=3)
+    p.set_defaults(func=bench_middleware)
+
+    p = sub.add_parser("json", help="serialização de payloads da API: jsonable_encoder+json vs FastJSONResponse")
+    p.add_argument("--iterations", type=int, default=500)
+    p.set_defaults(func=bench_json)
+
+    p = sub.add_parser("purchase", help="compras concorrentes do mesmo usuário: sem gasto duplo")
+    p.add_argument("--items", type=int, default=20)
+    p.add_argument("--repeat", type=int, default=10)
+    p.add_argument("--legacy", action="store_true", help="roda também o fluxo antigo para comparação")
+    p.set_defaults(func=bench_purchase)
+
+    p = sub.add_parser("end-session", help="latência do encerramento de sessão (p50/p99)")
+    p.add_argument("--sessions", type=int, default=200)
+    p.add_argument("--history", type=int, default=40, help="sessões já concluídas na semana")
+    p.add_argument("--events", type=int, default=4, help="eventos de agenda perto da sessão")
+    p.add_argument("--legacy", action="store_true", help="roda também o fluxo sequencial antigo")
+    p.add_argument("--mock-rtt", type=float, default=None, metavar="MS",
+                   help="Mongo em memória (mongomock-motor) com MS por ida, em vez do .env")
+    p.set_defaults(func=bench_end_session)
+
+    p = sub.add_parser("levels", help="nível a partir do XP total: laço vs bisect vs numpy")
+    p.add_argument("--users", type=int, default=200_000)
+    p.add_argument("--max-level", type=int, default=60)
+    p.set_defaults(func=bench_levels)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
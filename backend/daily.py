@@ -0,0 +1,53 @@
+"""
+Série diária de minutos estudados, um doc por usuário e ano (db.user_daily_minutes).
+
+`minutes` é um array fixo de 366 inteiros: índice = dia do ano - 1, pelo start_time (UTC) da
+sessão concluída, mesmo critério dos rollups semanais. Em ano não bissexto o último fica 0.
+O /study/end soma com $inc em minutes.<i>; o backfill reconstrói do histórico agrupando
+todas as sessões do usuário de uma vez com numpy (bucket_minutes).
+"""
+from __future__ import annotations
+
+import calendar
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depende do ambiente
+    np = None
+
+DAYS = 366
+
+
+def days_in_year(year: int) -> int:
+    return 366 if calendar.isleap(year) else 365
+
+
+def day_index(dt: datetime) -> tuple[int, int]:
+    """(ano, índice do dia no array) de um instante."""
+    dt = dt.astimezone(timezone.utc)
+    return dt.year, dt.timetuple().tm_yday - 1
+
+
+def bucket_minutes(starts: list[datetime], minutes: list[int]) -> dict[int, list[int]]:
+    """Soma minutos por dia: ano -> array de 366. Vetorizado (bincount) quando há numpy."""
+    if not starts:
+        return {}
+    if np is None:
+        out: dict[int, list[int]] = {}
+        for st, m in zip(starts, minutes):
+            year, i = day_index(st)
+            out.setdefault(year, [0] * DAYS)[i] += int(m)
+        return out
+
+    days = np.array([st.astimezone(timezone.utc).replace(tzinfo=None) for st in starts], dtype="datetime64[D]")
+    years = days.astype("datetime64[Y]")
+    doy = (days - years).astype(np.int64)
+    year_num = years.astype(np.int64) + 1970
+    first = int(year_num.min())
+    slot = (year_num - first) * DAYS + doy
+    n_years = int(year_num.max()) - first + 1
+    totals = np.bincount(slot, weights=np.asarray(minutes, dtype=np.int64), minlength=n_years * DAYS)
+    grid = totals.astype(np.int64).reshape(n_years, DAYS)
+    present = np.unique(year_num - first)
+    return {first + int(y): grid[y].tolist() for y in present}
@@ -0,0 +1,187 @@
+"""
+Middleware ASGI único com as proteções HTTP da API.
+
+Substitui os quatro @app.middleware("http") (csrf_guard, rate_limit, body_size_guard,
+security_headers): cada BaseHTTPMiddleware criava task e copiava o stream da resposta.
+Aqui tudo roda numa passada só, e os headers/respostas fixos são bytes pré-codificados.
+Ordem: tamanho do corpo (413) -> rate limit (429) -> CSRF (403); headers de segurança
+entram em toda resposta, inclusive nas recusas.
+
+O limite de corpo não confia só no Content-Length: o receive é embrulhado e conta os bytes
+conforme chegam (chunked ou não), cortando com 413 assim que passa do teto, antes de o
+handler acumular o corpo inteiro. O corpo inteiro tem prazo (body_read_timeout, contado da
+primeira leitura), para um cliente que pinga poucos bytes por vez não segurar o worker
+indefinidamente (408).
+"""
+from __future__ import annotations
+
+import asyncio
+import secrets
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.requests import cookie_parser
+
+UNSAFE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+BODY_METHODS = frozenset({"POST", "PUT", "PATCH"})
+
+# CSP: API-first (JSON). Permite connect 'self' e silencia fontes do Google quando o browser renderiza.
+CONTENT_SECURITY_POLICY = (
+    "default-src 'none'; "
+    "connect-src 'self'; "
+    "img-src 'self' data:; "
+    "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; "
+    "font-src 'self' data: https://fonts.gstatic.com; "
+    "frame-ancestors 'none'; base-uri 'none';"
+)
+
+SECURITY_HEADERS: list[tuple[bytes, bytes]] = [
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"referrer-policy", b"same-origin"),
+    (b"permissions-policy", b"camera=(), microphone=(), geolocation=()"),
+    (b"content-security-policy", CONTENT_SECURITY_POLICY.encode("latin-1")),
+]
+_SECURITY_HEADER_NAMES = frozenset(name for name, _ in SECURITY_HEADERS)
+
+
+def _reject_message(status: int, detail: str) -> tuple[dict, dict]:
+    body = b'{"detail":"%s"}' % detail.encode()
+    start = {
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *SECURITY_HEADERS,
+        ],
+    }
+    return start, {"type": "http.response.body", "body": body}
+
+
+_TOO_LARGE = _reject_message(413, "Payload too large")
+_TOO_MANY = _reject_message(429, "Too many requests")
+_CSRF_FAILED = _reject_message(403, "CSRF check failed")
+
+
+_TIMEOUT = _reject_message(408, "Request body timeout")
+
+
+# HTTPException: o FastAPI repropaga (em vez de virar 400 "error parsing the body") e o
+# ExceptionMiddleware transforma em resposta JSON normal.
+class BodyTooLarge(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=413, detail="Payload too large")
+
+
+class BodyTimeout(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=408, detail="Request body timeout")
+
+
+def _capped_receive(receive, limit: int, timeout: float | None):
+    """
+    Embrulha o receive contando bytes; passa do teto -> BodyTooLarge (nada além é lido).
+    `timeout` vale para o corpo todo: o prazo é fixado na primeira leitura e cada receive
+    só espera o que sobra dele (senão um byte por vez, logo antes do prazo, nunca acaba).
+    """
+    seen = 0
+    done = False
+    deadline: float | None = None
+
+    async def wrapped():
+        nonlocal seen, done, deadline
+        if done:
+            # corpo já lido: o próximo receive só retorna no disconnect, sem prazo
+            return await receive()
+        remaining = None
+        if timeout is not None:
+            now = asyncio.get_running_loop().time()
+            if deadline is None:
+                deadline = now + timeout
+            remaining = deadline - now
+            if remaining <= 0:
+                raise BodyTimeout()
+        try:
+            message = await asyncio.wait_for(receive(), remaining)
+        except asyncio.TimeoutError:
+            raise BodyTimeout() from None
+        if message["type"] == "http.request":
+            done = not message.get("more_body", False)
+            seen += len(message.get("body", b""))
+            if seen > limit:
+                raise BodyTooLarge()
+        return message
+
+    return wrapped
+
+
+class SecurityPipeline:
+    def __init__(self, app, *, limiter, limits_by_method: dict[str, int], default_limit: int,
+                 rate_exempt_paths, csrf_exempt_paths, max_body_bytes: int,
+                 body_read_timeout: float | None = 15.0):
+        self.app = app
+        self.limiter = limiter
+        self.limits_by_method = limits_by_method
+        self.default_limit = default_limit
+        self.rate_exempt_paths = frozenset(rate_exempt_paths)
+        self.csrf_exempt_paths = frozenset(csrf_exempt_paths)
+        self.max_body_bytes = max_body_bytes
+        self.body_read_timeout = body_read_timeout
+
+    @staticmethod
+    async def _reject(send, message: tuple[dict, dict]):
+        start, body = message
+        await send(start)
+        await send(body)
+
+    def _csrf_ok(self, headers: Headers) -> bool:
+        # Isenta se vier Authorization (útil em dev cross-origin)
+        if headers.get("authorization", "").startswith("Bearer "):
+            return True
+        # Verificação CSRF padrão (header vs cookie)
+        header = headers.get("x-csrf-token")
+        cookie = cookie_parser(headers.get("cookie", "")).get("csrf_token")
+        return bool(header and cookie and secrets.compare_digest(header, cookie))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        path = scope["path"]
+        headers = Headers(scope=scope)
+
+        if method in BODY_METHODS:
+            cl = headers.get("content-length")
+            if cl and cl.isdigit() and int(cl) > self.max_body_bytes:
+                return await self._reject(send, _TOO_LARGE)
+
+        if path not in self.rate_exempt_paths:
+            client = scope.get("client")
+            ip = client[0] if client else "unknown"
+            limit = self.limits_by_method.get(method, self.default_limit)
+            if not await self.limiter.hit((ip, method), limit):  # por IP+método (não por path)
+                return await self._reject(send, _TOO_MANY)
+
+        if method in UNSAFE_METHODS and path not in self.csrf_exempt_paths and not self._csrf_ok(headers):
+            return await self._reject(send, _CSRF_FAILED)
+
+        started = False
+
+        async def send_with_headers(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                raw = [h for h in message.get("headers", []) if h[0].lower() not in _SECURITY_HEADER_NAMES]
+                message["headers"] = raw + SECURITY_HEADERS
+            await send(message)
+
+        if method in BODY_METHODS:
+            receive = _capped_receive(receive, self.max_body_bytes, self.body_read_timeout)
+        try:
+            await self.app(scope, receive, send_with_headers)
+        except (BodyTooLarge, BodyTimeout) as e:
+            # só chega aqui se nada dentro do app tratou (ex.: corpo lido por outro middleware)
+            if not started:
+                await self._reject(send, _TOO_LARGE if e.status_code == 413 else _TIMEOUT)
@@ -0,0 +1,195 @@
+"""
+Registro declarativo dos índices do Mongo.
+
+REGISTRY lista todos os índices que o app espera, por coleção. apply_indexes() cria os que
+faltam (coleções em paralelo) e devolve um relatório com o que ainda falta, o que sobra
+(existe no banco mas não está no registro) e o que diverge (mesmas chaves, opções diferentes).
+Índices sobrando ou divergentes só são reportados; remoção é explícita via OBSOLETE.
+
+Startup: INDEX_STARTUP_MODE no server.py. Coleções grandes: `python manage.py indexes apply`.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from pymongo import IndexModel
+
+logger = logging.getLogger(__name__)
+
+# opções que fazem dois índices com as mesmas chaves serem diferentes
+_COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+class Index:
+    def __init__(self, collection: str, keys, **options):
+        if isinstance(keys, str):
+            keys = [keys]
+        self.collection = collection
+        self.keys = [(k, 1) if isinstance(k, str) else (k[0], k[1]) for k in keys]
+        self.options = options
+
+    @property
+    def name(self) -> str:
+        return self.options.get("name") or "_".join(f"{k}_{d}" for k, d in self.keys)
+
+    def model(self) -> IndexModel:
+        return IndexModel(self.keys, **self.options)
+
+    def matches_keys(self, info: dict) -> bool:
+        if info.get("name") == self.name:
+            return True
+        key = [(k, int(v) if isinstance(v, (int, float)) else v) for k, v in info["key"].items()]
+        return key == self.keys
+
+    def differs(self, info: dict) -> list[str]:
+        out = []
+        for opt in _COMPARED_OPTIONS:
+            want, have = self.options.get(opt), info.get(opt)
+            if opt in ("unique", "sparse"):
+                want, have = bool(want), bool(have)
+            elif isinstance(have, float) and want is not None:
+                have = type(want)(have)
+            if want != have:
+                out.append(f"{opt}: {have!r} != {want!r}")
+        return out
+
+
+TEXT = "text"
+
+REGISTRY: list[Index] = [
+    # usuários e perfil
+    Index("users", "id", unique=True),
+    Index("users", "active_session.expires_at", sparse=True),   # reaper de sessões abandonadas
+    Index("user_settings", "user_id"),
+    Index("user_bonus", "user_id"),
+    # sessões de estudo (somas por semana, matéria, rankings)
+    Index("study_sessions", "id", unique=True),
+    Index("study_sessions", ["user_id", "completed", "start_time"]),
+    Index("study_sessions", ["user_id", "completed", "subject_id", "start_time"]),
+    # rollups semanais (somas O(1) e rankings de dia/semana)
+    Index("user_week_rollups", ["user_id", "week_id"], unique=True),
+    Index("user_week_rollups", [("week_id", 1), ("minutes", -1)]),
+    # série diária (heatmap)
+    Index("user_daily_minutes", ["user_id", "year"], unique=True),
+    # agenda
+    Index("calendar_events", "id", unique=True),
+    Index("calendar_events", ["user_id", "start", "end"]),
+    # matérias / tarefas / quests
+    Index("subjects", ["user_id", "id"]),
+    Index("subjects", "id"),
+    Index("tasks", ["user_id", "subject_id"]),
+    Index("tasks", "id"),
+    Index("weekly_quests", ["user_id", "week_id"]),
+    Index("weekly_quests", [("user_id", 1), ("created_at", -1)]),
+    # amizades
+    Index("friends", "user_id"),
+    Index("friends", "friend_id"),
+    Index("friend_requests", "id"),
+    Index("friend_requests", ["to_id", "status"]),
+    Index("friend_requests", ["from_id", "status"]),
+    # grupos
+    Index("groups", "invite_code", unique=True),
+    Index("groups", [("name", TEXT), ("description", TEXT)]),
+    Index("group_members", ["group_id", "user_id"], unique=True),
+    Index("group_members", "user_id"),
+    # sessões de login / oauth
+    Index("sessions", "id", unique=True),
+    Index("sessions", "user_id"),
+    Index("sessions", "expires_at", expireAfterSeconds=0),
+    Index("sessions", "revoked_at", sparse=True),   # poll de revogação entre workers
+    Index("oauth_states", "state", unique=True),
+    Index("oauth_states", "expires_at", expireAfterSeconds=0),
+    # fila de jobs: elegíveis por (status, run_at); concluídos somem depois de 7 dias
+    # (só os "done": os "failed" ficam até alguém olhar / retry-failed)
+    Index("jobs", "id", unique=True),
+    Index("jobs", ["status", "run_at"]),
+    Index("jobs", "key", unique=True, partialFilterExpression={"key": {"$type": "string"}}),
+    Index("jobs", "finished_at", name="finished_at_done_ttl", expireAfterSeconds=7 * 24 * 3600,
+          partialFilterExpression={"status": "done"}),
+    # ledger de coins/XP
+    Index("ledger", "id", unique=True),
+    Index("ledger", ["user_id", "created_at"]),
+    Index("ledger", ["applied", "batch", "created_at"]),
+    Index("ledger", "key", unique=True, partialFilterExpression={"key": {"$type": "string"}}),
+]
+
+# (coleção, nome) removidos quando existirem
+OBSOLETE: list[tuple[str, str]] = [
+    ("groups", "id_1"),   # único em "id" (errado: id é materializado depois do insert)
+    ("jobs", "finished_at_1"),   # TTL sem filtro: apagava também os jobs "failed"
+]
+
+
+def _by_collection(registry, only=None) -> dict[str, list[Index]]:
+    out: dict[str, list[Index]] = {}
+    for ix in registry:
+        if only is None or ix.collection in only:
+            out.setdefault(ix.collection, []).append(ix)
+    return out
+
+
+async def _inspect(db, name: str, wanted: list[Index]) -> dict:
+    existing = [i async for i in db[name].list_indexes() if i["name"] != "_id_"]
+    missing, divergent, seen = [], [], set()
+    for ix in wanted:
+        info = next((i for i in existing if ix.matches_keys(i)), None)
+        if info is None:
+            missing.append(ix)
+            continue
+        seen.add(info["name"])
+        diff = ix.differs(info)
+        if diff:
+            divergent.append(f"{info['name']} ({'; '.join(diff)})")
+    extra = [i["name"] for i in existing if i["name"] not in seen]
+    return {"missing": missing, "extra": extra, "divergent": divergent}
+
+
+async def _apply_collection(db, name: str, wanted: list[Index], obsolete, create: bool) -> dict:
+    col = db[name]
+    for coll, ix_name in obsolete:
+        if coll == name:
+            try:
+                await col.drop_index(ix_name)
+            except Exception:
+                pass
+    state = await _inspect(db, name, wanted)
+    errors = []
+    if create and state["missing"]:
+        t0 = time.monotonic()
+        # um create_index por índice: dados antigos que violam um unique não barram os demais
+        for ix in state["missing"]:
+            try:
+                await col.create_indexes([ix.model()])
+            except Exception as e:
+                errors.append(f"{ix.name}: {e}")
+        state = await _inspect(db, name, wanted)
+        state["seconds"] = round(time.monotonic() - t0, 2)
+    state["missing"] = [ix.name for ix in state["missing"]]
+    state["errors"] = errors
+    return state
+
+
+async def apply_indexes(db, registry=REGISTRY, *, only=None, create: bool = True,
+                        obsolete=OBSOLETE) -> dict[str, dict]:
+    """Cria os índices que faltam (create=False só confere). Coleções em paralelo."""
+    groups = _by_collection(registry, only)
+    names = list(groups)
+    results = await asyncio.gather(
+        *(_apply_collection(db, n, groups[n], obsolete if create else [], create) for n in names),
+        return_exceptions=True,
+    )
+    report = {}
+    for name, res in zip(names, results):
+        if isinstance(res, Exception):
+            res = {"missing": [ix.name for ix in groups[name]], "extra": [], "divergent": [], "errors": [str(res)]}
+        report[name] = res
+    return report
+
+
+def log_report(report: dict[str, dict]):
+    for name, r in report.items():
+        for kind in ("missing", "extra", "divergent", "errors"):
+            if r.get(kind):
+                logger.warning(f"indexes {name} {kind}: {', '.join(r[kind])}")
@@ -0,0 +1,203 @@
+"""
+Fila de jobs em Mongo (db.jobs) para efeitos colaterais que podem rodar depois da resposta.
+
+Semântica at-least-once: um job pode rodar mais de uma vez (worker caiu no meio, lease venceu),
+então handlers têm que ser idempotentes.
+
+- enqueue(name, payload, key=...) grava um doc pendente; `key` (único) evita enfileirar duas vezes.
+- O worker reivindica com find_one_and_update: status "running" e run_at = fim do lease. Um doc
+  "running" com run_at vencido volta a ser elegível, então o mesmo índice (status, run_at)
+  serve para os pendentes e para os leases abandonados.
+- Falha -> volta para "pending" com backoff exponencial; depois de max_attempts fica "failed"
+  (`python manage.py jobs retry-failed` recoloca na fila).
+- Até `concurrency` jobs por processo ao mesmo tempo (semáforo).
+- inline=True (JOBS_MODE=inline): enqueue executa na hora, sem Mongo; para testes/dev.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class JobQueue:
+    def __init__(self, collection, *, concurrency: int = 4, lease_secs: float = 60.0,
+                 max_attempts: int = 5, backoff_secs: float = 5.0, poll_secs: float = 1.0,
+                 inline: bool = False):
+        self.collection = collection
+        self.concurrency = concurrency
+        self.lease_secs = lease_secs
+        self.max_attempts = max_attempts
+        self.backoff_secs = backoff_secs
+        self.poll_secs = poll_secs
+        self.inline = inline
+        self.worker_id = uuid.uuid4().hex
+        self.handlers: dict[str, Handler] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+
+    def handler(self, name: str):
+        def register(fn: Handler) -> Handler:
+            self.handlers[name] = fn
+            return fn
+        return register
+
+    async def enqueue(self, name: str, payload: dict, *, key: str | None = None,
+                      delay: float = 0.0) -> bool:
+        """Enfileira; False se `key` já estava na fila (ou já rodou)."""
+        if name not in self.handlers:
+            raise KeyError(f"job sem handler: {name}")
+        if self.inline:
+            await self._run_inline(name, payload)
+            return True
+        now = datetime.now(timezone.utc)
+        doc = {
+            "id": str(uuid.uuid4()), "name": name, "payload": payload, "status": "pending",
+            "attempts": 0, "run_at": now + timedelta(seconds=delay), "created_at": now,
+        }
+        if key:
+            doc["key"] = key
+        try:
+            await self.collection.insert_one(doc)
+        except DuplicateKeyError:
+            return False
+        if delay <= 0:
+            self._wake.set()
+        return True
+
+    async def _run_inline(self, name: str, payload: dict):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self.handlers[name](**payload)
+                return
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logger.warning(f"job {name} failed after {attempt} attempts: {e}")
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.backoff_secs * (2 ** (attempts - 1)), 3600.0)
+
+    async def _claim(self) -> dict | None:
+        now = datetime.now(timezone.utc)
+        # devolve o doc de antes do update: attempts ainda sem o +1 desta tentativa
+        job = await self.collection.find_one_and_update(
+            {"status": {"$in": ["pending", "running"]}, "run_at": {"$lte": now}},
+            {
+                "$set": {"status": "running", "run_at": now + timedelta(seconds=self.lease_secs),
+                         "worker": self.worker_id, "started_at": now},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", 1)],
+        )
+        if job is not None:
+            job["attempts"] = int(job.get("attempts") or 0) + 1
+        return job
+
+    async def _execute(self, job: dict):
+        # só quem ainda detém o lease (worker + tentativa) fecha o job
+        mine = {"id": job["id"], "worker": self.worker_id, "attempts": job["attempts"]}
+        now = datetime.now(timezone.utc)
+        handler = self.handlers.get(job["name"])
+        try:
+            if handler is None:
+                raise KeyError(f"job sem handler: {job['name']}")
+            await handler(**(job.get("payload") or {}))
+        except Exception as e:
+            failed = job["attempts"] >= self.max_attempts
+            if failed:
+                logger.warning(f"job {job['name']} {job['id']} failed after {job['attempts']} attempts: {e}")
+            update = {"status": "failed", "finished_at": now} if failed else {
+                "status": "pending", "run_at": now + timedelta(seconds=self._backoff(job["attempts"]))}
+            await self.collection.update_one(mine, {"$set": {**update, "last_error": str(e)[:500]}})
+            return
+        await self.collection.update_one(mine, {"$set": {"status": "done", "finished_at": now}})
+
+    async def run_pending(self, limit: int | None = None) -> int:
+        """Roda os jobs vencidos até a fila esvaziar (ou `limit`), respeitando `concurrency`."""
+        done = 0
+        while limit is None or done < limit:
+            batch = []
+            for _ in range(self.concurrency if limit is None else min(self.concurrency, limit - done)):
+                job = await self._claim()
+                if job is None:
+                    break
+                batch.append(job)
+            if not batch:
+                break
+            await asyncio.gather(*(self._execute(j) for j in batch))
+            done += len(batch)
+        return done
+
+    async def _spawn(self, job: dict):
+        try:
+            await self._execute(job)
+        except Exception as e:  # falha ao gravar o resultado: o lease vence e o job roda de novo
+            logger.warning(f"job {job['name']} {job['id']} warn: {e}")
+        finally:
+            self._slots.release()
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                job = await self._claim()
+            except Exception as e:
+                self._slots.release()
+                logger.warning(f"jobs claim warn: {e}")
+                await asyncio.sleep(self.poll_secs)
+                continue
+            if job is not None:
+                task = asyncio.ensure_future(self._spawn(job))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                continue
+            self._slots.release()
+            # acorda no intervalo ou logo após um enqueue local
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_secs)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def start(self):
+        if self._task is None and not self.inline:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, grace: float = 10.0):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._running:
+            # o que não terminar no prazo fica "running" e volta à fila quando o lease vencer
+            await asyncio.wait(self._running, timeout=grace)
+
+    # --- offline (manage.py) ---
+    async def stats(self) -> dict[str, dict[str, int]]:
+        out: dict[str, dict[str, int]] = {}
+        async for row in self.collection.aggregate([
+            {"$group": {"_id": {"name": "$name", "status": "$status"}, "n": {"$sum": 1}}},
+        ]):
+            out.setdefault(row["_id"]["name"], {})[row["_id"]["status"]] = row["n"]
+        return out
+
+    async def retry_failed(self, name: str | None = None) -> int:
+        q = {"status": "failed", **({"name": name} if name else {})}
+        res = await self.collection.update_many(q, {
+            "$set": {"status": "pending", "attempts": 0, "run_at": datetime.now(timezone.utc)},
+            "$unset": {"finished_at": ""},
+        })
+        return res.modified_count
@@ -0,0 +1,133 @@
+"""
+Curva de XP/nível num lugar só.
+
+O usuário guarda `xp` (XP dentro do nível atual) e `level`. A curva é por nível
+(xp_for_level: 100 * 1.25^(nível-1), arredondado para cima) e a tabela CUMULATIVE guarda,
+já somado, quanto XP total leva para chegar a cada nível. Com ela:
+
+    total_xp(xp, level)      -> CUMULATIVE[level-1] + xp
+    level_up(xp, level)      -> bisect na tabela (sem laço nível a nível)
+    levels_for_totals(arr)   -> mesma coisa vetorizada (numpy.searchsorted), p/ lote
+
+recompute_levels() reaplica a curva à coleção de usuários inteira (ex.: depois de mudar
+XP_BASE/XP_GROWTH): `python manage.py levels recompute --from-base 100 --from-growth 1.25`.
+"""
+from __future__ import annotations
+
+import os
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depende do ambiente
+    np = None
+
+XP_BASE = int(os.getenv("XP_BASE", "100"))
+XP_GROWTH = float(os.getenv("XP_GROWTH", "1.25"))
+# acima disso o XP acumulado passa de int64 (numpy); ninguém chega perto
+MAX_LEVEL = int(os.getenv("XP_MAX_LEVEL", "150"))
+
+
+def _need(level: int, base: int, growth: float) -> int:
+    return int(base * (growth ** (level - 1)) + 0.999)
+
+
+def curve_table(base: int = XP_BASE, growth: float = XP_GROWTH, max_level: int = MAX_LEVEL) -> list[int]:
+    """cum[l-1] = XP total para chegar ao nível l (cum[0] = 0)."""
+    cum = [0]
+    for level in range(1, max_level):
+        cum.append(cum[-1] + _need(level, base, growth))
+    return cum
+
+
+CUMULATIVE: list[int] = curve_table()
+_CUMULATIVE_NP = np.array(CUMULATIVE, dtype=np.int64) if np is not None else None
+
+
+def xp_for_level(level: int) -> int:
+    """XP necessário para sair de `level` para o próximo."""
+    if 1 <= level < MAX_LEVEL:
+        return CUMULATIVE[level] - CUMULATIVE[level - 1]
+    return _need(level, XP_BASE, XP_GROWTH)
+
+
+def total_xp(xp: int, level: int, cum: list[int] = CUMULATIVE) -> int:
+    level = max(1, level)
+    if level <= len(cum):
+        return cum[level - 1] + xp
+    return cum[-1] + sum(_need(l, XP_BASE, XP_GROWTH) for l in range(len(cum), level)) + xp
+
+
+def split_total(total: int, cum: list[int] = CUMULATIVE) -> tuple[int, int]:
+    """XP total -> (xp dentro do nível, nível)."""
+    level = max(1, bisect_right(cum, total))
+    xp = total - cum[level - 1]
+    if level == len(cum):  # passou do fim da tabela: segue nível a nível
+        need = _need(level, XP_BASE, XP_GROWTH)
+        while xp >= need:
+            xp -= need
+            level += 1
+            need = _need(level, XP_BASE, XP_GROWTH)
+    return xp, level
+
+
+def level_up(xp: int, level: int) -> tuple[int, int]:
+    """XP dentro do nível + nível -> normalizado pela curva (sobe quantos níveis couber)."""
+    if xp < xp_for_level(level):  # caso comum (e XP negativo): nada muda
+        return xp, level
+    return split_total(total_xp(xp, level))
+
+
+def levels_for_totals(totals, cum: list[int] | None = None):
+    """Versão vetorizada de split_total: array de XP total -> (arrays xp, nível)."""
+    if np is None:
+        raise RuntimeError("numpy não instalado")
+    table = _CUMULATIVE_NP if cum is None else np.asarray(cum, dtype=np.int64)
+    totals = np.asarray(totals, dtype=np.int64)
+    levels = np.maximum(np.searchsorted(table, totals, side="right"), 1)
+    return totals - table[levels - 1], levels
+
+
+async def recompute_levels(users, old: list[int] | None = None, *, batch: int = 5000,
+                           dry_run: bool = False) -> dict:
+    """
+    Reaplica a curva atual a todos os usuários, preservando o XP total. `old` é a tabela
+    com que xp/level foram gravados (curve_table(base, growth) da curva anterior).
+    Cada lote vira um bulk_write condicionado ao xp/level lido, como no ledger: se o
+    usuário ganhou XP no meio do caminho, o update não casa e ele fica para a próxima rodada.
+    """
+    from pymongo import UpdateOne
+
+    old = CUMULATIVE if old is None else old
+    old_np = np.asarray(old, dtype=np.int64)
+    stats = {"users": 0, "changed": 0, "written": 0}
+
+    async def flush(rows):
+        ids = [r["id"] for r in rows]
+        xp = np.fromiter((int(r.get("xp") or 0) for r in rows), dtype=np.int64, count=len(rows))
+        level = np.fromiter((int(r.get("level") or 1) for r in rows), dtype=np.int64, count=len(rows))
+        level = np.clip(level, 1, len(old_np))
+        new_xp, new_level = levels_for_totals(old_np[level - 1] + xp)
+        changed = np.nonzero((new_xp != xp) | (new_level != level))[0]
+        stats["users"] += len(rows)
+        stats["changed"] += len(changed)
+        if dry_run or not len(changed):
+            return
+        ops = [
+            UpdateOne(
+                {"id": ids[i], "xp": rows[i].get("xp"), "level": rows[i].get("level")},
+                {"$set": {"xp": int(new_xp[i]), "level": int(new_level[i])}},
+            )
+            for i in changed
+        ]
+        stats["written"] += (await users.bulk_write(ops, ordered=False)).modified_count
+
+    rows = []
+    async for u in users.find({}, {"_id": 0, "id": 1, "xp": 1, "level": 1}):
+        rows.append(u)
+        if len(rows) >= batch:
+            await flush(rows)
+            rows = []
+    if rows:
+        await flush(rows)
+    return stats
@@ -0,0 +1,303 @@
+"""
+Tarefas administrativas offline. Rodar de dentro de backend/ (usa MONGO_URL/DB_NAME do .env):
+
+    python manage.py ledger open [--rebase]
+                                           # abertura para contas anteriores ao ledger
+    python manage.py ledger flush          # materializa os lançamentos pendentes
+    python manage.py ledger audit [--fix]  # snapshot dos usuários vs soma do ledger
+    python manage.py migrate-dates [--batch N] [--dry-run]
+                                           # ISO string -> Date em study_sessions/calendar_events
+    python manage.py indexes [check|apply] [--collection C ...]
+                                           # índices do registro (indexes.py) vs banco
+    python manage.py levels recompute [--from-base B] [--from-growth G] [--dry-run]
+                                           # reaplica a curva de XP atual (leveling.py) a todos
+    python manage.py rollups rebuild [--user ID ...] [--force]
+                                           # regera user_week_rollups a partir das sessões
+                                           # (servidores parados: corre contra os $inc ao vivo)
+    python manage.py daily backfill [--user ID ...] [--force]
+                                           # regera user_daily_minutes (heatmap) com numpy
+                                           # (servidores parados, como o rollups rebuild)
+    python manage.py jobs stats|run|retry-failed [--name N]
+                                           # fila de jobs (jobs.py): contagem, drenar, recolocar
+    python manage.py sessions reap [--backfill]
+                                           # fecha active_sessions abandonadas (--backfill: expires_at
+                                           # para as anteriores ao reaper, antes da primeira rodada)
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+
+# coleção -> campos de data que ainda podem estar como ISO string
+DATE_FIELDS = {
+    "study_sessions": ("start_time", "end_time"),
+    "calendar_events": ("start", "end", "created_at"),
+}
+
+
+async def cmd_ledger(args):
+    from indexes import apply_indexes
+    from server import db, ledger
+
+    await apply_indexes(db, only={"ledger"})
+    if args.action == "open":
+        stats = await ledger.open_accounts(rebase=args.rebase)
+        print(f"{stats['opened']} contas abertas, {stats['rebased']} aberturas recalculadas, "
+              f"{stats['busy']} ocupadas (rode de novo)")
+    elif args.action == "flush":
+        await ledger.recover()
+        total = 0
+        while True:
+            n = await ledger.flush()
+            total += n
+            if n < ledger.batch_max:
+                break
+        print(f"{total} lançamentos aplicados")
+    else:
+        report = await ledger.audit(fix=args.fix)
+        busy = [row["user_id"] for row in report if row.get("busy")]
+        report = [row for row in report if not row.get("busy")]
+        for row in report:
+            print(
+                f"{row['user_id']}: coins {row['coins']} (ledger {row['ledger_coins']}), "
+                f"xp total {row['xp_total']} (ledger {row['ledger_xp_total']})"
+            )
+        if args.fix:
+            print(f"{sum(1 for r in report if r.get('fixed'))} de {len(report)} contas divergentes corrigidas")
+        else:
+            print(f"{len(report)} contas divergentes")
+        if busy:
+            print(f"{len(busy)} contas em movimento, não conferidas (rode de novo): {', '.join(busy[:20])}")
+
+
+async def _migrate_collection(db, name: str, fields: tuple[str, ...], state: dict, args) -> tuple[int, int]:
+    """Uma passada por _id crescente a partir do checkpoint. Devolve (convertidos, inválidos)."""
+    from pymongo import UpdateOne
+    from server import DATES_MIGRATION_ID, _to_aware
+
+    col = db[name]
+    last = (state.get("last_id") or {}).get(name)
+    converted = invalid = 0
+    while True:
+        q = {"$or": [{f: {"$type": "string"}} for f in fields]}
+        if last is not None:
+            q["_id"] = {"$gt": last}
+        docs = await col.find(q, {f: 1 for f in fields}).sort("_id", 1).limit(args.batch).to_list(args.batch)
+        if not docs:
+            break
+        ops = []
+        for d in docs:
+            upd = {}
+            for f in fields:
+                if isinstance(d.get(f), str):
+                    dt = _to_aware(d[f])
+                    if dt is None:
+                        invalid += 1
+                    else:
+                        upd[f] = dt
+            if upd:
+                # condicionado ao valor lido: não atropela uma escrita concorrente
+                ops.append(UpdateOne({"_id": d["_id"], **{f: d[f] for f in upd}}, {"$set": upd}))
+        last = docs[-1]["_id"]
+        if args.dry_run:
+            converted += len(ops)
+            continue
+        if ops:
+            converted += (await col.bulk_write(ops, ordered=False)).modified_count
+        await db.migrations.update_one(
+            {"_id": DATES_MIGRATION_ID},
+            {"$set": {f"last_id.{name}": last, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        print(f"  {name}: {converted} convertidos (até _id {last})")
+
+    if not args.dry_run:
+        # passada completa: a próxima recomeça do início (pega o que foi escrito atrás do cursor)
+        await db.migrations.update_one({"_id": DATES_MIGRATION_ID}, {"$unset": {f"last_id.{name}": ""}})
+    return converted, invalid
+
+
+async def cmd_migrate_dates(args):
+    """
+    Idempotente (só toca campos ainda em string) e retomável (checkpoint por coleção em
+    db.migrations). Repete passadas até uma não converter nada; então marca `done`, e os
+    servidores passam a filtrar só por Date no próximo start.
+    """
+    from server import DATES_MIGRATION_ID, db
+
+    while True:
+        state = await db.migrations.find_one({"_id": DATES_MIGRATION_ID}) or {}
+        total = invalid = 0
+        for name, fields in DATE_FIELDS.items():
+            n, bad = await _migrate_collection(db, name, fields, state, args)
+            total += n
+            invalid += bad
+        if args.dry_run:
+            print(f"{total} documentos a converter, {invalid} valores inválidos (ficam como estão)")
+            return
+        if total == 0:
+            break
+
+    await db.migrations.update_one(
+        {"_id": DATES_MIGRATION_ID},
+        {"$set": {"done": True, "finished_at": datetime.now(timezone.utc), "invalid": invalid}},
+        upsert=True,
+    )
+    print(f"migração concluída ({invalid} valores inválidos mantidos como string); reinicie os servidores")
+
+
+async def cmd_indexes(args):
+    """Confere (check) ou cria (apply) os índices do registro, fora do boot do servidor."""
+    from indexes import apply_indexes
+    from server import db
+
+    t0 = time.monotonic()
+    only = set(args.collection) if args.collection else None
+    report = await apply_indexes(db, only=only, create=args.action == "apply")
+    pending = 0
+    for name, r in sorted(report.items()):
+        status = "ok" if not (r["missing"] or r["divergent"] or r["errors"]) else "pendente"
+        took = f" ({r['seconds']}s)" if "seconds" in r else ""
+        print(f"{name}: {status}{took}")
+        for kind in ("missing", "extra", "divergent", "errors"):
+            for item in r[kind]:
+                print(f"  {kind}: {item}")
+        pending += len(r["missing"]) + len(r["divergent"]) + len(r["errors"])
+    print(f"{len(report)} coleções em {time.monotonic() - t0:.2f}s, {pending} pendências")
+    if pending:
+        raise SystemExit(1)
+
+
+async def cmd_levels(args):
+    """Depois de mudar XP_BASE/XP_GROWTH: --from-* é a curva com que os usuários foram gravados."""
+    from leveling import XP_BASE, XP_GROWTH, curve_table, recompute_levels
+    from server import db
+
+    base = XP_BASE if args.from_base is None else args.from_base
+    growth = XP_GROWTH if args.from_growth is None else args.from_growth
+    old = curve_table(base, growth)
+    print(f"curva gravada: base {base}, crescimento {growth}; "
+          f"atual: base {XP_BASE}, crescimento {XP_GROWTH}")
+    t0 = time.monotonic()
+    stats = await recompute_levels(db.users, old, batch=args.batch, dry_run=args.dry_run)
+    verb = "a alterar" if args.dry_run else f"alterados ({stats['written']} gravados)"
+    print(f"{stats['users']} usuários em {time.monotonic() - t0:.2f}s, {stats['changed']} {verb}")
+
+
+async def cmd_rollups(args):
+    """Rebuild completo marca a migração; servidores passam a ler os rollups no próximo start."""
+    from indexes import apply_indexes
+    from server import db, rebuild_week_rollups
+
+    await apply_indexes(db, only={"user_week_rollups"})
+    t0 = time.monotonic()
+    try:
+        stats = await rebuild_week_rollups(args.user or None, force=args.force)
+    except RuntimeError as e:
+        raise SystemExit(f"rebuild recusado: {e}")
+    print(f"{stats['users']} usuários, {stats['weeks']} semanas em {time.monotonic() - t0:.2f}s")
+    if not args.user:
+        print("rollups prontos; reinicie os servidores")
+
+
+async def cmd_daily(args):
+    """Backfill completo marca a migração; o heatmap passa a ler a série no próximo start."""
+    from indexes import apply_indexes
+    from server import backfill_daily_minutes, db
+
+    await apply_indexes(db, only={"user_daily_minutes"})
+    t0 = time.monotonic()
+    try:
+        stats = await backfill_daily_minutes(args.user or None, force=args.force)
+    except RuntimeError as e:
+        raise SystemExit(f"backfill recusado: {e}")
+    print(f"{stats['users']} usuários, {stats['years']} anos em {time.monotonic() - t0:.2f}s")
+    if not args.user:
+        print("série diária pronta; reinicie os servidores")
+
+
+async def cmd_jobs(args):
+    from server import jobs
+
+    if args.action == "stats":
+        for name, counts in sorted((await jobs.stats()).items()):
+            print(f"{name}: " + ", ".join(f"{k} {v}" for k, v in sorted(counts.items())))
+    elif args.action == "run":
+        t0 = time.monotonic()
+        n = await jobs.run_pending()
+        print(f"{n} jobs executados em {time.monotonic() - t0:.2f}s")
+    else:
+        print(f"{await jobs.retry_failed(args.name)} jobs recolocados na fila")
+
+
+async def cmd_sessions(args):
+    from indexes import apply_indexes
+    from server import db, reaper
+
+    await apply_indexes(db, only={"users"})
+    t0 = time.monotonic()
+    if args.backfill:
+        print(f"{await reaper.backfill()} active_sessions com expires_at")
+    stats = await reaper.reap()
+    print(f"{stats['users']} active_sessions limpas, {stats['sessions']} sessões fechadas "
+          f"em {time.monotonic() - t0:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("ledger", help="livro-razão de coins/XP")
+    p.add_argument("action", choices=["open", "flush", "audit"])
+    p.add_argument("--fix", action="store_true", help="audit: regrava o snapshot a partir do ledger")
+    p.add_argument("--rebase", action="store_true", help="open: recalcula aberturas já gravadas")
+    p.set_defaults(func=cmd_ledger)
+
+    p = sub.add_parser("migrate-dates", help="converte datas ISO string para Date (em lotes, retomável)")
+    p.add_argument("--batch", type=int, default=1000)
+    p.add_argument("--dry-run", action="store_true", help="só conta o que seria convertido")
+    p.set_defaults(func=cmd_migrate_dates)
+
+    p = sub.add_parser("indexes", help="confere/cria os índices declarados em indexes.py")
+    p.add_argument("action", nargs="?", choices=["check", "apply"], default="check")
+    p.add_argument("--collection", action="append", help="limita a uma coleção (repetível)")
+    p.set_defaults(func=cmd_indexes)
+
+    p = sub.add_parser("levels", help="recalcula xp/level de todos os usuários em lote (numpy)")
+    p.add_argument("action", choices=["recompute"])
+    p.add_argument("--from-base", type=int, default=None, help="XP_BASE da curva anterior (padrão: atual)")
+    p.add_argument("--from-growth", type=float, default=None, help="XP_GROWTH da curva anterior (padrão: atual)")
+    p.add_argument("--batch", type=int, default=5000)
+    p.add_argument("--dry-run", action="store_true", help="só conta quem mudaria")
+    p.set_defaults(func=cmd_levels)
+
+    p = sub.add_parser("rollups", help="rollups semanais por usuário (user_week_rollups)")
+    p.add_argument("action", choices=["rebuild"])
+    p.add_argument("--user", action="append", help="só estes usuários (repetível); não marca a migração")
+    p.add_argument("--force", action="store_true", help="roda mesmo com sessões encerradas há pouco")
+    p.set_defaults(func=cmd_rollups)
+
+    p = sub.add_parser("daily", help="série diária de minutos por usuário/ano (heatmap)")
+    p.add_argument("action", choices=["backfill"])
+    p.add_argument("--user", action="append", help="só estes usuários (repetível); não marca a migração")
+    p.add_argument("--force", action="store_true", help="roda mesmo com sessões encerradas há pouco")
+    p.set_defaults(func=cmd_daily)
+
+    p = sub.add_parser("jobs", help="fila de jobs pós-sessão")
+    p.add_argument("action", choices=["stats", "run", "retry-failed"])
+    p.add_argument("--name", help="retry-failed: só jobs com este nome")
+    p.set_defaults(func=cmd_jobs)
+
+    p = sub.add_parser("sessions", help="sessões de estudo abertas")
+    p.add_argument("action", choices=["reap"])
+    p.add_argument("--backfill", action="store_true", help="grava expires_at nas active_sessions antigas antes")
+    p.set_defaults(func=cmd_sessions)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
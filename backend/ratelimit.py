@@ -0,0 +1,307 @@
+"""
+Rate limit por janela deslizante aproximada (sliding window counter).
+
+Cada chave guarda só três números (início da janela atual, contagem da janela anterior
+e da atual), então a memória por cliente é fixa e cada hit é O(1). A estimativa é
+prev * (fração da janela anterior ainda dentro dos últimos `window` segundos) + curr.
+Chaves ociosas há mais de duas janelas são removidas numa varredura periódica.
+
+Com vários workers, use um backend compartilhado (Mongo ou servidor RESP) via build_backend().
+"""
+from __future__ import annotations
+
+import abc
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Hashable
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class _Slot:
+    __slots__ = ("start", "prev", "curr")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.prev = 0
+        self.curr = 0
+
+
+class SlidingWindowLimiter:
+    def __init__(self, window: float, sweep_every: float | None = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window = float(window)
+        self.sweep_every = float(sweep_every or window)
+        self.clock = clock
+        self._slots: dict[Hashable, _Slot] = {}
+        self._next_sweep = clock() + self.sweep_every
+
+    def hit(self, key: Hashable, limit: int) -> bool:
+        """Conta um hit para `key`. Devolve False (sem contar) se o limite já foi atingido."""
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot(now)
+        else:
+            elapsed = now - slot.start
+            if elapsed >= self.window:
+                skipped = int(elapsed // self.window)
+                slot.prev = slot.curr if skipped == 1 else 0
+                slot.curr = 0
+                slot.start += skipped * self.window
+
+        weight = 1.0 - (now - slot.start) / self.window
+        if slot.prev * weight + slot.curr >= limit:
+            return False
+        slot.curr += 1
+        return True
+
+    def sweep(self, now: float | None = None) -> int:
+        """Remove chaves sem hits há mais de duas janelas (contagem efetiva já é zero)."""
+        now = self.clock() if now is None else now
+        cutoff = now - 2 * self.window
+        before = len(self._slots)
+        self._slots = {k: s for k, s in self._slots.items() if s.start > cutoff}
+        self._next_sweep = now + self.sweep_every
+        return before - len(self._slots)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+# --------------------------------------------------------------------------------------
+# Backends compartilhados entre workers (uvicorn --workers N)
+#
+# Todos expõem `async hit(key, limit) -> bool`, `setup()` e `close()`. Os compartilhados usam
+# contadores atômicos por janela fixa (índice = wall clock // window) e estimam a janela
+# deslizante com a contagem da janela anterior, lida na mesma ida ao servidor.
+# Ao contrário do local, hits recusados também incrementam o contador (INCR antes de comparar).
+# --------------------------------------------------------------------------------------
+
+
+def _sliding_estimate(prev: int, curr: int, now: float, window: float) -> float:
+    return prev * (1.0 - (now % window) / window) + curr
+
+
+class LocalBackend:
+    """Só o processo atual (default). Sem I/O."""
+
+    def __init__(self, window: float):
+        self.limiter = SlidingWindowLimiter(window)
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def hit(self, key: Hashable, limit: int) -> bool:
+        return self.limiter.hit(key, limit)
+
+
+class _SharedBackend(abc.ABC):
+    """
+    Base dos backends remotos: se o servidor cair, degrada para o limiter local do worker.
+    Subclasse implementa _counts (abstrato: sem ele a classe nem instancia).
+    """
+
+    retry_after = 5.0   # segundos sem tentar o servidor depois de uma falha
+
+    def __init__(self, window: float):
+        self.window = float(window)
+        self.fallback = SlidingWindowLimiter(window)
+        self._down_until = 0.0
+
+    @abc.abstractmethod
+    async def _counts(self, key: str, idx: int) -> tuple[int, int]:
+        """Soma 1 na janela `idx` da chave e devolve (contagem da janela anterior, da atual)."""
+
+    async def hit(self, key: Hashable, limit: int) -> bool:
+        now = time.time()
+        idx = int(now // self.window)
+        if now < self._down_until:
+            return self.fallback.hit(key, limit)
+        skey = "|".join(map(str, key)) if isinstance(key, tuple) else str(key)
+        try:
+            prev, curr = await self._counts(skey, idx)
+        except Exception as e:
+            logger.warning(f"rate limit backend indisponível, usando limiter local: {e}")
+            self._down_until = now + self.retry_after
+            return self.fallback.hit(key, limit)
+        # curr já inclui este hit
+        return _sliding_estimate(prev, curr, now, self.window) <= limit
+
+
+class MongoBackend(_SharedBackend):
+    """
+    Um documento por chave: {_id: chave, c: {<idx>: n}, expires_at}. Um único
+    find_one_and_update incrementa a janela atual e devolve a anterior; índice TTL
+    em expires_at apaga chaves ociosas.
+    """
+
+    def __init__(self, window: float, collection):
+        super().__init__(window)
+        self.collection = collection
+
+    async def setup(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def close(self):
+        pass
+
+    async def _counts(self, key: str, idx: int) -> tuple[int, int]:
+        from pymongo import ReturnDocument  # local: o limiter local não depende do pymongo
+
+        cur, prev = str(idx), str(idx - 1)
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            {
+                "$inc": {f"c.{cur}": 1},
+                "$unset": {f"c.{idx - 2}": ""},
+                "$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=2 * self.window)},
+            },
+            projection={f"c.{cur}": 1, f"c.{prev}": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        c = (doc or {}).get("c") or {}
+        return int(c.get(prev, 0)), int(c.get(cur, 0))
+
+
+class RespError(Exception):
+    pass
+
+
+class _RespConnection:
+    """Cliente mínimo do protocolo do Redis (RESP2): só o necessário para INCR/PEXPIRE/GET."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        return b"".join(out)
+
+    async def _reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("conexão fechada pelo servidor")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = await self.reader.readexactly(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [await self._reply() for _ in range(n)]
+        raise RespError(f"resposta inválida: {line!r}")
+
+    async def pipeline(self, *commands) -> list:
+        """Envia todos os comandos de uma vez e lê as respostas em ordem (uma ida e volta)."""
+        self.writer.write(b"".join(self._encode(*c) for c in commands))
+        await self.writer.drain()
+        return [await self._reply() for _ in commands]
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class RedisBackend(_SharedBackend):
+    """
+    Qualquer servidor que fale RESP (Redis, KeyDB, Dragonfly ou um stand-in local).
+    Por hit: INCR da janela atual + PEXPIRE + GET da anterior num único pipeline.
+    """
+
+    def __init__(self, window: float, url: str, pool_size: int = 8, timeout: float = 0.5):
+        super().__init__(window)
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._idle: asyncio.Queue[_RespConnection] | None = None
+        self._opened = 0
+
+    async def _connect(self) -> _RespConnection:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        conn = _RespConnection(reader, writer)
+        init = []
+        if self.password:
+            init.append(("AUTH", self.password))
+        if self.db:
+            init.append(("SELECT", self.db))
+        if init:
+            await conn.pipeline(*init)
+        return conn
+
+    async def _acquire(self) -> _RespConnection:
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and self._opened < self.pool_size:
+            self._opened += 1
+            try:
+                return await self._connect()
+            except BaseException:
+                self._opened -= 1
+                raise
+        return await self._idle.get()
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        while self._idle is not None and not self._idle.empty():
+            await self._idle.get_nowait().close()
+        self._opened = 0
+
+    async def _counts(self, key: str, idx: int) -> tuple[int, int]:
+        cur, prev = f"rl:{key}:{idx}", f"rl:{key}:{idx - 1}"
+        conn = await asyncio.wait_for(self._acquire(), self.timeout)
+        try:
+            curr_n, _, prev_n = await asyncio.wait_for(conn.pipeline(
+                ("INCR", cur),
+                ("PEXPIRE", cur, int(2 * self.window * 1000)),
+                ("GET", prev),
+            ), self.timeout)
+        except BaseException:
+            # conexão em estado desconhecido: descarta em vez de devolver ao pool
+            self._opened -= 1
+            await conn.close()
+            raise
+        self._idle.put_nowait(conn)
+        return int(prev_n or 0), int(curr_n)
+
+
+def build_backend(kind: str, window: float, *, mongo_collection=None, redis_url: str | None = None):
+    kind = (kind or "local").lower()
+    if kind == "mongo":
+        return MongoBackend(window, mongo_collection)
+    if kind == "redis":
+        return RedisBackend(window, redis_url or "redis://127.0.0.1:6379/0")
+    return LocalBackend(window)
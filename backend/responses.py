@@ -0,0 +1,109 @@
+"""
+Resposta JSON rápida para o api_router.
+
+FastJSONResponse serializa com orjson (datetime, date, UUID e numpy nativos; ObjectId, set,
+Decimal e modelos pydantic via default). Sem orjson instalado, cai para o json da stdlib
+com o mesmo default, então a saída é equivalente.
+
+FastJSONRoute pula o jsonable_encoder do FastAPI quando o handler devolve dict/list e a
+rota não tem response_model: o objeto vai direto para o encoder, sem a cópia recursiva.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+from decimal import Decimal
+from typing import Any
+
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.routing import APIRoute
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende do ambiente
+    orjson = None
+
+try:
+    from bson import ObjectId
+except ImportError:  # pragma: no cover
+    ObjectId = None
+
+
+def _default(obj: Any):
+    if ObjectId is not None and isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    if hasattr(obj, "isoformat"):  # só usado no fallback (orjson já trata datetime/date)
+        return obj.isoformat()
+    if hasattr(obj, "hex") and hasattr(obj, "urn"):  # UUID no fallback
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=_OPTIONS)
+else:
+    def dumps(content: Any) -> bytes:
+        return json.dumps(
+            content, default=_default, ensure_ascii=False, allow_nan=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class FastJSONRoute(APIRoute):
+    """APIRoute que devolve dict/list direto como FastJSONResponse (sem jsonable_encoder)."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, endpoint, **kwargs)
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        if (
+            self.response_field is None
+            and isinstance(response_class, type)
+            and issubclass(response_class, FastJSONResponse)
+            and not _wants_response(self.dependant)
+        ):
+            # o dependant já foi montado com a assinatura original; só trocamos quem é chamado
+            self.dependant.call = _direct(self.dependant.call, response_class, self.status_code)
+
+
+def _wants_response(dependant) -> bool:
+    # handlers que recebem `response: Response` dependem do merge de headers/cookies do FastAPI
+    if dependant.response_param_name:
+        return True
+    return any(_wants_response(d) for d in dependant.dependencies)
+
+
+def _direct(call, response_class: type, status_code: int | None):
+    status = status_code or 200
+
+    def wrap(result):
+        if type(result) in (dict, list):
+            return response_class(result, status_code=status)
+        return result
+
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def endpoint(**values):
+            return wrap(await call(**values))
+    else:
+        @functools.wraps(call)
+        def endpoint(**values):
+            return wrap(call(**values))
+    return endpoint
@@ -14,7 +14,7 @@ import httpx
 import string, random
 from collections import defaultdict, deque
 from fastapi import Body, Query, Path as FPath
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 # --- GOOGLE OAUTH (LOGIN DIRETO, SEM EMERGENT) ---
 import secrets, jwt
 from fastapi.responses import RedirectResponse
@@ -25,17 +25,26 @@ from datetime import date
 from typing import Literal
 from fastapi import Depends, Body
 import time
+import asyncio
 from collections import defaultdict, deque
 from bson import ObjectId
 from fastapi import APIRouter
 from shop_seed import build_items
+from ratelimit import build_backend
+from guards import SecurityPipeline
+from indexes import apply_indexes, log_report
+from leveling import level_up, split_total, total_xp
+from daily import DAYS, bucket_minutes, day_index, days_in_year
+from jobs import JobQueue
+from responses import FastJSONResponse, FastJSONRoute, dumps as json_dumps
+import hashlib
 # from shop_seed import SHOP_ITEMS  # Não mais necessário - usamos make_items()
 ROOT_DIR = SysPath(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)   # datas voltam com tz (UTC)
 db = client[os.environ['DB_NAME']]
 groups_col = db["groups"]
 group_members_col = db["group_members"]
@@ -46,7 +55,8 @@ users_col = db["users"]                 # SUA coleção de perfis públicos (se
 
 
 
-api_router = APIRouter(prefix="/api")
+# orjson em todas as rotas da API; dict/list sem response_model não passam pelo jsonable_encoder
+api_router = APIRouter(prefix="/api", default_response_class=FastJSONResponse, route_class=FastJSONRoute)
 
 # Models
 class User(BaseModel):
@@ -128,6 +138,7 @@ class StudySessionEnd(BaseModel):
     session_id: str
     duration: int  # actual minutes studied
     skipped: bool = False
+    idempotency_key: Optional[str] = Field(None, max_length=128)  # alternativa ao header (sendBeacon não manda header)
 
 class Cycle(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -291,31 +302,6 @@ CSRF_EXEMPT_PATHS = {
 
 
 
-@app.middleware("http")
-async def csrf_guard(request: Request, call_next):
-    # Métodos “seguros” não validam
-    if request.method not in ("POST", "PUT", "PATCH", "DELETE"):
-        return await call_next(request)
-
-    # Isenta se vier Authorization (útil em dev cross-origin)
-    auth = request.headers.get("Authorization", "")
-    if auth.startswith("Bearer "):
-        return await call_next(request)
-
-    # Isenta paths específicos
-    if request.url.path in CSRF_EXEMPT_PATHS:
-        return await call_next(request)
-
-    # Verificação CSRF padrão (header vs cookie)
-    header = request.headers.get("X-CSRF-Token")
-    cookie = request.cookies.get("csrf_token")
-    if not header or not cookie or not secrets.compare_digest(header, cookie):
-        return JSONResponse({"detail": "CSRF check failed"}, status_code=403)
-
-    return await call_next(request)
-
-
-
 import time
 from collections import defaultdict, deque
 
@@ -343,55 +329,41 @@ RATE_LIMIT_MAX_BY_METHOD = {
     "DELETE": 60,
 }
 
-_hitq = defaultdict(deque)
+# janela deslizante aproximada: memória fixa por (ip, método), O(1) por hit, chaves ociosas expiram.
+# "local" vale por worker; "mongo"/"redis" dividem um único orçamento entre todos os workers
+# (uma ida ao servidor por request; se ele cair, cada worker volta ao limiter local).
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local")   # local | mongo | redis
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://127.0.0.1:6379/0")
+_limiter = build_backend(
+    RATE_LIMIT_BACKEND, RATE_LIMIT_WINDOW,
+    mongo_collection=db.rate_limits, redis_url=RATE_LIMIT_REDIS_URL,
+)
 # limite de tamanho do corpo (1 MB está ótimo para nosso uso)
 MAX_BODY_BYTES = 1_048_576
+# prazo por leitura do corpo (cliente que manda poucos bytes por vez recebe 408)
+BODY_READ_TIMEOUT = float(os.getenv("BODY_READ_TIMEOUT", "15"))
 
-@app.middleware("http")
-async def rate_limit(request: Request, call_next):
-    path = request.url.path
-    if path in EXEMPT_RATE_PATHS:
-        return await call_next(request)
-
-    ip = request.client.host if request.client else "unknown"
-    method = request.method.upper()
-    limit = RATE_LIMIT_MAX_BY_METHOD.get(method, 120)
-
-    now = time.time()
-    key = (ip, method)  # por IP+método (não por path)
-    dq = _hitq[key]
-
-    # limpa janelas antigas
-    while dq and (now - dq[0]) > RATE_LIMIT_WINDOW:
-        dq.popleft()
-
-    if len(dq) >= limit:
-        return JSONResponse({"detail": "Too many requests"}, status_code=429)
-
-    dq.append(now)
-    return await call_next(request)
 # === FIM RATE LIMIT ===
 
 
 
-async def ensure_group_indexes():
-    # remove o índice único errado em "id" se existir
-    try:
-        await groups_col.drop_index("id_1")
-    except Exception:
-        pass
+# === [ADD] Índices: registro declarativo em indexes.py (antes só groups/group_members) ===
+# apply      -> cria os que faltam no boot (coleções em paralelo) e reporta sobras/divergências
+# background -> idem, sem segurar o boot
+# check      -> só reporta (coleções grandes: `python manage.py indexes apply` fora do boot)
+# off        -> nada
+INDEX_STARTUP_MODE = os.getenv("INDEX_STARTUP_MODE", "apply").lower()
+_index_task: asyncio.Task | None = None
 
-    # códigos de convite precisam ser únicos
-    await groups_col.create_index("invite_code", unique=True)
+async def ensure_indexes(create: bool = True, only=None) -> dict:
+    report = await apply_indexes(db, only=only, create=create)
+    log_report(report)
+    return report
 
-    # (group_id, user_id) único em memberships
-    await group_members_col.create_index([("group_id", 1), ("user_id", 1)], unique=True)
-
-    # busca por nome/descrição (não é único)
-    try:
-        await groups_col.create_index([("name", "text"), ("description", "text")])
-    except Exception:
-        pass
+async def ensure_group_indexes():
+    # invite_code único, (group_id, user_id) único, texto em nome/descrição; remove o id_1 errado
+    return await ensure_indexes(only={"groups", "group_members"})
+# === [FIM ADD] ===
 
 
 # === TIMER CONFIG ===
@@ -425,44 +397,81 @@ def _sec(mins: int) -> int:
 @app.on_event("startup")
 async def _startup_indexes():
     # ... se você já tiver outro startup, apenas acrescente a chamada:
-    await ensure_group_indexes()
-
-
-
-
-@app.middleware("http")
-async def body_size_guard(request: Request, call_next):
-    if request.method in ("POST", "PUT", "PATCH"):
-        cl = request.headers.get("content-length")
-        if cl and cl.isdigit() and int(cl) > MAX_BODY_BYTES:
-            return JSONResponse({"detail": "Payload too large"}, status_code=413)
-    return await call_next(request)
-# === HEADERS DE SEGURANÇA (CSP para API) ===
-@app.middleware("http")
-async def security_headers(request: Request, call_next):
-    resp = await call_next(request)
-    resp.headers["X-Content-Type-Options"] = "nosniff"
-    resp.headers["X-Frame-Options"] = "DENY"
-    resp.headers["Referrer-Policy"] = "same-origin"
-    resp.headers["Permissions-Policy"] = "camera=(), microphone=(), geolocation=()"
-
-    # CSP: API-first (JSON). Permite connect 'self' e silencia fontes do Google quando o browser renderiza.
-    resp.headers["Content-Security-Policy"] = (
-        "default-src 'none'; "
-        "connect-src 'self'; "
-        "img-src 'self' data:; "
-        "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; "
-        "font-src 'self' data: https://fonts.gstatic.com; "
-        "frame-ancestors 'none'; base-uri 'none';"
-    )
-    return resp
+    global _index_task
+    await _limiter.setup()
+    if INDEX_STARTUP_MODE == "background":
+        _index_task = asyncio.ensure_future(ensure_indexes())
+    elif INDEX_STARTUP_MODE in ("apply", "check"):
+        await ensure_indexes(create=INDEX_STARTUP_MODE == "apply")
+
+
+
+
+# === PIPELINE ASGI: corpo (413) -> rate limit (429) -> CSRF (403) + headers de segurança ===
+# um único middleware ASGI puro no lugar de quatro @app.middleware("http");
+# adicionado por último = camada mais externa (fica por fora do CORS, como antes)
+app.add_middleware(
+    SecurityPipeline,
+    limiter=_limiter,
+    limits_by_method=RATE_LIMIT_MAX_BY_METHOD,
+    default_limit=120,
+    rate_exempt_paths=EXEMPT_RATE_PATHS,
+    csrf_exempt_paths=CSRF_EXEMPT_PATHS,
+    max_body_bytes=MAX_BODY_BYTES,
+    body_read_timeout=BODY_READ_TIMEOUT,
+)
 # === FIM HEADERS ===
 
 
 
 GOOGLE_AUTH = "https://accounts.google.com/o/oauth2/v2/auth"
-GOOGLE_TOKEN = "https://oauth2.googleapis.com/token"
-GOOGLE_USERINFO = "https://openidconnect.googleapis.com/v1/userinfo"
+# endpoints sobrescrevíveis por env para apontar a um stub local (benchmark de login offline)
+GOOGLE_TOKEN = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_USERINFO = os.getenv("GOOGLE_USERINFO_URL", "https://openidconnect.googleapis.com/v1/userinfo")
+
+# === [ADD] Cliente HTTP único (pool keep-alive) para o OAuth do Google ===
+OAUTH_HTTP_TIMEOUT = float(os.getenv("OAUTH_HTTP_TIMEOUT", "15"))
+OAUTH_HTTP_CONNECT_TIMEOUT = float(os.getenv("OAUTH_HTTP_CONNECT_TIMEOUT", "5"))
+OAUTH_HTTP_MAX_CONN = int(os.getenv("OAUTH_HTTP_MAX_CONN", "20"))
+
+try:
+    import h2  # noqa: F401  -> httpx[http2] instalado
+    OAUTH_HTTP2 = True
+except ImportError:
+    OAUTH_HTTP2 = False
+
+# vive o tempo da app; testes/benchmarks podem trocar por um client com transport próprio antes do startup
+oauth_http: httpx.AsyncClient | None = None
+
+def build_oauth_http(**overrides) -> httpx.AsyncClient:
+    kwargs = dict(
+        http2=OAUTH_HTTP2,
+        timeout=httpx.Timeout(OAUTH_HTTP_TIMEOUT, connect=OAUTH_HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=OAUTH_HTTP_MAX_CONN,
+            max_keepalive_connections=OAUTH_HTTP_MAX_CONN,
+            keepalive_expiry=60,
+        ),
+    )
+    kwargs.update(overrides)
+    return httpx.AsyncClient(**kwargs)
+
+def get_oauth_http() -> httpx.AsyncClient:
+    global oauth_http
+    if oauth_http is None or oauth_http.is_closed:
+        oauth_http = build_oauth_http()
+    return oauth_http
+
+async def close_oauth_http():
+    global oauth_http
+    if oauth_http is not None:
+        await oauth_http.aclose()
+        oauth_http = None
+
+@app.on_event("startup")
+async def _startup_oauth_http():
+    get_oauth_http()
+# === [FIM ADD] ===
 
 
 def set_session_cookie(resp, token: str):
@@ -499,8 +508,8 @@ def issue_session(user_id: str) -> dict:
         "id": secrets.token_urlsafe(32),             # session_token
         "user_id": user_id,
         "csrf_token": secrets.token_urlsafe(32),     # amarrado à sessão
-        "created_at": utcnow().isoformat(),
-        "expires_at": (utcnow() + timedelta(days=SESSION_TTL_DAYS)).isoformat(),
+        "created_at": utcnow(),
+        "expires_at": utcnow() + timedelta(days=SESSION_TTL_DAYS),   # Date nativo: o índice TTL expira sozinho
     }
 
 async def persist_session(sess: dict):
@@ -556,14 +565,8 @@ def _to_aware(dt):
 @api_router.get("/auth/google/login")
 async def google_login(request: Request):
     # gera state e grava tanto no cookie quanto no banco (dupla segurança)
-    state = secrets.token_urlsafe(24)
-    
-    # salva no banco com TTL de 10 minutos
-    await db.oauth_states.insert_one({
-        "state": state,
-        "created_at": datetime.now(timezone.utc),
-        "expires_at": datetime.now(timezone.utc) + timedelta(minutes=10)
-    })
+    # salva no banco com TTL de 10 minutos (índice TTL em expires_at) + mapa local do worker
+    state = await oauth_states.issue()
     
     params = {
         "client_id": GOOGLE_CLIENT_ID,
@@ -594,10 +597,10 @@ class TimerStateBody(BaseModel):
 async def study_timer_state(body: TimerStateBody, request: Request, session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(request, session_token)
 
+    now = utcnow()
     update = {
         "active_session.timer.state": body.state,
-        "active_session.timer.updated_at": utcnow(),
-        "last_activity": datetime.now(timezone.utc).isoformat(),
+        "active_session.timer.updated_at": now,
     }
     
     # (opcional) se você também quiser atualizar a matéria aqui:
@@ -615,6 +618,8 @@ async def study_timer_state(body: TimerStateBody, request: Request, session_toke
         update["active_session.timer.seconds_left"] = secs
         update["active_session.timer.phase_until"] = (datetime.now(timezone.utc) + timedelta(seconds=secs)).isoformat()
 
+    # prazo do reaper: fim da fase + folga (ou, pausado, agora + folga maior)
+    update["active_session.expires_at"] = _active_expiry(body.state, update["active_session.timer.phase_until"], now)
     await db.users.update_one({"id": user.id}, {"$set": update}, upsert=True)
     return {"ok": True}
 
@@ -629,29 +634,22 @@ async def google_callback(request: Request, code: str | None = None, state: str
     # tenta validar via cookie (compatibilidade)
     if oauth_state and state == oauth_state:
         state_valid = True
-    else:
-        # valida via banco de dados (mais robusto)
-        db_state = await db.oauth_states.find_one({
-            "state": state,
-            "expires_at": {"$gt": datetime.now(timezone.utc)}
-        })
-        if db_state:
-            state_valid = True
-            # limpa o state usado
-            await db.oauth_states.delete_one({"state": state})
+    # consome o state (uso único): mapa local do worker ou find_one_and_delete atômico no banco
+    if await oauth_states.consume(state):
+        state_valid = True
     
     if not state_valid:
         raise HTTPException(status_code=400, detail="Invalid OAuth state")
     
-    # troca code por tokens
-    async with httpx.AsyncClient(timeout=15) as client:
-        token_res = await client.post(GOOGLE_TOKEN, data={
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "code": code,
-            "grant_type": "authorization_code",
-            "redirect_uri": f"{BACKEND_URL}/api/auth/google/callback",
-        })
+    # troca code por tokens (mesmo pool/conexão para as duas chamadas)
+    http = get_oauth_http()
+    token_res = await http.post(GOOGLE_TOKEN, data={
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "code": code,
+        "grant_type": "authorization_code",
+        "redirect_uri": f"{BACKEND_URL}/api/auth/google/callback",
+    })
     if token_res.status_code != 200:
         raise HTTPException(status_code=400, detail="Token exchange failed")
     tokens = token_res.json()
@@ -660,8 +658,7 @@ async def google_callback(request: Request, code: str | None = None, state: str
         raise HTTPException(status_code=400, detail="No access token")
 
     # pega userinfo
-    async with httpx.AsyncClient(timeout=15) as client:
-        ui = await client.get(GOOGLE_USERINFO, headers={"Authorization": f"Bearer {access_token}"})
+    ui = await http.get(GOOGLE_USERINFO, headers={"Authorization": f"Bearer {access_token}"})
     if ui.status_code != 200:
         raise HTTPException(status_code=400, detail="Userinfo failed")
     info = ui.json()  # {"sub": "...", "email": "...", "name": "...", "picture": "..."}
@@ -678,15 +675,18 @@ async def google_callback(request: Request, code: str | None = None, state: str
         "avatar": info.get("picture"),
         "updated_at": datetime.now(timezone.utc).isoformat(),
     }
-    await db.users.update_one({"id": uid}, {"$setOnInsert": {"coins": 0, "xp": 0, "level": 1}, "$set": user_doc}, upsert=True)
-
-    # JWT e cookie
-    payload = {"sub": uid, "exp": datetime.now(timezone.utc) + timedelta(days=30)}
-    token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
+    res = await db.users.update_one({"id": uid}, {"$setOnInsert": {"coins": 0, "xp": 0, "level": 1}, "$set": user_doc}, upsert=True)
+    invalidate_user(uid)
+    if res.upserted_id is not None:
+        # conta nova: abertura zerada no ledger (a auditoria distingue de contas antigas sem abertura)
+        await ledger.record(uid, reason="opening", key=f"opening:{uid}", applied=True)
+
+    # sessão no servidor + cookies (session_token HttpOnly e csrf_token legível pelo front)
+    sess = await session_store.create(uid)
     
     # Redireciona para página intermediária que aguarda o cookie ser setado
     resp = RedirectResponse(f"{FRONTEND_URL}/auth/callback", status_code=302)
-    make_cookie(resp, token)
+    set_session_cookies(resp, sess, prod=BACKEND_URL.startswith("https://"))
     
     # limpa state cookie
     resp.delete_cookie("oauth_state", path="/")
@@ -695,10 +695,7 @@ async def google_callback(request: Request, code: str | None = None, state: str
 
 @api_router.post("/admin/seed-shop")
 async def admin_seed_shop():
-    # cuidado: reseta a coleção
-    await db.shop_items.delete_many({})
-    from pathlib import Path
-    # usa a mesma função que já existe
+    # cuidado: reseta a coleção (initialize_shop já apaga, regrava e sobe a versão do catálogo)
     items = await initialize_shop()
     return {"ok": True, "count": len(items)}
 
@@ -734,6 +731,7 @@ async def auth_me(request: Request, session_token: Optional[str] = Cookie(None),
 
         # Caminho normal: usa cookie session_token
         me = await get_current_user(request, session_token)
+        bal = await fresh_balance(me.id)
         return {
             "ok": True,
             "user": {
@@ -742,10 +740,10 @@ async def auth_me(request: Request, session_token: Optional[str] = Cookie(None),
                 "name": getattr(me, "name", None),
                 "nickname": getattr(me, "nickname", None),
                 "tag": getattr(me, "tag", None),
-                "level": getattr(me, "level", 1),
-                "coins": getattr(me, "coins", 0),
-                "xp": getattr(me, "xp", 0),
-                "equipped_items": getattr(me, "equipped_items", {"seal": None, "border": None, "theme": None}),
+                "level": bal.get("level", me.level),
+                "coins": bal.get("coins", me.coins),
+                "xp": bal.get("xp", me.xp),
+                "equipped_items": bal.get("equipped_items") or me.equipped_items,
             },
         }
     except HTTPException as e:
@@ -764,7 +762,7 @@ async def auth_me(request: Request, session_token: Optional[str] = Cookie(None),
 async def set_session(request: Request):
     """
     Endpoint para setar o cookie de sessão após OAuth.
-    Recebe o token no body e seta como cookie.
+    Recebe o token no body (sessão ativa ou JWT legado) e emite uma sessão nova nos cookies.
     """
     body = await request.json()
     token = body.get("token")
@@ -773,29 +771,34 @@ async def set_session(request: Request):
         raise HTTPException(status_code=400, detail="Token missing")
     
     # Valida o token
-    try:
-        data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        uid = data.get("sub")
-        if not uid:
+    uid = await session_store.resolve(token)
+    if not uid:
+        try:
+            data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+            uid = data.get("sub")
+            if not uid:
+                raise HTTPException(status_code=400, detail="Invalid token")
+        except jwt.InvalidTokenError:
             raise HTTPException(status_code=400, detail="Invalid token")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=400, detail="Invalid token")
     
     # Verifica se o usuário existe
     user = await db.users.find_one({"id": uid}, {"_id": 0, "id": 1})
     if not user:
         raise HTTPException(status_code=400, detail="User not found")
     
-    # Cria response e seta cookie
+    # Cria response e seta cookies
+    sess = await session_store.create(uid)
     resp = JSONResponse({"ok": True, "user_id": uid})
-    make_cookie(resp, token)
+    set_session_cookies(resp, sess, prod=BACKEND_URL.startswith("https://"))
     
     return resp
 
 @api_router.post("/auth/logout")
 async def logout(request: Request, session_token: Optional[str] = Cookie(None)):
     if session_token:
-        await db.sessions.delete_one({"id": session_token})
+        # revoga na hora neste worker e nos outros no próximo poll; JWT legado também
+        _token_cache.pop(session_token)
+        await session_store.revoke(session_token)
     resp = JSONResponse({"ok": True})
     # apaga cookies com os mesmos parâmetros usados ao criar
     is_production = BACKEND_URL.startswith("https://")
@@ -816,19 +819,411 @@ async def require_user(request: Request, session_token: str | None = Cookie(defa
         raise HTTPException(status_code=401, detail="Not authenticated")
     return me
 
+# === [ADD] Documento do usuário por request (uma leitura, projeção declarada) ===
+def user_doc(*fields: str):
+    """
+    Dependência que lê o documento do usuário logado no máximo uma vez por request.
+    Cada rota declara os campos que precisa: doc: dict = Depends(user_doc("tabs_open")).
+    Uma leitura já feita com projeção maior é reaproveitada por declarações menores.
+    """
+    wanted = frozenset(fields)
+    projection = {"_id": 0, "id": 1, **{f: 1 for f in fields}}
+
+    async def _load(request: Request, session_token: str | None = Cookie(default=None)) -> dict:
+        me = await get_current_user(request, session_token)
+        memo = getattr(request.state, "user_docs", None)
+        if memo is None:
+            memo = request.state.user_docs = {}
+        for loaded, doc in memo.items():
+            if wanted <= loaded:
+                return doc
+        doc = await db.users.find_one({"id": me.id}, projection) or {"id": me.id}
+        memo[wanted] = doc
+        return doc
+
+    return _load
+# === [FIM ADD] ===
+
 # Root Route
 @api_router.get("/")
 async def root():
     return {"message": "CicloStudy API", "status": "ok"}
 
-# Auth Helper
-async def get_current_user(request: Request, session_token: str | None = Cookie(None)):
+# === [ADD] Cache de resolução de usuário (token -> uid -> perfil projetado) ===
+from collections import OrderedDict
+from typing import Any
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))    # segundos; limita staleness entre workers
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "10000"))   # entradas por cache (LRU)
+
+# só o que o CurrentUser expõe; o resto do documento não trafega no caminho de auth
+USER_AUTH_PROJECTION = {
+    "_id": 0, "id": 1, "email": 1, "name": 1, "level": 1, "coins": 1, "xp": 1,
+    "items_owned": 1, "equipped_items": 1, "nickname": 1, "tag": 1, "last_nickname_change": 1,
+}
+
+class TTLCache:
     """
-    Aceita:
-      - Cookie: session_token (JWT)
-      - Header: Authorization: Bearer <jwt>  (prod)
-      - Header: Authorization: Bearer <user_id>  (dev fallback)
+    LRU limitado com expiração por entrada (relógio monotônico).
+    Sem locks: cada worker tem um único event loop.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key, default=None):
+        hit = self._data.get(key)
+        if hit is None:
+            return default
+        expires, value = hit
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        hit = self._data.pop(key, None)
+        return default if hit is None else hit[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+_token_cache = TTLCache(USER_CACHE_MAX, USER_CACHE_TTL)   # token -> uid
+_user_cache = TTLCache(USER_CACHE_MAX, USER_CACHE_TTL)    # uid -> doc projetado
+
+def invalidate_user(uid: str):
+    """
+    Descarta o perfil em cache. Chamar após mudar coins, xp, level, items_owned, equipped_items ou nickname.
+    Só vale para este worker: nos demais o perfil pode ficar até USER_CACHE_TTL velho. Por isso
+    nenhuma decisão sai do cache (posse de item vai no filtro do update) e saldo exibido vem de
+    fresh_balance().
+    """
+    _user_cache.pop(uid)
+
+BALANCE_PROJECTION = {"_id": 0, "coins": 1, "xp": 1, "level": 1, "equipped_items": 1}
+
+async def fresh_balance(uid: str) -> dict:
+    """coins/xp/level/equipped_items direto do Mongo (um find_one pelo índice de id)."""
+    return await db.users.find_one({"id": uid}, BALANCE_PROJECTION) or {}
+
+def _uid_from_token(token: str) -> tuple[str | None, float]:
+    """Decodifica o token e devolve (uid, ttl de cache). JWT nunca fica em cache além do 'exp'."""
+    try:
+        data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        # dev fallback: se não for JWT, trate como user_id direto
+        return token, USER_CACHE_TTL
+    ttl = USER_CACHE_TTL
+    exp = data.get("exp")
+    if exp:
+        ttl = min(ttl, float(exp) - time.time())
+    return data.get("sub"), ttl
+
+# === [ADD] Write-behind dos carimbos de atividade (last_activity / last_interaction) ===
+from pymongo import ReturnDocument, UpdateOne
+
+ACTIVITY_FLUSH_SECS = float(os.getenv("ACTIVITY_FLUSH_SECS", "5"))
+ACTIVITY_BUFFER_MAX = int(os.getenv("ACTIVITY_BUFFER_MAX", "5000"))   # usuários distintos por janela
+
+class ActivityBuffer:
+    """
+    Junta os carimbos por usuário em memória e grava tudo num único bulk_write não-ordenado.
+    Várias batidas do mesmo usuário na mesma janela viram um só UpdateOne (último valor vence).
+    Carimbo é best-effort: com o buffer cheio e um flush em andamento, usuários novos são descartados.
+    """
+    def __init__(self, collection, interval: float, maxsize: int):
+        self.collection = collection
+        self.interval = interval
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pending: dict[str, dict] = {}
+        self._task: asyncio.Task | None = None
+        self._early: asyncio.Task | None = None
+
+    def touch(self, user_id: str, **fields):
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            pending.update(fields)
+            return
+        if len(self._pending) >= self.maxsize:
+            if self._early is not None and not self._early.done():
+                self.dropped += 1
+                return
+            # buffer cheio: esvazia já e grava em background, sem segurar o request
+            self._early = asyncio.ensure_future(self._write(self._take()))
+        self._pending[user_id] = dict(fields)
+
+    def _take(self) -> dict[str, dict]:
+        batch, self._pending = self._pending, {}
+        return batch
+
+    async def _write(self, batch: dict[str, dict]) -> int:
+        if not batch:
+            return 0
+        ops = [UpdateOne({"id": uid}, {"$set": fields}) for uid, fields in batch.items()]
+        try:
+            await self.collection.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.warning(f"activity flush warn ({len(ops)} ops): {e}")
+        return len(ops)
+
+    async def flush(self) -> int:
+        return await self._write(self._take())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+activity_buffer = ActivityBuffer(db.users, ACTIVITY_FLUSH_SECS, ACTIVITY_BUFFER_MAX)
+
+@app.on_event("startup")
+async def _startup_activity_buffer():
+    activity_buffer.start()
+# === [FIM ADD] ===
+
+# === [ADD] Sessões opacas no servidor (db.sessions + LRU de ativas + cache de revogadas) ===
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "20000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "60"))    # revalida no Mongo (teto de segurança)
+REVOKED_CACHE_MAX = int(os.getenv("REVOKED_CACHE_MAX", "5000"))
+SESSION_REVOKE_POLL_SECS = float(os.getenv("SESSION_REVOKE_POLL_SECS", "2"))   # atraso da revogação entre workers
+REVOKED_KEEP_SECS = 600   # sessão revogada: doc fica esse tempo para os outros workers verem (depois o TTL apaga)
+SESSION_ID_LEN = len(secrets.token_urlsafe(32))   # ids de issue_session()
+
+def _is_session_id(token: str) -> bool:
+    return len(token) == SESSION_ID_LEN and "." not in token
+
+class SessionStore:
+    """
+    Sessões com id opaco persistidas em db.sessions (índice TTL em expires_at).
+    Caminho comum: um lookup no LRU de ativas. Revogar tira do LRU e entra no cache
+    negativo na hora, então o próprio worker recusa o id já no request seguinte.
+    Nos outros workers: revoke() marca revoked_at no doc (em vez de apagar) e cada worker
+    consulta os revogados recentes a cada SESSION_REVOKE_POLL_SECS (índice em revoked_at),
+    então o logout vale em todos em até ~SESSION_REVOKE_POLL_SECS; se o poll falhar, o teto
+    é SESSION_CACHE_TTL, quando o LRU revalida no Mongo (que já filtra revoked_at).
+    """
+    def __init__(self, collection, poll_secs: float = SESSION_REVOKE_POLL_SECS):
+        self.collection = collection
+        self.poll_secs = poll_secs
+        self._active = TTLCache(SESSION_CACHE_MAX, SESSION_CACHE_TTL)          # sid -> (user_id, expires_ts)
+        self._revoked = TTLCache(REVOKED_CACHE_MAX, SESSION_TTL_DAYS * 86400)   # sid -> True
+        self._since = utcnow()
+        self._task: asyncio.Task | None = None
+
+    def _remember(self, sid: str, user_id: str, expires_at: datetime):
+        ttl = min(SESSION_CACHE_TTL, (_to_aware(expires_at) - utcnow()).total_seconds())
+        if ttl > 0:
+            self._active.set(sid, (user_id, time.time() + ttl), ttl)
+
+    async def create(self, user_id: str) -> dict:
+        sess = issue_session(user_id)
+        await persist_session(sess)
+        self._remember(sess["id"], user_id, sess["expires_at"])
+        return sess
+
+    def cached(self, sid: str) -> str | None:
+        hit = self._active.get(sid)
+        return hit[0] if hit else None
+
+    def is_revoked(self, sid: str) -> bool:
+        return self._revoked.get(sid) is not None
+
+    async def resolve(self, sid: str) -> str | None:
+        uid = self.cached(sid)
+        if uid is not None:
+            return uid
+        if self.is_revoked(sid):
+            return None
+        doc = await self.collection.find_one(
+            {"id": sid, "expires_at": {"$gt": utcnow()}, "revoked_at": None},
+            {"_id": 0, "user_id": 1, "expires_at": 1},
+        )
+        if not doc:
+            return None
+        self._remember(sid, doc["user_id"], doc["expires_at"])
+        return doc["user_id"]
+
+    def _forget(self, sid: str):
+        self._active.pop(sid)
+        _token_cache.pop(sid)
+        self._revoked.set(sid, True)
+
+    async def revoke(self, sid: str):
+        self._forget(sid)
+        now = utcnow()
+        keep_until = now + timedelta(seconds=REVOKED_KEEP_SECS)
+        is_jwt = sid.count(".") == 2
+        if is_jwt:
+            # JWT legado não tem doc: o marcador vale até o 'exp' do próprio token (sem exp: para sempre),
+            # porque qualquer worker sem ele no LRU volta a aceitar o JWT
+            try:
+                exp = jwt.decode(sid, JWT_SECRET, algorithms=["HS256"], options={"verify_exp": False}).get("exp")
+            except jwt.InvalidTokenError:
+                return   # não decodifica: já é recusado
+            keep_until = max(keep_until, datetime.fromtimestamp(float(exp), timezone.utc)) if exp else None
+        await self.collection.update_one(
+            {"id": sid},
+            {"$set": {"revoked_at": now, "expires_at": keep_until}},
+            upsert=is_jwt,
+        )
+
+    async def jwt_revoked(self, token: str) -> bool:
+        """JWT fora do LRU: confere o marcador de revogação no Mongo (índice único em id)."""
+        if self.is_revoked(token):
+            return True
+        doc = await self.collection.find_one({"id": token, "revoked_at": {"$ne": None}}, {"_id": 1})
+        if doc is None:
+            return False
+        self._forget(token)
+        return True
+
+    async def poll_revoked(self):
+        """Puxa os revogados desde o último poll (com sobreposição de um intervalo: repetir é inócuo)."""
+        started = utcnow()
+        async for doc in self.collection.find(
+            {"revoked_at": {"$gte": self._since}}, {"_id": 0, "id": 1},
+        ):
+            self._forget(doc["id"])
+        self._since = started - timedelta(seconds=self.poll_secs)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_secs)
+            try:
+                await self.poll_revoked()
+            except Exception as e:
+                logger.warning(f"session revoke poll warn: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+session_store = SessionStore(db.sessions)
+
+@app.on_event("startup")
+async def _startup_session_store():
+    session_store.start()
+
+OAUTH_STATE_TTL = 600   # 10 min
+OAUTH_STATE_CACHE_MAX = int(os.getenv("OAUTH_STATE_CACHE_MAX", "10000"))
+
+class OAuthStateStore:
     """
+    States do OAuth em db.oauth_states (índice TTL em expires_at) com um mapa local expirável.
+    O state só vale uma vez: quem apaga o doc no Mongo (deleted_count == 1) é o único que passa,
+    então um replay em outro worker perde mesmo antes do delete. Callback no mesmo worker do
+    login: o mapa local recusa lixo sem ir ao Mongo e o delete dispensa o filtro de expiração
+    (o mapa já expira junto); nos demais casos, um único find_one_and_delete.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+        self._local = TTLCache(OAUTH_STATE_CACHE_MAX, OAUTH_STATE_TTL)
+
+    async def issue(self) -> str:
+        state = secrets.token_urlsafe(24)
+        now = utcnow()
+        await self.collection.insert_one({
+            "state": state,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=OAUTH_STATE_TTL),
+        })
+        self._local.set(state, True)
+        return state
+
+    async def consume(self, state: str) -> bool:
+        if self._local.get(state) is not None:
+            self._local.pop(state)
+            res = await self.collection.delete_one({"state": state})
+            return res.deleted_count == 1
+        doc = await self.collection.find_one_and_delete(
+            {"state": state, "expires_at": {"$gt": utcnow()}},
+            projection={"_id": 1},
+        )
+        return doc is not None
+
+oauth_states = OAuthStateStore(db.oauth_states)
+
+async def _resolve_uid(token: str) -> str | None:
+    """
+    Token -> user_id. Ordem: sessão ativa em cache, revogada, cache de tokens,
+    sessão no Mongo, JWT legado (até expirar, se não houver marcador de revogação no Mongo)
+    e, por fim, o fallback dev (token == user_id).
+    Um id com formato de sessão que não está no Mongo (expirado/revogado) para aí: nunca vira
+    user_id pelo fallback dev nem entra no cache de tokens.
+    """
+    uid = session_store.cached(token)
+    if uid is not None:
+        return uid
+    if session_store.is_revoked(token):
+        return None
+    uid = _token_cache.get(token)
+    if uid is not None:
+        return uid
+    if token.count(".") != 2:
+        uid = await session_store.resolve(token)
+        if uid is not None or _is_session_id(token):
+            return uid
+    elif await session_store.jwt_revoked(token):
+        return None
+    uid, ttl = _uid_from_token(token)
+    if uid and ttl > 0:
+        _token_cache.set(token, uid, ttl)
+    return uid
+# === [FIM ADD] ===
+
+class CurrentUser:
+    def __init__(self, user: dict):
+        self.id = user["id"]
+        self.email = user.get("email")
+        self.name = user.get("name")
+        self.level = user.get("level", 1)
+        self.coins = user.get("coins", 0)
+        self.xp = user.get("xp", 0)
+        self.items_owned = user.get("items_owned", [])
+        self.equipped_items = user.get("equipped_items", {"seal": None, "border": None, "theme": None})
+        self.nickname = user.get("nickname")
+        self.tag = user.get("tag")
+        self.last_nickname_change = user.get("last_nickname_change")
+# === [FIM ADD] ===
+
+# Auth Helper
+async def session_uid(request: Request, session_token: str | None = None) -> str:
+    """Só o user_id do request (cookie ou Bearer), sem carregar o perfil."""
     token = session_token
     auth = request.headers.get("Authorization", "")
     if auth.startswith("Bearer "):
@@ -837,40 +1232,36 @@ async def get_current_user(request: Request, session_token: str | None = Cookie(
     if not token:
         raise HTTPException(status_code=401, detail="no-session")
 
-    # tenta JWT primeiro
-    uid = None
-    try:
-        data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        uid = data.get("sub")
-    except jwt.InvalidTokenError:
-        # dev fallback: se não for JWT, trate como user_id direto
-        uid = token
-
+    uid = await _resolve_uid(token)
     if not uid:
         raise HTTPException(status_code=401, detail="invalid-token")
+    return uid
 
-    user = await db.users.find_one({"id": uid}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=401, detail="invalid-user")
 
-    await db.users.update_one(
-        {"id": uid},
-        {"$set": {"last_activity": datetime.now(timezone.utc).isoformat()}}
-    )
+async def get_current_user(request: Request, session_token: str | None = Cookie(None)):
+    """
+    Aceita:
+      - Cookie: session_token (id de sessão opaco; JWT legado até expirar)
+      - Header: Authorization: Bearer <sessão|jwt>  (prod)
+      - Header: Authorization: Bearer <user_id>  (dev fallback)
+    Token decodificado e perfil ficam em cache (TTL curto), então o caminho comum não lê o Mongo.
+    Dentro do mesmo request o resultado é memoizado em request.state.
+    """
+    memo = getattr(request.state, "current_user", None)
+    if memo is not None:
+        return memo
+
+    uid = await session_uid(request, session_token)
+    user = _user_cache.get(uid)
+    if user is None:
+        user = await db.users.find_one({"id": uid}, USER_AUTH_PROJECTION)
+        if not user:
+            raise HTTPException(status_code=401, detail="invalid-user")
+        _user_cache.set(uid, user)
+
+    activity_buffer.touch(uid, last_activity=datetime.now(timezone.utc).isoformat())
 
-    class CurrentUser: ...
-    cu = CurrentUser()
-    cu.id = user["id"]
-    cu.email = user.get("email")
-    cu.name = user.get("name")
-    cu.level = user.get("level", 1)
-    cu.coins = user.get("coins", 0)
-    cu.xp = user.get("xp", 0)
-    cu.items_owned = user.get("items_owned", [])
-    cu.equipped_items = user.get("equipped_items", {"seal": None, "border": None, "theme": None})
-    cu.nickname = user.get("nickname")
-    cu.tag = user.get("tag")
-    cu.last_nickname_change = user.get("last_nickname_change")
+    request.state.current_user = cu = CurrentUser(user)
     return cu
 
 
@@ -882,13 +1273,13 @@ async def _get_user_settings_minutes(user_id: str) -> int:
     s = await db.user_settings.find_one({"user_id": user_id}, {"_id": 0, "study_duration": 1})
     return int(s.get("study_duration", 50)) if s else 50
 
-async def _update_and_get_streak(user_id: str, studied_minutes_today: int) -> int:
+def _next_streak(u: dict | None, studied_minutes_today: int, today: date | None = None) -> tuple[int, dict | None]:
     """
-    Incrementa streak se estudou >=25 min no dia.
-    Salva/usa: users.last_streak_date (YYYY-MM-DD), users.streak_days (int).
+    Streak a partir do doc do usuário (last_streak_date/streak_days), sem I/O.
+    Devolve (streak, $set a gravar ou None se não estudou >=25 min). `today`: dia do estudo
+    (padrão: hoje UTC); um dia anterior ao último registrado não mexe na sequência.
     """
-    u = await db.users.find_one({"id": user_id}, {"_id": 0, "last_streak_date": 1, "streak_days": 1})
-    today = _today_utc_date()
+    today = today or _today_utc_date()
     last = None
     if u and u.get("last_streak_date"):
         try:
@@ -906,17 +1297,26 @@ async def _update_and_get_streak(user_id: str, studied_minutes_today: int) -> in
             streak = 1
         else:
             delta = (today - last).days
+            if delta < 0:
+                return streak, None
             if delta == 0:
                 pass
             elif delta == 1:
                 streak += 1
             else:
                 streak = 1
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {"last_streak_date": today.isoformat(), "streak_days": streak}},
-            upsert=True
-        )
+        return streak, {"last_streak_date": today.isoformat(), "streak_days": streak}
+    return streak, None
+
+async def _update_and_get_streak(user_id: str, studied_minutes_today: int) -> int:
+    """
+    Incrementa streak se estudou >=25 min no dia.
+    Salva/usa: users.last_streak_date (YYYY-MM-DD), users.streak_days (int).
+    """
+    u = await db.users.find_one({"id": user_id}, {"_id": 0, "last_streak_date": 1, "streak_days": 1})
+    streak, upd = _next_streak(u, studied_minutes_today)
+    if upd:
+        await db.users.update_one({"id": user_id}, {"$set": upd}, upsert=True)
     return streak
 
 def _fatigue_multiplier(minutes: int) -> float:
@@ -939,22 +1339,305 @@ def _week_bounds_utc(now: datetime) -> tuple[datetime, datetime]:
     end = start + timedelta(days=7)
     return start, end
 
-async def _week_minutes_accumulated(user_id: str) -> int:
-    now = datetime.now(timezone.utc)
-    week_start, week_end = _week_bounds_utc(now)
-    sessions = await db.study_sessions.find(
-        {"user_id": user_id, "completed": True},
-        {"_id": 0, "start_time": 1, "duration": 1}
-    ).to_list(10000)
+# === [ADD] Datas nativas (BSON) em study_sessions / calendar_events ===
+# Documentos antigos guardam ISO string; até `python manage.py migrate-dates` terminar (marca em
+# db.migrations), os filtros de intervalo casam as duas formas. Depois, só datas (índice direto).
+DATES_MIGRATION_ID = "bson_dates"
+_legacy_iso_dates = True
+
+def _date_filter(field: str, **ops: datetime) -> dict:
+    """_date_filter("start_time", gte=a, lt=b) -> filtro que casa Date e, na transição, ISO string."""
+    as_date = {f"${op}": v for op, v in ops.items()}
+    if not _legacy_iso_dates:
+        return {field: as_date}
+    # ISO UTC no mesmo formato: ordem da string = ordem cronológica
+    as_iso = {f"${op}": v.astimezone(timezone.utc).isoformat() for op, v in ops.items()}
+    return {"$or": [{field: as_date}, {field: as_iso}]}
+
+@app.on_event("startup")
+async def _startup_date_mode():
+    global _legacy_iso_dates
+    try:
+        done = await db.migrations.find_one({"_id": DATES_MIGRATION_ID, "done": True}, {"_id": 1})
+    except Exception:
+        done = None
+    _legacy_iso_dates = done is None
+# === [FIM ADD] ===
+
+# === [ADD] Somas de minutos por intervalo (índice user_id+completed+start_time, ver indexes.py) ===
+# sobreposição com o início de uma janela: sessões iniciadas até isso antes ainda contam
+SESSION_LOOKBACK_MIN = int(os.getenv("SESSION_LOOKBACK_MIN", "720"))
+
+def _start_range(lo: datetime, hi: datetime | None = None) -> dict:
+    """Filtro de intervalo [lo, hi) em start_time."""
+    return _date_filter("start_time", gte=lo, **({"lt": hi} if hi is not None else {}))
+
+async def _sum_session_minutes(user_id: str, lo: datetime, hi: datetime | None = None,
+                               subject_id: Optional[str] = None) -> int:
+    """Soma de duration das sessões concluídas com início em [lo, hi), agregada no Mongo."""
+    match = {"user_id": user_id, "completed": True, **_start_range(lo, hi)}
+    if subject_id:
+        match["subject_id"] = subject_id
+    async for row in db.study_sessions.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "minutes": {"$sum": "$duration"}}},
+    ]):
+        return int(row["minutes"] or 0)
+    return 0
+
+async def _overlap_session_minutes(user_id: str, lo: datetime, hi: datetime,
+                                   subject_id: Optional[str] = None) -> int:
+    """Minutos das sessões concluídas dentro de [lo, hi), cortando as que atravessam as bordas."""
+    match = {
+        "user_id": user_id, "completed": True,
+        **_start_range(lo - timedelta(minutes=SESSION_LOOKBACK_MIN), hi),
+    }
+    if subject_id:
+        match["subject_id"] = subject_id
     total = 0
-    for s in sessions:
+    async for s in db.study_sessions.find(match, {"_id": 0, "start_time": 1, "duration": 1}):
         try:
-            st = datetime.fromisoformat(s["start_time"])
-            if week_start <= st < week_end:
-                total += int(s.get("duration", 0))
+            st = _to_aware(s["start_time"])
+            total += _overlap_minutes(lo, hi, st, st + timedelta(minutes=int(s.get("duration", 0))))
         except Exception:
             pass
     return total
+# === [FIM ADD] ===
+
+# === [ADD] Rollups semanais por usuário (db.user_week_rollups) ===
+# Um doc por (user_id, week_id) — o week_id de get_week_bounds — com os contadores das sessões
+# concluídas, atribuídas pelo start_time (mesmo critério de _sum_session_minutes):
+#   minutes, sessions, days.<YYYY-MM-DD>.{minutes,sessions}, subjects.<subject_id>.{minutes,sessions}
+# O /study/end mantém com um $inc. Até `python manage.py rollups rebuild` terminar (marca em
+# db.migrations), as leituras continuam somando as sessões.
+ROLLUPS_MIGRATION_ID = "week_rollups"
+_rollups_ready = False
+rollups_col = db.user_week_rollups
+
+def _rollup_inc(user_id: str, subject_id: Optional[str], start: datetime, minutes: int) -> tuple[dict, dict]:
+    """(filtro, update) que soma uma sessão concluída no rollup da semana do start."""
+    week_start, _, week_id = get_week_bounds(start)
+    day = start.astimezone(timezone.utc).date().isoformat()
+    sid = subject_id or "none"
+    return (
+        {"user_id": user_id, "week_id": week_id},
+        {
+            "$inc": {
+                "minutes": minutes, "sessions": 1,
+                f"days.{day}.minutes": minutes, f"days.{day}.sessions": 1,
+                f"subjects.{sid}.minutes": minutes, f"subjects.{sid}.sessions": 1,
+            },
+            "$setOnInsert": {"week_start": week_start},
+        },
+    )
+
+def _rollup_docs(user_id: str, sessions) -> dict[str, dict]:
+    """Rollups de um usuário a partir das sessões concluídas (rebuild). week_id -> doc."""
+    docs: dict[str, dict] = {}
+    for s in sessions:
+        st = _to_aware(s.get("start_time"))
+        if st is None:
+            continue
+        week_start, _, week_id = get_week_bounds(st)
+        minutes = int(s.get("duration") or 0)
+        day = st.astimezone(timezone.utc).date().isoformat()
+        sid = s.get("subject_id") or "none"
+        d = docs.setdefault(week_id, {"user_id": user_id, "week_id": week_id, "week_start": week_start,
+                                      "minutes": 0, "sessions": 0, "days": {}, "subjects": {}})
+        d["minutes"] += minutes
+        d["sessions"] += 1
+        for bucket, key in (("days", day), ("subjects", sid)):
+            c = d[bucket].setdefault(key, {"minutes": 0, "sessions": 0})
+            c["minutes"] += minutes
+            c["sessions"] += 1
+    return docs
+
+REBUILD_QUIET_SECS = int(os.getenv("REBUILD_QUIET_SECS", "600"))
+
+async def _assert_no_live_study_writes(user_ids: Optional[list[str]] = None):
+    """
+    Rebuilds (rollups, série diária) substituem docs que o /study/end e o /study/sync
+    alimentam com $inc: com escrita no meio, um incremento se perde (o replace passa por cima)
+    ou conta duas vezes (a sessão já estava no snapshot). Recusa se alguma sessão desses
+    usuários terminou/sincronizou nos últimos REBUILD_QUIET_SECS ou ainda tem escrita pendente.
+    """
+    since = datetime.now(timezone.utc) - timedelta(seconds=REBUILD_QUIET_SECS)
+    q = {"$or": [
+        {"end_time": {"$gte": since}},
+        {"synced_at": {"$gte": since}},
+        {"completion.pending.0": {"$exists": True}},
+    ]}
+    if user_ids:
+        q["user_id"] = {"$in": list(user_ids)}
+    if await db.study_sessions.count_documents(q, limit=1):
+        raise RuntimeError(
+            f"sessões encerradas nos últimos {REBUILD_QUIET_SECS}s: pare os servidores "
+            "(ou tire esses usuários do ar) antes do rebuild, ou use --force"
+        )
+
+async def rebuild_week_rollups(user_ids: Optional[list[str]] = None, *, force: bool = False) -> dict:
+    """
+    Regera os rollups a partir do histórico de sessões, um usuário por vez (idempotente).
+    Semanas sem sessão concluída somem. Sem user_ids, refaz todos e marca a migração como feita.
+    Só com as escritas paradas (servidores fora do ar): os ReplaceOne saem de um snapshot das
+    sessões e correm contra os $inc do /study/end e do /study/sync. Sem `force`, recusa se
+    houve sessão encerrada recentemente (_assert_no_live_study_writes).
+    """
+    from pymongo import ReplaceOne
+
+    if not force:
+        await _assert_no_live_study_writes(user_ids)
+    stats = {"users": 0, "weeks": 0}
+
+    async def flush(uid: str, sessions: list[dict]):
+        docs = _rollup_docs(uid, sessions)
+        if docs:
+            await rollups_col.bulk_write(
+                [ReplaceOne({"user_id": uid, "week_id": w}, d, upsert=True) for w, d in docs.items()],
+                ordered=False,
+            )
+        await rollups_col.delete_many({"user_id": uid, "week_id": {"$nin": list(docs)}})
+        stats["users"] += 1
+        stats["weeks"] += len(docs)
+
+    q = {"completed": True}
+    if user_ids:
+        q["user_id"] = {"$in": list(user_ids)}
+    uid, batch = None, []
+    cursor = db.study_sessions.find(q, {"_id": 0, "user_id": 1, "subject_id": 1, "start_time": 1, "duration": 1})
+    async for s in cursor.sort("user_id", 1):
+        if s.get("user_id") != uid:
+            if uid is not None:
+                await flush(uid, batch)
+            uid, batch = s.get("user_id"), []
+        batch.append(s)
+    if uid is not None:
+        await flush(uid, batch)
+
+    if not user_ids:
+        await db.migrations.update_one(
+            {"_id": ROLLUPS_MIGRATION_ID},
+            {"$set": {"done": True, "finished_at": datetime.now(timezone.utc), **stats}},
+            upsert=True,
+        )
+    return stats
+
+async def _week_rollup(user_id: str, now: Optional[datetime] = None) -> Optional[dict]:
+    """Rollup da semana de `now` ({} se não estudou); None enquanto os rollups não estão prontos."""
+    if not _rollups_ready:
+        return None
+    _, _, week_id = get_week_bounds(now or datetime.now(timezone.utc))
+    return await rollups_col.find_one({"user_id": user_id, "week_id": week_id}, {"_id": 0}) or {}
+
+@app.on_event("startup")
+async def _startup_rollups_mode():
+    global _rollups_ready
+    try:
+        done = await db.migrations.find_one({"_id": ROLLUPS_MIGRATION_ID, "done": True}, {"_id": 1})
+    except Exception:
+        done = None
+    _rollups_ready = done is not None
+# === [FIM ADD] ===
+
+# === [ADD] Série diária por usuário/ano (db.user_daily_minutes, ver daily.py) ===
+# Alimenta o heatmap. Até `python manage.py daily backfill` terminar (marca em db.migrations),
+# o endpoint agrupa as sessões do ano na hora.
+DAILY_MIGRATION_ID = "daily_minutes"
+_daily_ready = False
+daily_col = db.user_daily_minutes
+
+async def _daily_inc(user_id: str, start: datetime, minutes: int):
+    year, i = day_index(start)
+    await _daily_add(user_id, year, {i: minutes})
+
+async def _daily_add(user_id: str, year: int, days: dict[int, int]):
+    """Soma minutos em vários dias do mesmo ano (índice do dia -> minutos) num update só."""
+    q = {"user_id": user_id, "year": year}
+    upd = {"$inc": {f"minutes.{i}": m for i, m in days.items()}}
+    if (await daily_col.update_one(q, upd)).matched_count:
+        return
+    # primeiro estudo do ano: cria o array zerado (upsert com $inc criaria objeto, não array)
+    try:
+        await daily_col.insert_one({**q, "minutes": [0] * DAYS})
+    except DuplicateKeyError:
+        pass  # outro request criou junto
+    await daily_col.update_one(q, upd)
+
+async def _sessions_daily(q: dict) -> dict[str, dict[int, list[int]]]:
+    """Sessões concluídas do filtro -> user_id -> ano -> array de 366 (agrupado com numpy)."""
+    starts: dict[str, list] = {}
+    minutes: dict[str, list] = {}
+    async for s in db.study_sessions.find({"completed": True, **q}, {"_id": 0, "user_id": 1, "start_time": 1, "duration": 1}):
+        st = _to_aware(s.get("start_time"))
+        if st is None:
+            continue
+        uid = s.get("user_id")
+        starts.setdefault(uid, []).append(st)
+        minutes.setdefault(uid, []).append(int(s.get("duration") or 0))
+    return {uid: bucket_minutes(starts[uid], minutes[uid]) for uid in starts}
+
+async def backfill_daily_minutes(user_ids: Optional[list[str]] = None, *, force: bool = False) -> dict:
+    """
+    Regera a série a partir das sessões, um usuário por vez (idempotente). Mesma restrição
+    do rebuild dos rollups: só com as escritas paradas (_assert_no_live_study_writes).
+    """
+    from pymongo import ReplaceOne
+
+    if not force:
+        await _assert_no_live_study_writes(user_ids)
+    stats = {"users": 0, "years": 0}
+    if user_ids:
+        uids = list(user_ids)
+    else:
+        uids = sorted(u for u in await db.study_sessions.distinct("user_id", {"completed": True}) if u)
+    for uid in uids:
+        years = (await _sessions_daily({"user_id": uid})).get(uid, {})
+        if years:
+            await daily_col.bulk_write(
+                [ReplaceOne({"user_id": uid, "year": y}, {"user_id": uid, "year": y, "minutes": arr}, upsert=True)
+                 for y, arr in years.items()],
+                ordered=False,
+            )
+        await daily_col.delete_many({"user_id": uid, "year": {"$nin": list(years)}})
+        stats["users"] += 1
+        stats["years"] += len(years)
+
+    if not user_ids:
+        await db.migrations.update_one(
+            {"_id": DAILY_MIGRATION_ID},
+            {"$set": {"done": True, "finished_at": datetime.now(timezone.utc), **stats}},
+            upsert=True,
+        )
+    return stats
+
+async def daily_series(user_id: str, year: int) -> list[int]:
+    """Minutos por dia do ano (365 ou 366 valores)."""
+    if _daily_ready:
+        doc = await daily_col.find_one({"user_id": user_id, "year": year}, {"_id": 0, "minutes": 1})
+        arr = (doc or {}).get("minutes") or [0] * DAYS
+    else:
+        lo = datetime(year, 1, 1, tzinfo=timezone.utc)
+        rows = await _sessions_daily({"user_id": user_id, **_start_range(lo, lo.replace(year=year + 1))})
+        arr = rows.get(user_id, {}).get(year) or [0] * DAYS
+    return [int(m) for m in arr[:days_in_year(year)]]
+
+@app.on_event("startup")
+async def _startup_daily_mode():
+    global _daily_ready
+    try:
+        done = await db.migrations.find_one({"_id": DAILY_MIGRATION_ID, "done": True}, {"_id": 1})
+    except Exception:
+        done = None
+    _daily_ready = done is not None
+# === [FIM ADD] ===
+
+async def _week_minutes_accumulated(user_id: str) -> int:
+    rollup = await _week_rollup(user_id)
+    if rollup is not None:
+        return int(rollup.get("minutes") or 0)
+    now = datetime.now(timezone.utc)
+    week_start, week_end = _week_bounds_utc(now)
+    return await _sum_session_minutes(user_id, week_start, week_end)
 
 def _softcap_multiplier(week_minutes_before: int) -> float:
     # a partir de 900 min/semana, coins pela metade
@@ -975,22 +1658,17 @@ def _apply_mults(value: float, *mults: float) -> int:
         v *= float(m)
     return max(0, int(v // 1))
 
-def _xp_curve_per_level(level: int) -> int:
-    base_xp = 100
-    return int(base_xp * (1.25 ** (level - 1)) + 0.999)
 
-
-def current_user_id(request: Request) -> str:
+async def current_user_id(request: Request) -> str:
     auth = request.headers.get("Authorization", "")
     if auth.startswith("Bearer "):
         return auth.split(" ", 1)[1].strip()
     # como várias rotas de ranking/grupos usam esse helper, aceite cookie também:
-    try:
-        tok = request.cookies.get("session_token")
-        data = jwt.decode(tok, JWT_SECRET, algorithms=["HS256"])
-        return data.get("sub")
-    except Exception:
-        pass
+    tok = request.cookies.get("session_token")
+    if tok:
+        uid = await _resolve_uid(tok)
+        if uid:
+            return uid
     raise HTTPException(status_code=401, detail="unauthorized")
 
 
@@ -1112,23 +1790,9 @@ async def _subject_week_minutes(user_id: str, subject_id: str, until: Optional[d
     """Minutos estudados da matéria nesta semana (segunda 00:00) até 'until' (ou agora)."""
     now = until or datetime.now(timezone.utc)
     week_start, week_end = _week_bounds_utc(now)
-    # limita janela até 'until'
+    # limita janela até 'until'; sessão considerada no intervalo [week_start, hi)
     hi = min(week_end, now)
-    sessions = await db.study_sessions.find(
-        {"user_id": user_id, "completed": True, "subject_id": subject_id},
-        {"_id": 0, "start_time": 1, "duration": 1}
-    ).to_list(10000)
-    total = 0
-    for s in sessions:
-        try:
-            st = datetime.fromisoformat(s["start_time"])
-            dur = int(s.get("duration", 0))
-            # sessão considerada no intervalo [week_start, hi)
-            endt = st + timedelta(minutes=dur)
-            total += _overlap_minutes(week_start, hi, st, endt)
-        except Exception:
-            pass
-    return total
+    return await _overlap_session_minutes(user_id, week_start, hi, subject_id)
 
 async def _effective_minutes_in_window(user_id: str, window_start: datetime, window_end: datetime, subject_id: Optional[str]) -> int:
     """
@@ -1141,21 +1805,7 @@ async def _effective_minutes_in_window(user_id: str, window_start: datetime, win
     break_len = int(cfg.get("break_duration", 10)) if cfg else 10
     factor = (study_len + break_len) / max(1, study_len)
 
-    q = {"user_id": user_id, "completed": True}
-    if subject_id:
-        q["subject_id"] = subject_id
-
-    sessions = await db.study_sessions.find(q, {"_id": 0, "start_time": 1, "duration": 1}).to_list(10000)
-    total = 0
-    for s in sessions:
-        try:
-            st = datetime.fromisoformat(s["start_time"])
-            dur = int(s.get("duration", 0))
-            endt = st + timedelta(minutes=dur)
-            ov = _overlap_minutes(window_start, window_end, st, endt)
-            total += ov
-        except Exception:
-            pass
+    total = await _overlap_session_minutes(user_id, window_start, window_end, subject_id)
     return int(total * factor)
 
 async def _try_autocomplete_events(user_id: str, subject_id: Optional[str], session_start: datetime, session_end: datetime):
@@ -1173,8 +1823,8 @@ async def _try_autocomplete_events(user_id: str, subject_id: Optional[str], sess
         {
             "user_id": user_id,
             "$or": [
-                {"start": {"$lte": we.isoformat()}, "end": {"$gte": ws.isoformat()}},
-                {"start": {"$gte": ws.isoformat(), "$lte": we.isoformat()}},
+                {"$and": [_date_filter("start", lte=we), _date_filter("end", gte=ws)]},
+                _date_filter("start", gte=ws, lte=we),
             ],
         },
         {"_id": 0}
@@ -1184,8 +1834,8 @@ async def _try_autocomplete_events(user_id: str, subject_id: Optional[str], sess
         if ev.get("completed"):
             continue
 
-        ev_start = datetime.fromisoformat(ev["start"])
-        ev_end   = datetime.fromisoformat(ev["end"])
+        ev_start = _to_aware(ev["start"])
+        ev_end   = _to_aware(ev["end"])
         # janela de tolerância do próprio evento
         ev_ws, ev_we = _expand_tolerance(ev_start, ev_end, 60)
 
@@ -1198,10 +1848,11 @@ async def _try_autocomplete_events(user_id: str, subject_id: Optional[str], sess
         rule2_ok = False
         if ev.get("subject_id"):
             # minutos semanais ANTES e DEPOIS, recortando por 'limites' da janela do evento
-            before = await _subject_week_minutes(user_id, ev["subject_id"], until=ev_ws)
-            after  = await _subject_week_minutes(user_id, ev["subject_id"], until=ev_we)
-
-            subj = await db.subjects.find_one({"id": ev["subject_id"], "user_id": user_id}, {"_id": 0, "time_goal": 1})
+            before, after, subj = await asyncio.gather(
+                _subject_week_minutes(user_id, ev["subject_id"], until=ev_ws),
+                _subject_week_minutes(user_id, ev["subject_id"], until=ev_we),
+                db.subjects.find_one({"id": ev["subject_id"], "user_id": user_id}, {"_id": 0, "time_goal": 1}),
+            )
             goal = int(subj.get("time_goal", 0)) if subj else 0
             # atingiu a meta dentro da janela (antes < goal <= depois)
             rule2_ok = (goal > 0 and before < goal <= after)
@@ -1224,25 +1875,327 @@ def get_week_bounds(now: datetime) -> tuple[datetime, datetime, str]:
     week_id = f"{week_start.isocalendar().year}-W{week_start.isocalendar().week:02d}"
     return week_start, week_end, week_id
 
-async def grant_reward(user_id: str, coins: int, xp: int):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not user: 
-        return
-    # reaproveita mesma curva de level do /study/end
-    def calculate_xp_for_level(level:int):
-        base_xp = 100
-        return int(base_xp * (1.25 ** (level - 1)) + 0.999)
-    new_xp = user.get("xp", 0) + max(0, xp)
-    new_level = user.get("level", 1)
-    need = calculate_xp_for_level(new_level)
-    while new_xp >= need:
-        new_xp -= need
-        new_level += 1
-        need = calculate_xp_for_level(new_level)
-    await db.users.update_one(
-        {"id": user_id},
-        {"$inc": {"coins": max(0, coins)}, "$set": {"xp": new_xp, "level": new_level}}
-    )
+# === [ADD] Livro-razão de coins/XP (append-only) + materialização em lote nos usuários ===
+LEDGER_FLUSH_SECS = float(os.getenv("LEDGER_FLUSH_SECS", "2"))
+LEDGER_BATCH_MAX = int(os.getenv("LEDGER_BATCH_MAX", "2000"))      # lançamentos por rodada
+LEDGER_STALE_SECS = float(os.getenv("LEDGER_STALE_SECS", "300"))   # lote preso (worker caiu) é recuperado
+
+
+class Ledger:
+    """
+    Cada recompensa/gasto vira um lançamento em db.ledger ({user_id, coins, xp, reason, ref, key}).
+    Recompensas entram pendentes (um insert, sem tocar no usuário); um loop junta os pendentes
+    por usuário e grava um único $inc/$set no snapshot (users.coins/xp/level), normalmente
+    poucos ms depois do lançamento e no máximo LEDGER_FLUSH_SECS.
+    Gastos que precisam de checagem atômica (compra) continuam no usuário e são lançados
+    já aplicados, só para auditoria. `key` (única) torna o lançamento idempotente.
+
+    Materialização em quatro passos, segura com vários workers e com queda no meio:
+    marca os lançamentos com o id do lote -> update do usuário condicionado ao xp/level lidos
+    e ao lote ainda não aplicado (o lote entra em users.ledger_batches) -> marca os lançamentos
+    do lote como aplicados -> tira o lote de users.ledger_batches. A lista só guarda lotes já
+    no usuário e ainda não fechados nos lançamentos (sem teto: nenhum lote sai dela antes de
+    fechar), então a recuperação de um lote preso sempre sabe se o usuário já o recebeu.
+    Conflito de xp/level (outro worker) só devolve os lançamentos para a próxima rodada.
+    """
+    def __init__(self, entries, users, interval: float, batch_max: int, on_applied=None):
+        self.entries = entries
+        self.users = users
+        self.interval = interval
+        self.batch_max = batch_max
+        self.on_applied = on_applied
+        self._task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+
+    async def record(self, user_id: str, *, coins: int = 0, xp: int = 0, reason: str,
+                     ref: str | None = None, key: str | None = None, applied: bool = False) -> bool:
+        """Um insert. False se `key` já foi lançada (não paga duas vezes)."""
+        now = utcnow()
+        entry = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "coins": int(coins),
+            "xp": int(xp),
+            "reason": reason,
+            "ref": ref,
+            "created_at": now,
+            "applied": applied,
+            "applied_at": now if applied else None,
+            "batch": None,
+        }
+        if key is not None:
+            entry["key"] = key
+        try:
+            await self.entries.insert_one(entry)
+        except DuplicateKeyError:
+            return False
+        if not applied:
+            self._wake.set()
+        return True
+
+    async def record_many(self, user_id: str, items: list[dict], *, reason: str) -> int:
+        """Vários lançamentos num insert_many ({coins, xp, ref, key}); chaves repetidas são puladas."""
+        now = utcnow()
+        entries = [{
+            "id": str(uuid.uuid4()), "user_id": user_id, "coins": int(it.get("coins") or 0),
+            "xp": int(it.get("xp") or 0), "reason": reason, "ref": it.get("ref"), "created_at": now,
+            "applied": False, "applied_at": None, "batch": None,
+            **({"key": it["key"]} if it.get("key") is not None else {}),
+        } for it in items]
+        if not entries:
+            return 0
+        try:
+            inserted = len((await self.entries.insert_many(entries, ordered=False)).inserted_ids)
+        except BulkWriteError as e:
+            inserted = e.details.get("nInserted", 0)
+        if inserted:
+            self._wake.set()
+        return inserted
+
+    async def _settle(self, batch: str, user_ids: list[str]) -> set[str]:
+        """Usuários que já têm o lote aplicado -> lançamentos aplicados; o resto volta a pendente."""
+        done = {
+            u["id"] for u in await self.users.find(
+                {"id": {"$in": user_ids}, "ledger_batches": batch}, {"_id": 0, "id": 1}
+            ).to_list(None)
+        }
+        if done:
+            await self.entries.update_many(
+                {"batch": batch, "user_id": {"$in": list(done)}},
+                {"$set": {"applied": True, "applied_at": utcnow()}},
+            )
+            # só depois de os lançamentos estarem aplicados (cair aqui deixa o lote na lista: inócuo)
+            await self.users.update_many({"id": {"$in": list(done)}}, {"$pull": {"ledger_batches": batch}})
+        await self.entries.update_many(
+            {"batch": batch, "applied": False}, {"$set": {"batch": None}, "$unset": {"claimed_at": ""}})
+        return done
+
+    async def recover(self) -> int:
+        """Fecha lotes de workers que caíram entre os passos (mais velhos que LEDGER_STALE_SECS)."""
+        cutoff = utcnow() - timedelta(seconds=LEDGER_STALE_SECS)
+        stale = await self.entries.find(
+            {"applied": False, "batch": {"$ne": None}, "claimed_at": {"$lt": cutoff}},
+            {"_id": 0, "batch": 1, "user_id": 1},
+        ).to_list(None)
+        by_batch: dict[str, set[str]] = defaultdict(set)
+        for e in stale:
+            by_batch[e["batch"]].add(e["user_id"])
+        for batch, uids in by_batch.items():
+            await self._settle(batch, list(uids))
+        return len(stale)
+
+    async def flush(self) -> int:
+        """Uma rodada de materialização. Devolve quantos lançamentos foram aplicados."""
+        pending = await self.entries.find(
+            {"applied": False, "batch": None}, {"_id": 0, "id": 1},
+        ).sort("created_at", 1).limit(self.batch_max).to_list(self.batch_max)
+        if not pending:
+            return 0
+
+        batch = uuid.uuid4().hex
+        await self.entries.update_many(
+            {"id": {"$in": [e["id"] for e in pending]}, "batch": None},
+            {"$set": {"batch": batch, "claimed_at": utcnow()}},
+        )
+        claimed = await self.entries.find(
+            {"batch": batch}, {"_id": 0, "user_id": 1, "coins": 1, "xp": 1}).to_list(None)
+        if not claimed:
+            return 0   # outro worker pegou tudo
+
+        totals: dict[str, list[int]] = defaultdict(lambda: [0, 0, 0])
+        for e in claimed:
+            t = totals[e["user_id"]]
+            t[0] += int(e.get("coins", 0))
+            t[1] += int(e.get("xp", 0))
+            t[2] += 1
+
+        uids = list(totals)
+        snapshots = {
+            u["id"]: u for u in await self.users.find(
+                {"id": {"$in": uids}}, {"_id": 0, "id": 1, "xp": 1, "level": 1}
+            ).to_list(None)
+        }
+        ops = []
+        for uid, (coins, xp, _) in totals.items():
+            snap = snapshots.get(uid)
+            if snap is None:
+                continue   # usuário apagado: lançamentos ficam pendentes para auditoria
+            new_xp, new_level = level_up(int(snap.get("xp") or 0) + xp, int(snap.get("level") or 1))
+            ops.append(UpdateOne(
+                # xp/level exatamente como lidos (None casa campo ausente): sem lost update
+                {"id": uid, "xp": snap.get("xp"), "level": snap.get("level"), "ledger_batches": {"$ne": batch}},
+                {
+                    "$inc": {"coins": coins},
+                    "$set": {"xp": new_xp, "level": new_level},
+                    "$push": {"ledger_batches": batch},
+                },
+            ))
+        if ops:
+            await self.users.bulk_write(ops, ordered=False)
+
+        done = await self._settle(batch, uids)
+        if self.on_applied is not None:
+            for uid in done:
+                self.on_applied(uid)
+        return sum(totals[uid][2] for uid in done)
+
+    async def _run(self):
+        while True:
+            # acorda no intervalo ou logo após um lançamento pendente; o que chegar
+            # enquanto uma rodada grava entra junto na próxima
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.recover()
+                while await self.flush() >= self.batch_max:
+                    pass
+            except Exception as e:
+                logger.warning(f"ledger flush warn: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"ledger flush warn: {e}")
+
+    # --- offline (manage.py) ---
+    async def _applied_sum(self, user_id: str) -> tuple[int, int, int]:
+        """(nº, coins, xp) dos lançamentos aplicados do usuário."""
+        async for d in self.entries.aggregate([
+            {"$match": {"user_id": user_id, "applied": True}},
+            {"$group": {"_id": None, "n": {"$sum": 1}, "coins": {"$sum": "$coins"}, "xp": {"$sum": "$xp"}}},
+        ]):
+            return int(d["n"]), int(d["coins"]), int(d["xp"])
+        return 0, 0, 0
+
+    async def _drop_settled_markers(self, user_id: str, markers: list[str]) -> bool:
+        """Tira de ledger_batches o que já fechou (queda entre os passos); False se algo está em voo."""
+        settled = []
+        for m in markers:
+            if m.startswith("purchase:"):
+                ok = await self.entries.find_one({"key": m}, {"_id": 1}) is not None
+            else:
+                ok = await self.entries.find_one(
+                    {"batch": m, "user_id": user_id, "applied": False}, {"_id": 1}) is None
+            if ok:
+                settled.append(m)
+        if settled:
+            await self.users.update_one({"id": user_id}, {"$pullAll": {"ledger_batches": settled}})
+        return len(settled) == len(markers)
+
+    async def _quiet_view(self, user_id: str, attempts: int = 5) -> tuple[dict, tuple[int, int, int]] | None:
+        """
+        Snapshot do usuário + soma dos aplicados, coerentes entre si, com o ledger no ar.
+        Tudo que muda o snapshot (lote do flush, compra) põe um marcador em ledger_batches no
+        mesmo update e só o tira depois de o lançamento estar aplicado. Então: snapshot sem
+        marcador e a mesma soma lida antes e depois dele = nada aplicado pela metade no meio.
+        None se o usuário não parou de mexer em `attempts` tentativas.
+        """
+        for _ in range(attempts):
+            before = await self._applied_sum(user_id)
+            snap = await self.users.find_one(
+                {"id": user_id}, {"_id": 0, "id": 1, "coins": 1, "xp": 1, "level": 1, "ledger_batches": 1})
+            if snap is None:
+                return None
+            markers = snap.get("ledger_batches") or []
+            if markers:
+                if not await self._drop_settled_markers(user_id, markers):
+                    await asyncio.sleep(0.05)
+                continue
+            after = await self._applied_sum(user_id)
+            if before == after:
+                return snap, after
+        return None
+
+    async def open_accounts(self, rebase: bool = False) -> dict:
+        """
+        Lançamento de abertura (já aplicado) para usuários de antes do ledger: snapshot atual
+        menos o que já foi aplicado pelo ledger desde o deploy, lidos juntos (_quiet_view), para
+        a auditoria fechar em zero. `rebase` recalcula aberturas já gravadas (ex.: as feitas com
+        o snapshot inteiro). Quem não parou de mexer fica em "busy": rode de novo.
+        """
+        stats = {"opened": 0, "rebased": 0, "busy": 0}
+        async for u in self.users.find({}, {"_id": 0, "id": 1}):
+            uid = u["id"]
+            key = f"opening:{uid}"
+            opening = await self.entries.find_one({"key": key}, {"_id": 0, "id": 1, "coins": 1, "xp": 1})
+            if opening is not None and not rebase:
+                continue
+            view = await self._quiet_view(uid)
+            if view is None:
+                stats["busy"] += 1
+                continue
+            snap, (_, applied_coins, applied_xp) = view
+            coins = int(snap.get("coins") or 0) - applied_coins
+            xp = total_xp(int(snap.get("xp") or 0), int(snap.get("level") or 1)) - applied_xp
+            if opening is None:
+                stats["opened"] += await self.record(uid, coins=coins, xp=xp, reason="opening", key=key, applied=True)
+            else:
+                # a abertura atual já está na soma: ajusta pela diferença
+                coins += int(opening.get("coins") or 0)
+                xp += int(opening.get("xp") or 0)
+                if (coins, xp) != (opening.get("coins"), opening.get("xp")):
+                    await self.entries.update_one({"id": opening["id"]}, {"$set": {"coins": coins, "xp": xp}})
+                    stats["rebased"] += 1
+        return stats
+
+    async def audit(self, fix: bool = False) -> list[dict]:
+        """
+        Compara o snapshot de cada usuário com a soma dos lançamentos aplicados (_quiet_view:
+        seguro com o ledger no ar). Usuário que não parou de mexer vem com "busy" e não é
+        corrigido; `fix` grava condicionado ao snapshot lido.
+        """
+        report = []
+        async for u in self.users.find({}, {"_id": 0, "id": 1}):
+            view = await self._quiet_view(u["id"])
+            if view is None:
+                report.append({"user_id": u["id"], "busy": True})
+                continue
+            snap, (_, ledger_coins, ledger_xp) = view
+            coins = int(snap.get("coins") or 0)
+            total = total_xp(int(snap.get("xp") or 0), int(snap.get("level") or 1))
+            if coins == ledger_coins and total == ledger_xp:
+                continue
+            row = {"user_id": u["id"], "coins": coins, "ledger_coins": ledger_coins,
+                   "xp_total": total, "ledger_xp_total": ledger_xp}
+            report.append(row)
+            if fix:
+                xp, level = split_total(ledger_xp)
+                res = await self.users.update_one(
+                    {"id": u["id"], "coins": snap.get("coins"), "xp": snap.get("xp"), "level": snap.get("level"),
+                     "ledger_batches.0": {"$exists": False}},
+                    {"$set": {"coins": ledger_coins, "xp": xp, "level": level}})
+                row["fixed"] = bool(res.modified_count)
+                if res.modified_count and self.on_applied is not None:
+                    self.on_applied(u["id"])
+        return report
+
+
+ledger = Ledger(db.ledger, db.users, LEDGER_FLUSH_SECS, LEDGER_BATCH_MAX, on_applied=invalidate_user)
+
+@app.on_event("startup")
+async def _startup_ledger():
+    ledger.start()
+# === [FIM ADD] ===
+
+
+async def grant_reward(user_id: str, coins: int, xp: int, key: str | None = None):
+    # só um lançamento no ledger; o saldo do usuário é atualizado pelo loop de materialização
+    await ledger.record(user_id, coins=max(0, coins), xp=max(0, xp), reason="quest", ref=key, key=key)
 
 # >>> NEW: geração/obtenção das quests da semana do usuário
 async def ensure_weekly_quests(user_id: str):
@@ -1354,10 +2307,13 @@ async def get_current_week_quests(user_id: str):
     return doc
 
 # >>> NEW: atualizar progresso após cada estudo
-async def update_weekly_quests_after_study(user_id: str, subject_id: str, duration: int, completed: bool):
+async def update_weekly_quests_after_study(user_id: str, subject_id: str, duration: int, completed: bool,
+                                          session_id: Optional[str] = None):
     doc = await get_current_week_quests(user_id)
     if not doc: 
         return
+    if session_id and session_id in (doc.get("sessions_applied") or []):
+        return  # sessão já contada (job repetido)
 
     quests = doc.get("quests", [])
     changed = False
@@ -1367,15 +2323,7 @@ async def update_weekly_quests_after_study(user_id: str, subject_id: str, durati
     total_goal = sum(s.get("time_goal", 0) for s in subjects) or 1
 
     # minutos acumulados na semana
-    now = datetime.now(timezone.utc)
-    week_start, _, _ = get_week_bounds(now)
-    sessions = await db.study_sessions.find(
-        {"user_id": user_id, "completed": True}, {"_id": 0}
-    ).to_list(10000)
-    week_minutes = sum(
-        s.get("duration", 0) for s in sessions
-        if s.get("start_time") and datetime.fromisoformat(s["start_time"]) >= week_start
-    )
+    week_minutes = await _week_minutes_accumulated(user_id)
 
     for q in quests:
         if q.get("done"): 
@@ -1385,14 +2333,14 @@ async def update_weekly_quests_after_study(user_id: str, subject_id: str, durati
             q["progress"] = min(q["target"], q.get("progress", 0) + max(0, duration))
             if q["progress"] >= q["target"]:
                 q["done"] = True
-                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"])
+                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"], key=f"quest:{user_id}:{doc['week_id']}:{q['qid']}")
                 changed = True
 
         elif q["type"] == "study_sessions_subject" and q.get("subject_id") == subject_id and completed:
             q["progress"] = min(q["target"], q.get("progress", 0) + 1)
             if q["progress"] >= q["target"]:
                 q["done"] = True
-                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"])
+                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"], key=f"quest:{user_id}:{doc['week_id']}:{q['qid']}")
                 changed = True
 
         elif q["type"] == "study_minutes_week":
@@ -1400,7 +2348,7 @@ async def update_weekly_quests_after_study(user_id: str, subject_id: str, durati
             q["progress"] = min(q["target"], week_minutes)
             if q["progress"] >= q["target"]:
                 q["done"] = True
-                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"])
+                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"], key=f"quest:{user_id}:{doc['week_id']}:{q['qid']}")
                 changed = True
 
         elif q["type"] == "complete_cycle":
@@ -1408,14 +2356,48 @@ async def update_weekly_quests_after_study(user_id: str, subject_id: str, durati
             q["progress"] = 1 if cycle_progress >= 100.0 else 0
             if q["progress"] >= q["target"]:
                 q["done"] = True
-                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"])
+                await grant_reward(user_id, q["reward"]["coins"], q["reward"]["xp"], key=f"quest:{user_id}:{doc['week_id']}:{q['qid']}")
                 changed = True
 
-    if changed:
-        await db.weekly_quests.update_one(
-            {"user_id": user_id, "week_id": doc["week_id"]},
-            {"$set": {"quests": quests}}
-        )
+    if changed or session_id:
+        # condicionado à revisão lida: duas sessões do mesmo usuário não se atropelam
+        q = {"user_id": user_id, "week_id": doc["week_id"], "rev": doc.get("rev")}
+        update = {"$set": {"quests": quests}, "$inc": {"rev": 1}}
+        if session_id:
+            q["sessions_applied"] = {"$ne": session_id}
+            update["$push"] = {"sessions_applied": {"$each": [session_id], "$slice": -QUEST_SESSIONS_MEMORY}}
+        res = await db.weekly_quests.update_one(q, update)
+        if not res.matched_count:
+            raise RuntimeError("weekly_quests changed concurrently")  # a fila tenta de novo
+
+QUEST_SESSIONS_MEMORY = 500   # ids de sessão lembrados por semana (dedup do job)
+
+# === [ADD] Fila de jobs (jobs.py): efeitos do /study/end que rodam depois da resposta ===
+JOBS_MODE = os.getenv("JOBS_MODE", "worker").lower()             # worker | inline (testes)
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", "4"))        # jobs simultâneos por processo
+JOBS_LEASE_SECS = float(os.getenv("JOBS_LEASE_SECS", "60"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "5"))
+
+jobs = JobQueue(db.jobs, concurrency=JOBS_CONCURRENCY, lease_secs=JOBS_LEASE_SECS,
+                max_attempts=JOBS_MAX_ATTEMPTS, inline=JOBS_MODE == "inline")
+
+@jobs.handler("calendar_autocomplete")
+async def _job_calendar_autocomplete(user_id: str, subject_id: Optional[str], start: datetime, duration: int):
+    # marcar evento como concluído é idempotente
+    start = _to_aware(start)
+    await _try_autocomplete_events(user_id, subject_id, start, start + timedelta(minutes=duration))
+
+@jobs.handler("weekly_quests")
+async def _job_weekly_quests(user_id: str, session_id: str, subject_id: Optional[str], duration: int, completed: bool):
+    # sessions_applied + chaves do ledger seguram a repetição
+    await update_weekly_quests_after_study(user_id=user_id, subject_id=subject_id, duration=duration,
+                                           completed=completed, session_id=session_id)
+
+@app.on_event("startup")
+async def _startup_jobs():
+    jobs.start()
+# === [FIM ADD] ===
+
 class ReorderSubjectsPayload(BaseModel):
     order: List[str]  # lista de IDs na nova ordem
 # --- Presença ---------------------------------------------------------------
@@ -1474,13 +2456,13 @@ class PingBody(BaseModel):
     interaction: Optional[bool] = False
 
 @api_router.post("/presence/open")
-async def presence_open(request: Request, session_token: Optional[str] = Cookie(None)):
-    me = await get_current_user(request, session_token)
-    doc = await db.users.find_one({"id": me.id}, {"_id": 0}) or {"id": me.id}
+async def presence_open(request: Request, session_token: Optional[str] = Cookie(None), doc: dict = Depends(user_doc("tabs_open"))):
+    me = await get_current_user(request, session_token)  # memoizado no request pelo user_doc
     tabs = max(0, int(doc.get("tabs_open") or 0)) + 1
     now = utcnow()
     updates = {"tabs_open": tabs, "last_activity": now, "last_interaction": now}
-    await db.users.update_one({"id": me.id}, {"$set": updates}, upsert=True)
+    await db.users.update_one({"id": me.id}, {"$set": {"tabs_open": tabs}}, upsert=True)
+    activity_buffer.touch(me.id, last_activity=now, last_interaction=now)
     merged = {**doc, **updates}
     return {"ok": True, "status": _presence_from_fields(merged), "tabs_open": tabs}
 
@@ -1516,15 +2498,31 @@ def blocks_pipeline(match_extra):
         {"$limit": 100}
     ]
 
+def rollup_blocks_pipeline(field: str, match_extra):
+    # mesmo formato do blocks_pipeline, lendo os minutos já somados no rollup
+    return [
+        {"$match": {field: {"$gte": 50}, **match_extra}},
+        {"$project": {"_id": 0, "user_id": 1, "minutes": f"${field}"}},
+        {"$project": {"user_id": 1, "minutes": 1, "blocks": {"$floor": {"$divide": ["$minutes", 50]}}}},
+        {"$sort": {"blocks": -1, "minutes": -1}},
+        {"$limit": 100}
+    ]
+
+async def _ranking_rows(period: str, match_extra=None) -> list[dict]:
+    """Top 100 por blocos no período. Dia/semana saem dos rollups; mês/total das sessões."""
+    match_extra = match_extra or {}
+    if _rollups_ready and period in ("day", "week"):
+        now = datetime.now(timezone.utc)
+        _, _, week_id = get_week_bounds(now)
+        field = "minutes" if period == "week" else f"days.{now.date().isoformat()}.minutes"
+        return [r async for r in rollups_col.aggregate(rollup_blocks_pipeline(field, {"week_id": week_id, **match_extra}))]
+    start, end = period_bounds(period)
+    return [r async for r in sessions_col.aggregate(blocks_pipeline({**_date_filter("start_time", gte=start, lte=end), **match_extra}))]
+
 @api_router.get("/rankings/global", tags=["rankings"])
 async def rk_global(period: str = "week"):
-    start, end = period_bounds(period)
-    # Converte para ISO string para comparação com start_time (armazenado como string)
-    start_iso = start.isoformat()
-    end_iso = end.isoformat()
-    cur = sessions_col.aggregate(blocks_pipeline({"start_time":{"$gte": start_iso, "$lte": end_iso}}))
     out = []
-    async for r in cur:
+    for r in await _ranking_rows(period):
         u = await users_col.find_one({"id": r["user_id"]}, {"name":1,"nickname":1,"tag":1, "_id":0})
         handle = f'{u["nickname"]}#{u["tag"]}' if u and u.get("nickname") and u.get("tag") else ""
         out.append({"id": r["user_id"], "handle": handle, "name": (u or {}).get("name",""),
@@ -1533,20 +2531,15 @@ async def rk_global(period: str = "week"):
 
 @api_router.get("/rankings/friends", tags=["rankings"])
 async def rk_friends(period: str = "week", request: Request = None):
-    uid = current_user_id(request)
-    start, end = period_bounds(period)
-    start_iso = start.isoformat()
-    end_iso = end.isoformat()
+    uid = await current_user_id(request)
     friends_col = db["friendships"]
     friends = set()
     async for fr in friends_col.find({"$or":[{"a": uid},{"b": uid}], "status":"accepted"}):
         other = fr["b"] if fr["a"] == uid else fr["a"]
         friends.add(other)
     if not friends: return []
-    cur = sessions_col.aggregate(blocks_pipeline({"start_time":{"$gte": start_iso, "$lte": end_iso},
-                                                  "user_id": {"$in": list(friends)}}))
     out = []
-    async for r in cur:
+    for r in await _ranking_rows(period, {"user_id": {"$in": list(friends)}}):
         u = await users_col.find_one({"id": r["user_id"]}, {"name":1,"nickname":1,"tag":1, "_id":0})
         handle = f'{u["nickname"]}#{u["tag"]}' if u and u.get("nickname") and u.get("tag") else ""
         out.append({"id": r["user_id"], "handle": handle, "name": (u or {}).get("name",""),
@@ -1555,10 +2548,7 @@ async def rk_friends(period: str = "week", request: Request = None):
 
 @api_router.get("/rankings/groups", tags=["rankings"])
 async def rk_groups(period: str = "week"):
-    start, end = period_bounds(period)
-    start_iso = start.isoformat()
-    end_iso = end.isoformat()
-    tmp = [r async for r in sessions_col.aggregate(blocks_pipeline({"start_time":{"$gte": start_iso, "$lte": end_iso}}))]
+    tmp = await _ranking_rows(period)
     if not tmp: return []
     agg = {}
     for r in tmp:
@@ -1580,14 +2570,10 @@ async def rk_groups(period: str = "week"):
 
 @api_router.get("/rankings/groups/{group_id}", tags=["rankings"])
 async def rk_inside_group(group_id: str, period: str = "week"):
-    start, end = period_bounds(period)
-    start_iso = start.isoformat()
-    end_iso = end.isoformat()
     uids = [m["user_id"] async for m in group_members_col.find({"group_id": group_id}, {"user_id":1,"_id":0})]
     if not uids: return []
-    cur = sessions_col.aggregate(blocks_pipeline({"start_time":{"$gte": start_iso, "$lte": end_iso}, "user_id":{"$in": uids}}))
     out = []
-    async for r in cur:
+    for r in await _ranking_rows(period, {"user_id": {"$in": uids}}):
         u = await users_col.find_one({"id": r["user_id"]}, {"name":1,"nickname":1,"tag":1, "_id":0})
         handle = f'{u["nickname"]}#{u["tag"]}' if u and u.get("nickname") and u.get("tag") else ""
         out.append({"id": r["user_id"], "handle": handle, "name": (u or {}).get("name",""),
@@ -1605,7 +2591,7 @@ def _new_invite():
 
 @api_router.post("/groups", tags=["groups"], status_code=201, response_model=GroupOut)
 async def groups_create(payload: GroupCreate, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
 
     name = (payload.name or "").strip()
     if not name:
@@ -1673,7 +2659,7 @@ async def groups_create(payload: GroupCreate, request: Request):
 
 @api_router.get("/groups/mine", tags=["groups"])
 async def my_groups(request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
 
     pipeline = [
         {"$match": {"user_id": uid}},
@@ -1750,7 +2736,7 @@ async def groups_info(group_id: str, request: Request):
 
 @api_router.post("/groups/join", tags=["groups"])
 async def groups_join(payload: InviteJoin, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     g = await groups_col.find_one({"invite_code": payload.invite_code})
     if not g:
         raise HTTPException(404, "Convite inválido")
@@ -1770,13 +2756,13 @@ async def groups_join(payload: InviteJoin, request: Request):
 
 @api_router.post("/groups/leave", tags=["groups"])
 async def groups_leave(payload: GroupLeave, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await group_members_col.delete_one({"group_id": payload.group_id, "user_id": uid})
     return {"ok": True}
 
 @api_router.patch("/groups/{group_id}", tags=["groups"])
 async def groups_update(group_id: str, payload: GroupUpdate, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     upd = {k:v for k,v in payload.dict(exclude_unset=True).items()}
     if not upd: return {"ok": True}
@@ -1785,7 +2771,7 @@ async def groups_update(group_id: str, payload: GroupUpdate, request: Request):
 
 @api_router.post("/groups/{group_id}/invite/regenerate", tags=["groups"])
 async def groups_invite_regen(group_id: str, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     code = secrets.token_urlsafe(6).replace("_","").lower()
     await groups_col.update_one({"_id": ObjectId(group_id)}, {"$set": {"invite_code": code}})
@@ -1794,7 +2780,7 @@ async def groups_invite_regen(group_id: str, request: Request):
 # pedidos de entrada (para grupos privados)
 @api_router.get("/groups/{group_id}/join-requests", tags=["groups"])
 async def groups_join_requests(group_id: str, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     out = []
     async for r in group_join_col.find({"group_id": group_id, "status":"pending"}):
@@ -1803,7 +2789,7 @@ async def groups_join_requests(group_id: str, request: Request):
 
 @api_router.post("/groups/{group_id}/join-requests/accept", tags=["groups"])
 async def groups_join_accept(group_id: str, user_id: str = Body(...), request: Request = None):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     await group_join_col.update_one({"group_id": group_id, "user_id": user_id}, {"$set":{"status":"accepted"}})
     if not (await group_members_col.find_one({"group_id": group_id, "user_id": user_id})):
@@ -1812,7 +2798,7 @@ async def groups_join_accept(group_id: str, user_id: str = Body(...), request: R
 
 @api_router.post("/groups/{group_id}/join-requests/reject", tags=["groups"])
 async def groups_join_reject(group_id: str, user_id: str = Body(...), request: Request = None):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     await group_join_col.update_one({"group_id": group_id, "user_id": user_id}, {"$set":{"status":"rejected"}})
     return {"ok": True}
@@ -1820,14 +2806,14 @@ async def groups_join_reject(group_id: str, user_id: str = Body(...), request: R
 # gerir membros
 @api_router.post("/groups/{group_id}/members/role", tags=["groups"])
 async def groups_member_role(group_id: str, payload: MemberRoleChange, request: Request):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     await group_members_col.update_one({"group_id": group_id, "user_id": payload.user_id}, {"$set":{"role": payload.role}})
     return {"ok": True}
 
 @api_router.post("/groups/{group_id}/members/kick", tags=["groups"])
 async def groups_member_kick(group_id: str, user_id: str = Body(...), request: Request = None):
-    uid = current_user_id(request)
+    uid = await current_user_id(request)
     await ensure_admin(group_id, uid)
     await group_members_col.delete_one({"group_id": group_id, "user_id": user_id})
     return {"ok": True}
@@ -1838,13 +2824,11 @@ async def groups_member_kick(group_id: str, user_id: str = Body(...), request: R
 @api_router.post("/presence/ping")
 async def presence_ping(payload: dict, user = Depends(require_user)):
     me = user  # user já foi retornado pelo Depends(require_user)
-    doc = await db.users.find_one({"id": me.id}, {"_id": 0}) or {"id": me.id}
     now = utcnow()
     updates = {"last_activity": now}
     if payload.get("interaction"):
         updates["last_interaction"] = now
-    await db.users.update_one({"id": me.id}, {"$set": updates}, upsert=True)
-    merged = {**doc, **updates}
+    activity_buffer.touch(me.id, **updates)
     return {"ok": True}
 
 
@@ -1980,13 +2964,11 @@ async def friends_list(request: Request, session_token: Optional[str] = Cookie(N
 
 
 @api_router.post("/presence/leave")
-async def presence_leave(payload: dict, user = Depends(require_user)):
+async def presence_leave(payload: dict, user = Depends(require_user), doc: dict = Depends(user_doc("tabs_open"))):
     me = user  # user já foi retornado pelo Depends(require_user)
-    doc = await db.users.find_one({"id": me.id}, {"_id": 0}) or {"id": me.id}
     tabs = max(0, int(doc.get("tabs_open") or 0) - 1)
-    updates = {"tabs_open": tabs, "last_activity": utcnow()}
-    await db.users.update_one({"id": me.id}, {"$set": updates}, upsert=True)
-    merged = {**doc, **updates}
+    await db.users.update_one({"id": me.id}, {"$set": {"tabs_open": tabs}}, upsert=True)
+    activity_buffer.touch(me.id, last_activity=utcnow())
     return {"ok": True}
 
 
@@ -2063,6 +3045,7 @@ async def create_or_update_nickname(input: NicknameTagCreate, request: Request,
             "last_nickname_change": datetime.now(timezone.utc).isoformat()
         }}
     )
+    invalidate_user(user.id)
     
     return {"success": True, "nickname": input.nickname, "tag": input.tag}
 
@@ -2177,16 +3160,13 @@ async def start_study_session(input: StudySessionStart, request: Request, sessio
         subject_id=input.subject_id,
         start_time=datetime.now(timezone.utc)
     )
-    session_dict = session.model_dump()
-    session_dict["start_time"] = session_dict["start_time"].isoformat()
-    if session_dict.get("end_time"):
-        session_dict["end_time"] = session_dict["end_time"].isoformat()
-
+    session_dict = session.model_dump()   # start_time/end_time ficam como datas nativas
     await db.study_sessions.insert_one(session_dict)
 
     # status online + snapshot do que está estudando (ESTE BLOCO TEM QUE FICAR DENTRO DA FUNÇÃO!)
     block_minutes = await _get_user_settings_minutes(user.id)
-    est_end = datetime.now(timezone.utc) + timedelta(minutes=block_minutes)
+    now = datetime.now(timezone.utc)
+    est_end = now + timedelta(minutes=block_minutes)
 
     await db.users.update_one(
     {"id": user.id},
@@ -2195,12 +3175,14 @@ async def start_study_session(input: StudySessionStart, request: Request, sessio
         "active_session": {
             "session_id": session.id,
             "subject_id": input.subject_id,
-            "start_time": session_dict["start_time"],
+            "start_time": session.start_time.isoformat(),
             "estimated_end": est_end.isoformat(),
+            "expires_at": _active_expiry("focus", est_end, now),
             "timer": {
                 "state": "focus",
                 "phase_until": est_end.isoformat(),
                 "seconds_left": int(block_minutes * 60),
+                "updated_at": now,
             }
         }
     }},
@@ -2213,118 +3195,646 @@ async def start_study_session(input: StudySessionStart, request: Request, sessio
 
 
 @api_router.post("/study/end")
-async def end_study_session(input: StudySessionEnd, request: Request, session_token: Optional[str] = Cookie(None)):
+async def end_study_session(
+    input: StudySessionEnd,
+    request: Request,
+    session_token: Optional[str] = Cookie(None),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=128),
+):
     user = await get_current_user(request, session_token)
+    if idempotency_key and not input.idempotency_key:
+        input.idempotency_key = idempotency_key
+    return await complete_study_session(user.id, input)
+
+
+async def _logged(label: str, coro):
+    # efeito colateral opcional: falha vira warning, não derruba o /study/end
+    try:
+        await coro
+    except Exception as e:
+        logger.warning(f"{label} warning: {e}")
+
+
+def _stored_completion(session: dict, key: str | None) -> dict:
+    """
+    Resposta de uma sessão que já foi encerrada (retry, clique duplo, duas abas): devolve o
+    resultado gravado sem recalcular. Chave diferente da gravada = outro encerramento -> 409.
+    """
+    done = session.get("completion") or {}
+    if key and done.get("key") and key != done["key"]:
+        raise HTTPException(status_code=409, detail="Session already ended")
+    result = done.get("result") or {   # sessões encerradas antes de existir `completion`
+        "ok": True,
+        "session_id": session["id"],
+        "coins_earned": int(session.get("coins_earned") or 0),
+        "xp_earned": int(session.get("xp_earned") or 0),
+        "skipped": bool(session.get("skipped")),
+    }
+    return {**result, "replayed": True}
+
+
+def _completion_steps(user_id: str, session_id: str, apply: dict, *, replay: bool = False) -> dict:
+    """
+    Escritas de um encerramento, por nome -> fábrica de corrotina. `apply` é o que fica gravado
+    em completion.apply, então a mesma lista serve para o request original e para o retry.
+    Os $inc (matéria, rollup, série diária) não são idempotentes: só rodam de novo os passos
+    que ficaram em completion.pending. O ledger já é (chave session:<id>).
+    """
+    subject_id, st, duration = apply.get("subject_id"), _to_aware(apply["start"]), apply["duration"]
+    skipped, coins, xp, streak_set = apply["skipped"], apply["coins"], apply["xp"], apply.get("streak_set")
+
+    async def user_step():
+        if not replay:
+            update = {"$unset": {"active_session": ""}}   # limpa o estado de sessão ativa
+            if streak_set:
+                update["$set"] = streak_set
+            await db.users.update_one({"id": user_id}, update)
+            return
+        # retry: a active_session pode já ser de outra sessão
+        await asyncio.gather(
+            db.users.update_one({"id": user_id}, {"$set": streak_set}) if streak_set else asyncio.sleep(0),
+            db.users.update_one({"id": user_id, "active_session.session_id": session_id},
+                                {"$unset": {"active_session": ""}}),
+        )
+
+    steps = {"user": user_step}
+    if subject_id:
+        steps["subject"] = lambda: db.subjects.update_one(
+            {"id": subject_id, "user_id": user_id},
+            {
+                "$inc": {"time_spent": 0 if skipped else duration, "sessions_count": (0 if skipped else 1)},
+                "$setOnInsert": {"created_at": apply["created_at"]},
+            },
+            upsert=True,
+        )
+    if not skipped:
+        steps["rollup"] = lambda: rollups_col.update_one(*_rollup_inc(user_id, subject_id, st, duration), upsert=True)
+        steps["daily"] = lambda: _daily_inc(user_id, st, duration)
+    if coins or xp:
+        # coins/xp/level: lançamento no ledger, materializado em lote
+        steps["ledger"] = lambda: ledger.record(user_id, coins=coins, xp=xp, reason="study_session",
+                                                ref=session_id, key=f"session:{session_id}")
+    return steps
+
+
+COMPLETION_LEASE_SECS = 60   # quem está gravando o encerramento; vencido (processo caiu), um retry assume
+
+async def _run_completion_steps(session_id: str | list[str], steps: dict) -> list[str]:
+    """
+    Roda os passos juntos; tira de completion.pending os que deram certo e solta o lease.
+    Devolve os que falharam. Lista de ids: passos em lote do /study/sync, valendo para todas.
+    """
+    ids = [session_id] if isinstance(session_id, str) else list(session_id)
+    names = list(steps)
+    results = await asyncio.gather(*(steps[n]() for n in names), return_exceptions=True)
+    failed = []
+    for name, res in zip(names, results):
+        if isinstance(res, Exception):
+            logger.warning(f"study end {ids[0]}{'…' if len(ids) > 1 else ''} step {name} warn: {res}")
+            failed.append(name)
+    await db.study_sessions.update_many({"id": {"$in": ids}}, {
+        "$pullAll": {"completion.pending": [n for n in names if n not in failed]},
+        "$set": {"completion.lease_until": None},
+    })
+    return failed
+
+
+async def _enqueue_followups(user_id: str, session_id: str, apply: dict):
+    # agenda (±1h) e quests semanais: fila de jobs, rodam depois da resposta (chaves: sem duplicar)
+    # apply["quests"] False: bloco sincronizado de uma semana passada, não conta para as quests
+    subject_id, duration = apply.get("subject_id"), apply["duration"]
+    await asyncio.gather(
+        _logged("enqueue calendar_autocomplete", jobs.enqueue(
+            "calendar_autocomplete", {"user_id": user_id, "subject_id": subject_id,
+                                      "start": _to_aware(apply["start"]), "duration": duration},
+            key=f"calendar:{session_id}")),
+        _logged("enqueue weekly_quests", jobs.enqueue(
+            "weekly_quests", {"user_id": user_id, "session_id": session_id, "subject_id": subject_id,
+                              "duration": duration, "completed": not apply["skipped"]},
+            key=f"quests:{session_id}")) if apply.get("quests", True) else asyncio.sleep(0),
+    )
 
-    # Busca a sessão
-    session = await db.study_sessions.find_one({"id": input.session_id, "user_id": user.id})
+
+_INCOMPLETE = "Session ended but not fully saved; retry"
+
+async def _replay_completion(user_id: str, session: dict, key: str | None) -> dict:
+    """
+    Sessão já encerrada: devolve o resultado gravado e, se algum passo do encerramento
+    falhou (completion.pending), roda de novo só esses. Os passos só rodam com o lease
+    (completion.lease_until) livre ou vencido: um clique duplo não refaz o que o request
+    original ainda está gravando, e dois retries ao mesmo tempo não refazem o mesmo $inc.
+    """
+    result = _stored_completion(session, key)
+    done = session.get("completion") or {}
+    pending = done.get("pending")
+    if not pending or not done.get("apply"):
+        return result
+    now = utcnow()
+    claim = await db.study_sessions.update_one(
+        {"id": session["id"], "user_id": user_id, "completion.pending": pending,
+         "$or": [{"completion.lease_until": None}, {"completion.lease_until": {"$lt": now}}]},
+        {"$set": {"completion.lease_until": now + timedelta(seconds=COMPLETION_LEASE_SECS)}},
+    )
+    if claim.modified_count == 0:
+        return result
+    steps = _completion_steps(user_id, session["id"], done["apply"], replay=True)
+    if await _run_completion_steps(session["id"], {n: steps[n] for n in pending if n in steps}):
+        raise HTTPException(status_code=503, detail=_INCOMPLETE)
+    await _enqueue_followups(user_id, session["id"], done["apply"])
+    return result
+
+
+async def complete_study_session(user_id: str, input: StudySessionEnd) -> dict:
+    """
+    Fecha a sessão em três etapas; dentro de cada uma as idas ao Mongo são independentes
+    e rodam juntas (asyncio.gather):
+      1. leituras: sessão, settings, minutos da semana, streak do usuário
+      2. escritas: a sessão passa de aberta (end_time nulo) para encerrada num
+         find_one_and_update condicional; só quem ganha a transição grava usuário (streak +
+         active_session num update só), matéria e ledger
+      3. agenda e quests viram jobs (jobs.py): rodam depois da resposta, com retry
+    Encerrar de novo a mesma sessão devolve o resultado gravado (_replay_completion). Se
+    alguma escrita da etapa 2 falhar, a resposta é 503 e o retry refaz só os passos pendentes.
+    """
+    duration = max(0, int(input.duration))
+    studied = duration if not input.skipped else 0
+    key = input.idempotency_key or None
+
+    # --- 1. leituras ---
+    session, block_minutes, week_before, u = await asyncio.gather(
+        db.study_sessions.find_one(
+            {"id": input.session_id, "user_id": user_id},
+            {"_id": 0, "id": 1, "subject_id": 1, "start_time": 1, "end_time": 1,
+             "coins_earned": 1, "xp_earned": 1, "skipped": 1, "completion": 1},
+        ),
+        _get_user_settings_minutes(user_id),
+        _week_minutes_accumulated(user_id),
+        db.users.find_one({"id": user_id}, {"_id": 0, "last_streak_date": 1, "streak_days": 1}),
+    )
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
+    if session.get("end_time") is not None:
+        return await _replay_completion(user_id, session, key)
 
     # --- NOVA FÓRMULA DE RECOMPENSAS ---
-    duration = max(0, int(input.duration))
-    block_minutes = await _get_user_settings_minutes(user.id)
-
-    week_before   = await _week_minutes_accumulated(user.id)
+    streak_days, streak_set = _next_streak(u, studied)
     fatigue_mult  = _fatigue_multiplier(duration)
     completion_mult = _completion_multiplier(duration, block_minutes, input.skipped)
-    streak_days   = await _update_and_get_streak(user.id, duration if not input.skipped else 0)
     streak_mult   = _streak_multiplier(streak_days)
     softcap_mult  = _softcap_multiplier(week_before)
 
-    coins_base = _coins_raw(duration)
-    xp_base    = _session_xp_raw(duration, block_minutes)
+    coins = int(_apply_mults(_coins_raw(duration), completion_mult, fatigue_mult, streak_mult, softcap_mult))
+    xp    = int(_apply_mults(_session_xp_raw(duration, block_minutes), completion_mult, fatigue_mult, streak_mult))
+    # --- FIM NOVA FÓRMULA ---
 
-    coins = _apply_mults(coins_base, completion_mult, fatigue_mult, streak_mult, softcap_mult)
-    xp    = _apply_mults(xp_base,    completion_mult, fatigue_mult, streak_mult)
+    result = {
+        "ok": True,
+        "session_id": input.session_id,
+        "coins_earned": coins,
+        "xp_earned": xp,
+        "skipped": bool(input.skipped),
+    }
 
-    # Atualiza sessão
-    await db.study_sessions.update_one(
-        {"id": input.session_id},
+    # --- 2. escritas ---
+    sid = input.session_id
+    now = datetime.now(timezone.utc)
+    st = _to_aware(session.get("start_time")) or now - timedelta(minutes=duration)
+    apply = {
+        "subject_id": session.get("subject_id"), "start": st, "duration": duration,
+        "skipped": bool(input.skipped), "coins": coins, "xp": xp, "streak_set": streak_set,
+        "created_at": now.isoformat(),
+    }
+    steps = _completion_steps(user_id, sid, apply)
+    claimed = await db.study_sessions.find_one_and_update(
+        {"id": sid, "user_id": user_id, "end_time": None},
         {"$set": {
-            "end_time": datetime.now(timezone.utc).isoformat(),
+            "end_time": now,
             "duration": duration,
             "completed": not input.skipped,
             "skipped": input.skipped,
-            "coins_earned": int(coins),
-            "xp_earned": int(xp)
-        }}
+            "coins_earned": coins,
+            "xp_earned": xp,
+            # pending: passos ainda não gravados; esvazia conforme dão certo
+            "completion": {"key": key, "result": result, "apply": apply, "pending": list(steps),
+                           "lease_until": now + timedelta(seconds=COMPLETION_LEASE_SECS)},
+        }},
+        projection={"_id": 1},
     )
+    if claimed is None:
+        # outro request encerrou a sessão entre a leitura e aqui
+        session = await db.study_sessions.find_one({"id": sid, "user_id": user_id}, {"_id": 0})
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        return await _replay_completion(user_id, session, key)
 
-    # limpar estado de sessão ativa do usuário (ATENÇÃO À INDENTAÇÃO)
-    await db.users.update_one(
-        {"id": user.id},
-        {"$unset": {"active_session": ""}}
-    )
-    # --- FIM NOVA FÓRMULA ---
+    if await _run_completion_steps(sid, steps):
+        raise HTTPException(status_code=503, detail=_INCOMPLETE)
 
-    # Auto-completar eventos de agenda (±1h)
-    subject_id = session.get("subject_id")
-    try:
-        st_iso = session.get("start_time")
-        st = datetime.fromisoformat(st_iso) if st_iso else datetime.now(timezone.utc) - timedelta(minutes=duration)
-        en = st + timedelta(minutes=duration)
-        await _try_autocomplete_events(user.id, subject_id, st, en)
-    except Exception as _e:
-        logger.warning(f"calendar autocompletion warn: {_e}")
-
-    # Atualiza a matéria
-    if subject_id:
-        await db.subjects.update_one(
-            {"id": subject_id, "user_id": user.id},
-            {
-                "$inc": {
-                    "time_spent": (duration if not input.skipped else 0),
-                    "sessions_count": (0 if input.skipped else 1),
-                },
-                "$setOnInsert": {"created_at": datetime.now(timezone.utc).isoformat()}
-            },
-            upsert=True
-        )
+    # --- 3. agenda (±1h) e quests semanais: fila de jobs, rodam depois da resposta ---
+    await _enqueue_followups(user_id, sid, apply)
+    return result
+
+
+
+
+
+
+# === [ADD] /study/sync: blocos concluídos offline, enviados em lote ===
+# O timer roda no cliente; sem rede, os blocos ficam guardados lá (id gerado no cliente) e
+# sobem juntos. Validação, recompensas e escritas são em lote: uma leitura de matérias/
+# sessões/settings, um insert_many, um update no usuário (streak) e um insert_many no ledger.
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depende do ambiente
+    np = None
+
+SYNC_MAX_BLOCKS = int(os.getenv("SYNC_MAX_BLOCKS", "100"))
+SYNC_MAX_AGE_DAYS = int(os.getenv("SYNC_MAX_AGE_DAYS", "14"))          # blocos mais velhos são recusados
+SYNC_MAX_BLOCK_MINUTES = int(os.getenv("SYNC_MAX_BLOCK_MINUTES", "240"))
+SYNC_CLOCK_SKEW_SECS = 300                                              # relógio do cliente adiantado
+
+class SyncBlock(BaseModel):
+    id: str = Field(..., min_length=8, max_length=64)    # gerado no cliente; vira o id da sessão
+    subject_id: str
+    start_time: datetime
+    duration: int = Field(..., ge=0, le=SYNC_MAX_BLOCK_MINUTES)
+    skipped: bool = False
+
+class StudySyncPayload(BaseModel):
+    blocks: List[SyncBlock] = Field(..., min_length=1, max_length=SYNC_MAX_BLOCKS)
+
+
+def _batch_rewards(durations, skipped, block_minutes: int, week_before, streaks) -> tuple[list[int], list[int]]:
+    """
+    Mesma fórmula do /study/end para N blocos de uma vez: bases e multiplicadores vêm dos
+    helpers de sempre, e o produto/piso é vetorizado (mesma ordem de multiplicação de
+    _apply_mults, então o resultado é idêntico).
+    """
+    coins_base = [_coins_raw(d) for d in durations]
+    xp_base = [_session_xp_raw(d, block_minutes) for d in durations]
+    completion = [_completion_multiplier(d, block_minutes, sk) for d, sk in zip(durations, skipped)]
+    fatigue = [_fatigue_multiplier(d) for d in durations]
+    streak = [_streak_multiplier(st) for st in streaks]
+    softcap = [_softcap_multiplier(w) for w in week_before]
+    if np is None:
+        coins = [_apply_mults(*row) for row in zip(coins_base, completion, fatigue, streak, softcap)]
+        xp = [_apply_mults(*row) for row in zip(xp_base, completion, fatigue, streak)]
+        return coins, xp
+    f = lambda v: np.asarray(v, dtype=np.float64)
+    coins = f(coins_base) * f(completion) * f(fatigue) * f(streak) * f(softcap)
+    xp = f(xp_base) * f(completion) * f(fatigue) * f(streak)
+    to_int = lambda a: np.maximum(np.floor(a), 0).astype(np.int64).tolist()
+    return to_int(coins), to_int(xp)
+
+
+def _merge_incs(updates: list[tuple[dict, dict]]) -> list[tuple[dict, dict]]:
+    """Junta updates com o mesmo filtro somando os $inc (rollups da mesma semana)."""
+    merged: dict[tuple, tuple[dict, dict]] = {}
+    for q, upd in updates:
+        k = tuple(sorted(q.items()))
+        if k not in merged:
+            merged[k] = (q, {"$inc": dict(upd["$inc"]), **{op: v for op, v in upd.items() if op != "$inc"}})
+            continue
+        inc = merged[k][1]["$inc"]
+        for field, n in upd["$inc"].items():
+            inc[field] = inc.get(field, 0) + n
+    return list(merged.values())
 
-    # Atualiza usuário (coins/xp/level)
-    if coins or xp:
-        udoc = await db.users.find_one({"id": user.id}, {"_id": 0}) or {"id": user.id, "coins": 0, "xp": 0, "level": 1}
-        new_xp   = int(udoc.get("xp", 0)) + int(xp)
-        new_lvl  = int(udoc.get("level", 1))
-        need_xp  = _xp_curve_per_level(new_lvl)
-        while new_xp >= need_xp:
-            new_xp -= need_xp
-            new_lvl += 1
-            need_xp  = _xp_curve_per_level(new_lvl)
-
-        await db.users.update_one(
-            {"id": user.id},
-            {
-                "$inc": {"coins": int(coins)},
-                "$set": {"xp": int(new_xp), "level": int(new_lvl)}
-            },
-            upsert=True
-        )
 
-    # Atualiza quests semanais
+@api_router.post("/study/sync")
+async def sync_study_blocks(payload: StudySyncPayload, request: Request, session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(request, session_token)
+    uid = user.id
+    now = datetime.now(timezone.utc)
+    blocks = sorted(payload.blocks, key=lambda b: _to_aware(b.start_time))
+    results: dict[str, dict] = {}
+
+    def reject(b: SyncBlock, reason: str):
+        results[b.id] = {"id": b.id, "status": "rejected", "reason": reason}
+
+    # --- validação local ---
+    seen, candidates = set(), []
+    oldest = now - timedelta(days=SYNC_MAX_AGE_DAYS)
+    for b in blocks:
+        st = _to_aware(b.start_time)
+        if b.id in seen:
+            continue   # mesmo bloco repetido no lote: conta uma vez
+        if st + timedelta(minutes=b.duration) > now + timedelta(seconds=SYNC_CLOCK_SKEW_SECS):
+            reject(b, "ends in the future")
+        elif st < oldest:
+            reject(b, "too old")
+        else:
+            candidates.append(b)
+        seen.add(b.id)
+
+    # --- validação contra o banco: uma ida para cada coisa, em paralelo ---
+    ids = [b.id for b in candidates]
+    lo = min((_to_aware(b.start_time) for b in candidates), default=now) - timedelta(minutes=SESSION_LOOKBACK_MIN)
+    hi = max((_to_aware(b.start_time) + timedelta(minutes=b.duration) for b in candidates), default=now)
+    subject_ids = list({b.subject_id for b in candidates})
+    existing, owned_subjects, around, block_minutes, u = await asyncio.gather(
+        db.study_sessions.find({"id": {"$in": ids}}, {"_id": 0}).to_list(None),
+        db.subjects.distinct("id", {"user_id": uid, "id": {"$in": subject_ids}}),
+        db.study_sessions.find(
+            {"user_id": uid, "duration": {"$gt": 0}, **_start_range(lo, hi)},
+            {"_id": 0, "id": 1, "start_time": 1, "duration": 1},
+        ).to_list(None),
+        _get_user_settings_minutes(uid),
+        db.users.find_one({"id": uid}, {"_id": 0, "last_streak_date": 1, "streak_days": 1}),
+    )
+    existing = {s["id"]: s for s in existing}
+    owned_subjects = set(owned_subjects)
+    # inclui as sessões de blocos deste lote já sincronizados antes (reenvio não abre brecha)
+    busy = sorted(
+        (st, st + timedelta(minutes=int(s.get("duration") or 0)))
+        for s in around if (st := _to_aware(s.get("start_time"))) is not None
+    )
+
+    fresh: list[SyncBlock] = []
+    replays: list[dict] = []
+    last_end = None
+    for b in candidates:
+        st = _to_aware(b.start_time)
+        en = st + timedelta(minutes=b.duration)
+        prev = existing.get(b.id)
+        if prev is not None:
+            if prev.get("user_id") != uid:
+                reject(b, "id already used")
+            else:  # reenvio: devolve o que foi gravado (e refaz o que ficou pendente)
+                results[b.id] = {"id": b.id, "status": "duplicate",
+                                 **{k: v for k, v in _stored_completion(prev, None).items() if k in ("coins_earned", "xp_earned")}}
+                if (prev.get("completion") or {}).get("pending"):
+                    replays.append(prev)
+        elif b.subject_id not in owned_subjects:
+            reject(b, "unknown subject")
+        elif (last_end is not None and st < last_end) or any(bs < en and st < be for bs, be in busy):
+            reject(b, "overlaps another session")
+        else:
+            fresh.append(b)
+            last_end = en
+
+    # reenvio de um lote que falhou no meio: só os passos pendentes de cada sessão, com o lease
+    incomplete = False
+    if replays:
+        replayed = await asyncio.gather(*(_replay_completion(uid, prev, None) for prev in replays),
+                                        return_exceptions=True)
+        incomplete = any(isinstance(r, Exception) for r in replayed)
+        if any("user" in prev["completion"]["pending"] for prev in replays):   # streak regravado
+            u = await db.users.find_one({"id": uid}, {"_id": 0, "last_streak_date": 1, "streak_days": 1})
+
+    order = list(dict.fromkeys(b.id for b in payload.blocks))
+    if not fresh:
+        if incomplete:
+            raise HTTPException(status_code=503, detail=_INCOMPLETE)
+        return {"ok": True, "results": [results[i] for i in order], "coins_earned": 0, "xp_earned": 0}
+
+    # --- recompensas: minutos da semana antes de cada bloco e streak em ordem cronológica ---
+    # uma leitura das sessões guardadas das semanas do lote; intercaladas com os blocos novos
+    # por start_time, a soma corrida por semana dá os minutos antes de cada bloco
+    starts = [_to_aware(b.start_time) for b in fresh]
+    week_ids = [get_week_bounds(st)[2] for st in starts]
+    stored = sorted(
+        (st, int(s.get("duration") or 0))
+        for s in await db.study_sessions.find(
+            {"user_id": uid, "completed": True, **_start_range(get_week_bounds(starts[0])[0], starts[-1])},
+            {"_id": 0, "start_time": 1, "duration": 1},
+        ).to_list(None)
+        if (st := _to_aware(s.get("start_time"))) is not None
+    )
+    week_before, streaks, acc, k = [], [], {}, 0
+    streak_doc, streak_set, streak_block = u, None, None
+    for b, st, week_id in zip(fresh, starts, week_ids):
+        while k < len(stored) and stored[k][0] < st:
+            w = get_week_bounds(stored[k][0])[2]
+            acc[w] = acc.get(w, 0) + stored[k][1]
+            k += 1
+        week_before.append(acc.get(week_id, 0))
+        if not b.skipped:
+            acc[week_id] = acc.get(week_id, 0) + b.duration
+        streak, upd = _next_streak(streak_doc, b.duration if not b.skipped else 0, st.date())
+        if upd:
+            streak_doc, streak_set, streak_block = {**(streak_doc or {}), **upd}, upd, b.id
+        streaks.append(streak)
+    coins, xp = _batch_rewards([b.duration for b in fresh], [b.skipped for b in fresh],
+                               block_minutes, week_before, streaks)
+
+    # --- sessões: um insert_many; só o que entrou de fato recebe o resto ---
+    # cada doc leva o seu completion.apply/pending, como no /study/end: se um passo em lote
+    # falhar, o reenvio do bloco cai em "duplicate" e refaz só o que ficou pendente
+    _, _, this_week = get_week_bounds(now)
+    docs = []
+    for b, st, week_id, c, x in zip(fresh, starts, week_ids, coins, xp):
+        result = {"ok": True, "session_id": b.id, "coins_earned": c, "xp_earned": x, "skipped": b.skipped}
+        apply = {
+            "subject_id": b.subject_id, "start": st, "duration": b.duration, "skipped": b.skipped,
+            "coins": c, "xp": x, "streak_set": streak_set if b.id == streak_block else None,
+            "created_at": now.isoformat(), "quests": week_id == this_week,
+        }
+        # "user" só no bloco que leva o streak; matéria de bloco pulado não muda (o lote não grava)
+        pending = [n for n in _completion_steps(uid, b.id, apply, replay=True)
+                   if not (n == "user" and not apply["streak_set"]) and not (n == "subject" and b.skipped)]
+        docs.append({
+            "id": b.id, "user_id": uid, "subject_id": b.subject_id, "start_time": st,
+            "end_time": st + timedelta(minutes=b.duration), "duration": b.duration,
+            "completed": not b.skipped, "skipped": b.skipped, "coins_earned": c, "xp_earned": x,
+            "completion": {"key": None, "result": result, "apply": apply, "pending": pending,
+                           "lease_until": now + timedelta(seconds=COMPLETION_LEASE_SECS)},
+            "synced_at": now,
+        })
     try:
-        await update_weekly_quests_after_study(
-            user_id=user.id,
-            subject_id=subject_id,
-            duration=duration,
-            completed=not input.skipped
+        await db.study_sessions.insert_many(docs, ordered=False)
+        lost = set()
+    except BulkWriteError as e:   # id inserido por outro request no meio do caminho
+        lost = {docs[err["index"]]["id"] for err in e.details.get("writeErrors", [])}
+    inserted = [(b, d) for b, d in zip(fresh, docs) if d["id"] not in lost]
+    for b in fresh:
+        if b.id in lost:
+            results[b.id] = {"id": b.id, "status": "duplicate"}
+
+    # --- escritas derivadas: um passo em lote por nome de passo, em paralelo ---
+    done = [(b, d) for b, d in inserted if not b.skipped]
+    subject_inc: dict[str, dict] = {}
+    for b, _ in done:
+        inc = subject_inc.setdefault(b.subject_id, {"time_spent": 0, "sessions_count": 0})
+        inc["time_spent"] += b.duration
+        inc["sessions_count"] += 1
+    daily_by_year: dict[int, dict[int, int]] = {}
+    for b, d in done:
+        year, i = day_index(d["start_time"])
+        days = daily_by_year.setdefault(year, {})
+        days[i] = days.get(i, 0) + b.duration
+    rollups = _merge_incs([_rollup_inc(uid, b.subject_id, d["start_time"], b.duration) for b, d in done])
+    entries = [
+        {"coins": d["coins_earned"], "xp": d["xp_earned"], "ref": d["id"], "key": f"session:{d['id']}"}
+        for _, d in inserted if d["coins_earned"] or d["xp_earned"]
+    ]
+    steps = {}
+    if entries:
+        steps["ledger"] = lambda: ledger.record_many(uid, entries, reason="study_session")
+    if daily_by_year:
+        steps["daily"] = lambda: asyncio.gather(*(_daily_add(uid, year, days) for year, days in daily_by_year.items()))
+    if streak_set and any(d["id"] == streak_block for _, d in inserted):
+        steps["user"] = lambda: db.users.update_one({"id": uid}, {"$set": streak_set})
+    if subject_inc:
+        steps["subject"] = lambda: db.subjects.bulk_write(
+            [UpdateOne({"id": sid, "user_id": uid}, {"$inc": inc}) for sid, inc in subject_inc.items()],
+            ordered=False,
         )
-    except Exception as e:
-        logger.warning(f"update_weekly_quests_after_study warning: {e}")
-
-    # Resposta (GARANTA que este return esteja INDENTADO dentro da função)
+    if rollups:
+        steps["rollup"] = lambda: rollups_col.bulk_write(
+            [UpdateOne(q, upd, upsert=True) for q, upd in rollups], ordered=False)
+    failed = await _run_completion_steps([d["id"] for _, d in inserted], steps) if inserted else []
+    if failed or incomplete:
+        raise HTTPException(status_code=503, detail=_INCOMPLETE)
+
+    # agenda e quests: mesma fila do /study/end (quests só da semana corrente)
+    await asyncio.gather(*(_enqueue_followups(uid, d["id"], d["completion"]["apply"]) for _, d in inserted))
+
+    for b, d in inserted:
+        results[b.id] = {"id": b.id, "status": "created", "coins_earned": d["coins_earned"], "xp_earned": d["xp_earned"]}
     return {
         "ok": True,
-        "session_id": input.session_id,
-        "coins_earned": int(coins),
-        "xp_earned": int(xp),
-        "skipped": bool(input.skipped),
+        "results": [results[i] for i in order],
+        "coins_earned": sum(d["coins_earned"] for _, d in inserted),
+        "xp_earned": sum(d["xp_earned"] for _, d in inserted),
     }
+# === [FIM ADD] ===
+
+
+# === [ADD] Reaper de active_session abandonada (aba morreu sem /study/end) ===
+# active_session.expires_at (data nativa, índice esparso em users) é recalculado a cada start e
+# /study/timer/state: fim da fase (timer.phase_until) + folga, ou, pausado, timer.updated_at +
+# folga maior. O reaper só olha o índice (expires_at < agora), nunca a coleção inteira, e em
+# lotes: limpa a active_session (condicionado ao expires_at lido: um timer que acabou de
+# atualizar não é apagado) e fecha a sessão aberta como abandonada, sem recompensa.
+REAP_INTERVAL_SECS = float(os.getenv("REAP_INTERVAL_SECS", "60"))
+REAP_GRACE_SECS = int(os.getenv("REAP_GRACE_SECS", "900"))           # depois do fim da fase
+REAP_PAUSED_SECS = int(os.getenv("REAP_PAUSED_SECS", "10800"))       # pausado sem notícia
+REAP_BATCH = int(os.getenv("REAP_BATCH", "500"))
+
+def _active_expiry(state: Optional[str], phase_until, now: datetime) -> datetime:
+    until = _to_aware(phase_until)
+    if state in ("focus", "break") and until is not None:
+        return max(until, now) + timedelta(seconds=REAP_GRACE_SECS)
+    return now + timedelta(seconds=REAP_PAUSED_SECS)
+
+
+class ActiveSessionReaper:
+    def __init__(self, users, sessions, presence, interval: float, batch: int):
+        self.users = users
+        self.sessions = sessions
+        self.presence = presence
+        self.interval = interval
+        self.batch = batch
+        self._task: asyncio.Task | None = None
+
+    async def reap_once(self, now: datetime | None = None) -> dict:
+        """Um lote. Devolve {"fetched": vencidas lidas, "users": limpos, "sessions": fechadas}."""
+        now = now or datetime.now(timezone.utc)
+        stale = await self.users.find(
+            {"active_session.expires_at": {"$lt": now}},
+            {"_id": 0, "id": 1, "active_session.session_id": 1, "active_session.expires_at": 1},
+        ).limit(self.batch).to_list(self.batch)
+        if not stale:
+            return {"fetched": 0, "users": 0, "sessions": 0}
+
+        # um update condicional por usuário (juntos): o modified_count diz de quem a limpeza pegou
+        res = await asyncio.gather(*(
+            self.users.update_one(
+                {"id": u["id"], "active_session.expires_at": u["active_session"]["expires_at"]},
+                {"$unset": {"active_session": ""}},
+            )
+            for u in stale
+        ))
+        cleared = [u for u, r in zip(stale, res) if r.modified_count]
+        # quem mexeu no timer entre o find e o update ficou de fora; se foi para uma sessão
+        # nova, a antiga (lida no find) ficou largada e é fechada mesmo assim
+        spared = [u["id"] for u, r in zip(stale, res) if not r.modified_count]
+        current = {
+            u["id"]: u["active_session"].get("session_id")
+            async for u in self.users.find(
+                {"id": {"$in": spared}, "active_session.session_id": {"$exists": True}},
+                {"_id": 0, "id": 1, "active_session.session_id": 1},
+            )
+        } if spared else {}
+        ops = [
+            # mesma transição do /study/end (end_time nulo -> data): um /study/end atrasado vê a sessão encerrada
+            UpdateOne(
+                {"id": sid, "user_id": u["id"], "end_time": None},
+                {"$set": {"end_time": now, "duration": 0, "completed": False, "skipped": True,
+                          "abandoned": True, "coins_earned": 0, "xp_earned": 0}},
+            )
+            for u in stale if (sid := u["active_session"].get("session_id")) and current.get(u["id"]) != sid
+        ]
+        closed = (await self.sessions.bulk_write(ops, ordered=False)).modified_count if ops else 0
+        # presença e cache: só de quem teve a active_session apagada aqui
+        uids = [u["id"] for u in cleared]
+        if uids:
+            await self.presence.update_many(
+                {"user_id": {"$in": uids}},
+                {"$set": {"timer_state": None, "studying": None, "seconds_left": None, "show_timer": False}},
+            )
+            for uid in uids:
+                invalidate_user(uid)
+        return {"fetched": len(stale), "users": len(uids), "sessions": closed}
+
+    async def reap(self) -> dict:
+        total = {"users": 0, "sessions": 0}
+        while True:
+            r = await self.reap_once()
+            total["users"] += r["users"]
+            total["sessions"] += r["sessions"]
+            # lote cheio = pode haver mais, mesmo que parte tenha sido poupada (timer atualizado)
+            if r["fetched"] < self.batch:
+                return total
+
+    async def backfill(self) -> int:
+        """Offline: expires_at para active_sessions de antes do reaper (varre só quem tem uma)."""
+        now = datetime.now(timezone.utc)
+        ops = []
+        async for u in self.users.find(
+            {"active_session": {"$exists": True}, "active_session.expires_at": {"$exists": False}},
+            {"_id": 0, "id": 1, "active_session": 1},
+        ):
+            timer = (u.get("active_session") or {}).get("timer") or {}
+            seen = _to_aware(timer.get("updated_at")) or _to_aware(u["active_session"].get("start_time")) or now
+            ops.append(UpdateOne(
+                {"id": u["id"], "active_session.expires_at": {"$exists": False}},
+                {"$set": {"active_session.expires_at": _active_expiry(timer.get("state"), timer.get("phase_until"), seen)}},
+            ))
+        done = 0
+        for i in range(0, len(ops), self.batch):
+            done += (await self.users.bulk_write(ops[i:i + self.batch], ordered=False)).modified_count
+        return done
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.warning(f"active session reaper warn: {e}")
 
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
 
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
 
+reaper = ActiveSessionReaper(db.users, db.study_sessions, presence_col, REAP_INTERVAL_SECS, REAP_BATCH)
+
+@app.on_event("startup")
+async def _startup_reaper():
+    reaper.start()
+# === [FIM ADD] ===
 
 
 # --- SHOP: precificação proporcional a 5000h -------------------------------
@@ -2698,30 +4208,117 @@ def theme_effects(rarity: str, i: int) -> Dict[str, Any]:
 # make_items() removido - agora usa build_items() do shop_seed.py
 
 
-async def initialize_shop():
+# === [ADD] Catálogo da loja em memória (índices + bytes pré-serializados + ETag) ===
+# a versão fica em db.shop_meta; outros workers conferem no máximo a cada N segundos
+CATALOG_VERSION_CHECK_SECS = float(os.getenv("CATALOG_VERSION_CHECK_SECS", "30"))
+
+
+class ShopCatalog:
+    """
+    Catálogo carregado uma vez por worker: id -> item e o corpo do /shop/list
+    já serializado, com ETag = hash do conteúdo. Só recarrega quando a versão em
+    db.shop_meta muda (bump() no seed).
+    """
+    def __init__(self, items_col, meta_col):
+        self.items_col = items_col
+        self.meta_col = meta_col
+        self.version = None
+        self.items: list[dict] = []
+        self.by_id: dict[str, dict] = {}
+        self.body = b""
+        self.etag = ""
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _remote_version(self) -> int:
+        try:
+            doc = await self.meta_col.find_one({"_id": "catalog"}, {"version": 1})
+        except Exception:
+            return self.version or 0
+        return int((doc or {}).get("version", 0))
+
+    async def _read_items(self) -> list[dict]:
+        try:
+            items = await self.items_col.find({}, {"_id": 0}).to_list(1000)
+        except Exception:
+            # fallback: se não tiver DB, use seed em memória do shop_seed.py
+            return build_items()
+        if not items:
+            items = await _seed_shop_items()
+        return items
+
+    def _index(self, items: list[dict], version: int):
+        body = json_dumps({"items": items})
+        self.items = items
+        self.by_id = {it["id"]: it for it in items}
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        self.version = version
+
+    async def ensure(self) -> "ShopCatalog":
+        now = time.monotonic()
+        if self.version is not None and now - self._checked_at < CATALOG_VERSION_CHECK_SECS:
+            return self
+        async with self._lock:
+            if self.version is not None and time.monotonic() - self._checked_at < CATALOG_VERSION_CHECK_SECS:
+                return self
+            version = await self._remote_version()
+            if version != self.version:
+                self._index(await self._read_items(), version)
+            self._checked_at = time.monotonic()
+        return self
+
+    async def bump(self):
+        """Chamado depois de reescrever db.shop_items: nova versão + recarga local imediata."""
+        try:
+            doc = await self.meta_col.find_one_and_update(
+                {"_id": "catalog"}, {"$inc": {"version": 1}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+            version = int(doc["version"])
+        except Exception:
+            version = (self.version or 0) + 1
+        async with self._lock:
+            self._index(await self._read_items(), version)
+            self._checked_at = time.monotonic()
+
+    async def get(self, item_id: str) -> dict | None:
+        return (await self.ensure()).by_id.get(item_id)
+
+    def matches(self, if_none_match: str | None) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = (t.strip().removeprefix("W/") for t in if_none_match.split(","))
+        return self.etag in tags
+
+
+shop_catalog = ShopCatalog(db.shop_items, db.shop_meta)
+
+
+async def _seed_shop_items() -> list[dict]:
     items = build_items()   # agora existe
     try:
         await db.shop_items.delete_many({})
-        await db.shop_items.insert_many(items)
+        # cópias: insert_many acrescenta _id (ObjectId) nos dicts
+        await db.shop_items.insert_many([dict(it) for it in items])
     except Exception:
         pass
     return items
 
 
+async def initialize_shop():
+    items = await _seed_shop_items()
+    await shop_catalog.bump()
+    return items
+# === [FIM ADD] ===
+
+
 # ------------------------- MODELOS E ROTAS -------------------------
 class EquipBody(BaseModel):
     item_id: str
 
-async def _get_items():
-    try:
-        items = await db.shop_items.find({}, {"_id": 0}).to_list(1000)
-        if items:
-            return items
-    except Exception:
-        pass
-    # fallback: se não tiver DB, use seed em memória do shop_seed.py
-    return build_items()
-
 @api_router.post("/admin/seed-shop")
 async def route_seed_shop():
     items = await initialize_shop()
@@ -2735,37 +4332,34 @@ async def route_seed_shop():
 @api_router.get("/shop/items")
 @api_router.get("/shop")
 @api_router.get("/shop/all")
-async def shop_list():
-    # tenta ler do Mongo
-    items = await db.shop_items.find({}, {"_id": 0}).to_list(1000)
-    # se estiver vazio, faz o seed uma vez
-    if not items:
-        items = await initialize_shop()
-    # *** SEMPRE devolva neste shape ***
-    return {"items": items}
+async def shop_list(if_none_match: Optional[str] = Header(default=None)):
+    # catálogo em memória (seed automático se a coleção estiver vazia)
+    catalog = await shop_catalog.ensure()
+    headers = {"ETag": catalog.etag, "Cache-Control": "no-cache"}
+    if catalog.matches(if_none_match):
+        return Response(status_code=304, headers=headers)
+    # *** SEMPRE devolva neste shape *** ({"items": [...]}, já serializado)
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
 
 @api_router.post("/shop/equip")
 async def route_shop_equip(body: EquipBody, request: Request, session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(request, session_token)
     
     # tenta achar o item
-    items = await _get_items()
-    item = next((x for x in items if x["id"] == body.item_id), None)
+    item = await shop_catalog.get(body.item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item não encontrado")
 
-    # verifica se o usuário possui o item
-    items_owned = user.items_owned or []
-    if body.item_id not in items_owned:
-        raise HTTPException(status_code=400, detail="Você não possui este item")
-    
     item_type = item["item_type"]
     
-    # atualiza no banco
-    await db.users.update_one(
-        {"id": user.id},
+    # posse conferida no filtro (o perfil em cache pode ser de antes da compra, feita em outro worker)
+    res = await db.users.update_one(
+        {"id": user.id, "items_owned": body.item_id},
         {"$set": {f"equipped_items.{item_type}": body.item_id}}
     )
+    if res.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Você não possui este item")
+    invalidate_user(user.id)
     
     return {"ok": True, "item_type": item_type, "item_id": body.item_id}
 
@@ -2782,6 +4376,7 @@ async def route_shop_unequip(body: dict, request: Request, session_token: Option
         {"id": user.id},
         {"$set": {f"equipped_items.{item_type}": None}}
     )
+    invalidate_user(user.id)
     
     return {"ok": True, "item_type": item_type}
     
@@ -2937,17 +4532,17 @@ async def level_bonus(payload: LevelBonusPayload, request: Request, session_toke
     lvl   = int(payload.level)
     bonus = max(0, int(payload.bonus_coins))
 
-    # evita pagar repetido: grava levels_paid por usuário
-    doc = await db.user_bonus.find_one({"user_id": user.id}, {"_id": 0})
-    already = set(doc.get("levels_paid", [])) if doc else set()
-    if lvl in already or bonus <= 0:
+    # evita pagar repetido: a chave única do lançamento garante um pagamento por nível
+    if bonus <= 0:
+        return {"ok": True, "paid": False}
+    doc = await db.user_bonus.find_one({"user_id": user.id, "levels_paid": lvl}, {"_id": 1})
+    if doc or not await ledger.record(user.id, coins=bonus, reason="level_bonus", ref=str(lvl),
+                                      key=f"level_bonus:{user.id}:{lvl}"):
         return {"ok": True, "paid": False}
 
-    await db.users.update_one({"id": user.id}, {"$inc": {"coins": bonus}}, upsert=True)
-    already.add(lvl)
     await db.user_bonus.update_one(
         {"user_id": user.id},
-        {"$set": {"levels_paid": sorted(list(already))}},
+        {"$addToSet": {"levels_paid": lvl}},
         upsert=True
     )
     return {"ok": True, "paid": True, "bonus": bonus}
@@ -2970,20 +4565,15 @@ async def calendar_create(ev: CalendarEventCreate, request: Request, session_tok
         end=ev.end,
         subject_id=ev.subject_id,
         checklist=ev.checklist or []
-    ).model_dump()
-    # normaliza ISO
-    doc["start"] = doc["start"].isoformat()
-    doc["end"]   = doc["end"].isoformat()
-    doc["created_at"] = doc["created_at"].isoformat()
+    ).model_dump()   # start/end/created_at como datas nativas
     await db.calendar_events.insert_one(doc)
     return doc
 
 @api_router.get("/calendar/day")
-async def calendar_day(payload: dict, user = Depends(require_user)):
+async def calendar_day(date_iso: str, user = Depends(require_user)):
     """
     Retorna eventos do dia (UTC) informado (YYYY-MM-DD).
     """
-    user = await get_current_user(request, session_token)
     try:
         d = datetime.fromisoformat(date_iso).date()
     except Exception:
@@ -2996,12 +4586,13 @@ async def calendar_day(payload: dict, user = Depends(require_user)):
         {
             "user_id": user.id,
             # qualquer evento que toque o dia
-            "start": {"$lt": day_end.isoformat()},
-            "end":   {"$gt": day_start.isoformat()}
+            "$and": [_date_filter("start", lt=day_end), _date_filter("end", gt=day_start)],
         },
         {"_id": 0}
-    ).sort("start", 1).to_list(500)
-    return {"ok": True}
+    ).to_list(500)
+    # ordena aqui: na transição Date e string não se intercalam no sort do Mongo
+    items.sort(key=lambda ev: _to_aware(ev.get("start")) or datetime.min.replace(tzinfo=timezone.utc))
+    return items
 
 @api_router.patch("/calendar/event/{event_id}")
 async def calendar_update(event_id: str, payload: CalendarEventUpdate, request: Request, session_token: Optional[str] = Cookie(None)):
@@ -3015,12 +4606,6 @@ async def calendar_update(event_id: str, payload: CalendarEventUpdate, request:
         if not owned:
             raise HTTPException(status_code=400, detail="subject_id inválido")
 
-    # normaliza ISO se veio datetime
-    if "start" in upd and isinstance(upd["start"], datetime):
-        upd["start"] = upd["start"].isoformat()
-    if "end" in upd and isinstance(upd["end"], datetime):
-        upd["end"] = upd["end"].isoformat()
-
     await db.calendar_events.update_one({"id": event_id, "user_id": user.id}, {"$set": upd})
     return {"success": True}
 
@@ -3059,45 +4644,64 @@ async def checklist_toggle(event_id: str, item_id: str, request: Request, sessio
 # Shop Routes
 @api_router.get("/shop", response_model=List[ShopItem])
 async def get_shop_items():
-    items = await db.shop_items.find({}, {"_id": 0}).to_list(1000)
-    if not items:
-        # Initialize shop with default items
-        items = await initialize_shop()
-    return items
+    return (await shop_catalog.ensure()).items
+
+async def buy_item(user_id: str, item: dict) -> int:
+    """
+    Compra atômica: um find_one_and_update só casa se o usuário tem saldo, nível e ainda
+    não possui o item. Duas compras simultâneas não passam ambas (sem saldo negativo nem
+    item duplicado). Devolve o novo saldo.
+    """
+    item_id = item["id"]
+    price = int(item.get("price", 0) or 0)
+    min_level = int(item.get("level_required", 1) or 1)
+
+    query = {"id": user_id, "items_owned": {"$ne": item_id}}
+    if price > 0:
+        query["coins"] = {"$gte": price}
+    if min_level > 1:
+        query["level"] = {"$gte": min_level}
+
+    # marcador em ledger_batches até o lançamento existir: a auditoria não lê o gasto pela metade
+    marker = f"purchase:{uuid.uuid4().hex}"
+    doc = await db.users.find_one_and_update(
+        query,
+        {"$inc": {"coins": -price}, "$addToSet": {"items_owned": item_id}, "$push": {"ledger_batches": marker}},
+        projection={"coins": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
+        # não casou: uma leitura só para explicar o motivo
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "coins": 1, "level": 1, "items_owned": 1})
+        if not user:
+            raise HTTPException(status_code=401, detail="invalid-user")
+        if (user.get("level") or 1) < min_level:
+            raise HTTPException(status_code=400, detail=f"Nível insuficiente: requer nível {min_level}")
+        if item_id in (user.get("items_owned") or []):
+            raise HTTPException(status_code=400, detail="Item already owned")
+        raise HTTPException(status_code=400, detail="Not enough coins")
+
+    invalidate_user(user_id)
+    # gasto já aplicado no snapshot; o lançamento é só para auditoria/reconstrução
+    await ledger.record(user_id, coins=-price, reason="purchase", ref=item_id, key=marker, applied=True)
+    await db.users.update_one({"id": user_id}, {"$pull": {"ledger_batches": marker}})
+    return int(doc.get("coins", 0))
+
 
 # === PATCH: /shop/purchase (substituir função inteira) ===
 @api_router.post("/shop/purchase")
 async def purchase_item(input: PurchaseItem, request: Request, session_token: Optional[str] = Cookie(None)):
-    # 1) pega usuário atual (já logado)
-    user = await get_current_user(request, session_token)
+    # só o uid do token (cache); saldo/posse são checados no próprio update
+    uid = await session_uid(request, session_token)
 
-    # 2) busca o item no banco
-    item = await db.shop_items.find_one({"id": input.item_id}, {"_id": 0})
+    item = await shop_catalog.get(input.item_id)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    # 3) bloqueia por nível mínimo (se houver)
-    min_level = item.get("level_required", 1)
-    if (user.level or 1) < min_level:
-        raise HTTPException(status_code=400, detail=f"Nível insuficiente: requer nível {min_level}")
-
-    # 4) checa coins
-    price = item.get("price", 0)
-    if (user.coins or 0) < price:
-        raise HTTPException(status_code=400, detail="Not enough coins")
-
-    # 5) não comprar duas vezes
-    already = input.item_id in (user.items_owned or [])
-    if already:
-        raise HTTPException(status_code=400, detail="Item already owned")
-
-    # 6) debita e adiciona item
-    await db.users.update_one(
-        {"id": user.id},
-        {"$inc": {"coins": -price}, "$push": {"items_owned": input.item_id}},
-    )
+    coins = await buy_item(uid, item)
+    activity_buffer.touch(uid, last_activity=datetime.now(timezone.utc).isoformat())
 
-    return {"success": True, "spent": price, "item_id": input.item_id}
+    return {"success": True, "spent": item.get("price", 0), "item_id": input.item_id, "coins": coins}
 # === /PATCH ===
 
 
@@ -3112,29 +4716,35 @@ class UnequipItem(BaseModel):
 
 
 # Stats Routes
+@api_router.get("/stats/heatmap")
+async def get_heatmap(request: Request, year: Optional[int] = Query(None, ge=2000, le=2100),
+                      session_token: Optional[str] = Cookie(None)):
+    user = await get_current_user(request, session_token)
+    year = year or datetime.now(timezone.utc).year
+    minutes = await daily_series(user.id, year)
+    return {"year": year, "start": f"{year}-01-01", "minutes": minutes, "total": sum(minutes)}
+
 @api_router.get("/stats")
 async def get_stats(request: Request, session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(request, session_token)
     
-    # Get current week cycle
-    now = datetime.now(timezone.utc)
-    week_start = now - timedelta(days=now.weekday())
-    week_start = week_start.replace(hour=0, minute=0, second=0, microsecond=0)
-    
-    # Total study time
-    sessions = await db.study_sessions.find({"user_id": user.id, "completed": True}, {"_id": 0}).to_list(10000)
-    total_time = sum(s.get("duration", 0) for s in sessions)
+    # Total por matéria (minutos e nº de sessões), agrupado no Mongo
+    by_subject = {
+        row["_id"]: row async for row in db.study_sessions.aggregate([
+            {"$match": {"user_id": user.id, "completed": True}},
+            {"$group": {"_id": "$subject_id", "minutes": {"$sum": "$duration"}, "count": {"$sum": 1}}},
+        ])
+    }
+    total_time = sum(int(r["minutes"] or 0) for r in by_subject.values())
     
-    # Week time
-    week_sessions = [s for s in sessions if datetime.fromisoformat(s["start_time"]) >= week_start]
-    week_time = sum(s.get("duration", 0) for s in week_sessions)
+    # Week time (rollup da semana) e saldo atual (o perfil em cache pode ser de outro worker)
+    week_time, bal = await asyncio.gather(_week_minutes_accumulated(user.id), fresh_balance(user.id))
     
     # Subject breakdown
     subjects = await db.subjects.find({"user_id": user.id}, {"_id": 0}).to_list(100)
     subject_stats = []
     for subject in subjects:
-        subject_sessions = [s for s in sessions if s["subject_id"] == subject["id"]]
-        subject_time = sum(s.get("duration", 0) for s in subject_sessions)
+        subject_time = int((by_subject.get(subject["id"]) or {}).get("minutes") or 0)
         subject_stats.append({
             "id": subject["id"],
             "name": subject["name"],
@@ -3148,7 +4758,7 @@ async def get_stats(request: Request, session_token: Optional[str] = Cookie(None
     total_goal = sum(s["time_goal"] for s in subjects)
     cycle_progress = min(100, (week_time / total_goal) * 100) if total_goal > 0 else 0
     
-    sessions_completed = sum(1 for s in sessions if s.get("completed"))
+    sessions_completed = sum(r["count"] for r in by_subject.values())
     total_studied_minutes = total_time  # alias mais claro
 
     return {
@@ -3157,9 +4767,9 @@ async def get_stats(request: Request, session_token: Optional[str] = Cookie(None
         "week_time": week_time,
         "cycle_progress": cycle_progress,
         "subjects": subject_stats,
-        "level": user.level,
-        "xp": user.xp,
-        "coins": user.coins,
+        "level": bal.get("level", user.level),
+        "xp": bal.get("xp", user.xp),
+        "coins": bal.get("coins", user.coins),
         "sessions_completed": sessions_completed
     }
 
@@ -3469,4 +5079,14 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # grava os carimbos pendentes antes de fechar a conexão
+    await activity_buffer.stop()
+    await session_store.stop()
+    await reaper.stop()
+    await jobs.stop()
+    await ledger.stop()
+    await close_oauth_http()
+    await _limiter.close()
+    if _index_task is not None and not _index_task.done():
+        _index_task.cancel()
     client.close()
\ No newline at end of file